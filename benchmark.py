@@ -0,0 +1,779 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# End-to-end benchmark of the scraping pipeline against a synthetic corpus.
+#
+# Spins up mock_yio.MockServer, then runs the real pipeline functions:
+#
+#   fetch        HTTP round trips (listing pages and organization pages)
+#   parse        parse_subject_page / parse_individual_org, minus the time
+#                spent fetching and writing
+#   raw insert   DB.insert_dict and DB.add_raw_columns
+#   clean        clean_raw_orgs.clean_row
+#   final insert clean_raw_orgs.clean_org_to_db
+#
+# and appends throughput, latency percentiles and peak RSS to a JSON history
+# file so runs can be compared:
+#
+#   python benchmark.py --orgs 500 --per-page 25
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import logutil
+import metrics
+import throttle
+from yio import DB
+from mock_yio import SyntheticYIO, MockServer
+
+# Full modules
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import requests
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Just parts of modules
+from collections import defaultdict, namedtuple
+from datetime import datetime
+
+# Start log
+logger = logging.getLogger(__name__)
+
+STAGES = ["fetch", "parse", "raw_insert", "clean", "final_insert"]
+
+# Modules whose import cost --startup measures: every entry point, plus yio
+# on its own since everything imports it
+STARTUP_MODULES = ["yio", "scrape_yio", "manual_copy_paste", "clean_raw_orgs",
+                   "pipeline", "delta_crawl", "page_store", "search",
+                   "export_final", "snapshot", "run"]
+
+# (name, use_queue, aggregate_every, level) for the logging benchmark
+LOG_MODES = [("off", False, 1, "WARNING"),
+             ("sync", False, 1, "INFO"),
+             ("sync+aggregate", False, 500, "INFO"),
+             ("queue", True, 1, "INFO"),
+             ("queue+aggregate", True, 500, "INFO")]
+
+
+class StageTimer():
+    """Accumulate per-item durations for each pipeline stage"""
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.bytes_fetched = 0
+
+    def add(self, stage, seconds):
+        self.durations[stage].append(seconds)
+
+    def total(self, stage):
+        return sum(self.durations[stage])
+
+    def summary(self):
+        stages = {}
+        for stage in STAGES:
+            durations = sorted(self.durations[stage])
+            total = sum(durations)
+            stages[stage] = {
+                "items": len(durations),
+                "seconds": round(total, 6),
+                "per_second": (round(len(durations) / total, 2)
+                               if total > 0 else None),
+                "p50_ms": percentile(durations, 50),
+                "p90_ms": percentile(durations, 90),
+                "p99_ms": percentile(durations, 99),
+            }
+        return stages
+
+
+class TimedDB(DB):
+    """DB that charges its writes to the raw insert stage"""
+    def __init__(self, timer):
+        super().__init__()
+        self.timer = timer
+
+    def insert_dict(self, row_dict, table, *args, **kwargs):
+        start = time.perf_counter()
+        super().insert_dict(row_dict, table, *args, **kwargs)
+        self.timer.add("raw_insert", time.perf_counter() - start)
+
+    def add_raw_columns(self, colnames):
+        start = time.perf_counter()
+        super().add_raw_columns(colnames)
+        self.timer.add("raw_insert", time.perf_counter() - start)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list, in milliseconds"""
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1)
+    return round(sorted_values[min(rank, len(sorted_values) - 1)] * 1000, 3)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss = rss / 1024
+    return round(rss / 1024, 1)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def unthrottled():
+    """Start requests with no pause between them, so the benchmarks that
+    aren't about pacing measure the pipeline rather than the throttle"""
+    config.THROTTLE_INTERVAL = 0
+    config.THROTTLE_MIN_INTERVAL = 0
+    throttle.reset()
+
+
+def timed_session(timer):
+    """A plain requests session that records every round trip as a fetch"""
+    session = requests.session()
+
+    def record_fetch(response, *args, **kwargs):
+        # Hooks run before the body is read, so read it here to count the
+        # whole transfer in the fetch stage
+        start = time.perf_counter()
+        timer.bytes_fetched += len(response.content)
+        timer.add("fetch", response.elapsed.total_seconds() +
+                  time.perf_counter() - start)
+
+    session.hooks["response"].append(record_fetch)
+    return session
+
+
+def run_pipeline(corpus, timer):
+    """Run every stage of the pipeline against a running mock server"""
+    # Import here so config.BASE_URL is already pointing at the mock server
+    import scrape_yio
+    import clean_raw_orgs
+
+    session = timed_session(timer)
+    db = TimedDB(timer)
+
+    # Subject listings -> organizations
+    for subject in corpus.subjects:
+        fetch_before = timer.total("fetch")
+        insert_before = timer.total("raw_insert")
+        start = time.perf_counter()
+
+        scrape_yio.parse_subject_page(session, scrape_yio.subject_url(subject),
+                                      subject, db)
+
+        elapsed = time.perf_counter() - start
+        timer.add("parse", elapsed -
+                  (timer.total("fetch") - fetch_before) -
+                  (timer.total("raw_insert") - insert_before))
+
+    # Organization pages -> organizations_raw
+    OrgPage = namedtuple('OrgPage', ['id_org', 'name', 'url'])
+    db.c.execute("SELECT id_org, org_name_t, org_url FROM organizations")
+    orgs = [OrgPage(*row) for row in db.c.fetchall()]
+
+    for org in orgs:
+        fetch_before = timer.total("fetch")
+        insert_before = timer.total("raw_insert")
+        start = time.perf_counter()
+
+        scrape_yio.parse_individual_org(session, org, db)
+
+        elapsed = time.perf_counter() - start
+        timer.add("parse", elapsed -
+                  (timer.total("fetch") - fetch_before) -
+                  (timer.total("raw_insert") - insert_before))
+
+    # clean_me_full -> organizations_final
+    colnames_raw = db.c.execute("PRAGMA table_info(clean_me_full);").fetchall()
+    OrgRawRow = namedtuple("OrgRawRow", [col[1] for col in colnames_raw])
+    rows = [OrgRawRow(*row) for row in
+            db.c.execute("SELECT * FROM clean_me_full").fetchall()]
+
+    for row in rows:
+        start = time.perf_counter()
+        record = clean_raw_orgs.clean_row(row)
+        timer.add("clean", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        clean_raw_orgs.clean_org_to_db(*record, db=db)
+        timer.add("final_insert", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    db.conn.commit()
+    timer.add("final_insert", time.perf_counter() - start)
+
+    n_final = db.c.execute("SELECT COUNT(*) FROM organizations_final").fetchone()[0]
+    db.close()
+
+    return len(orgs), n_final
+
+
+def seed_database(corpus):
+    """Fill a fresh database with listing rows and saved pages in data_raw,
+    the state parse_manual_orgs starts from, without going over HTTP
+    """
+    db = DB()
+    db.c.execute("""CREATE TABLE IF NOT EXISTS data_raw
+                    (fk_org integer NOT NULL, org_html text)""")
+
+    for id_org, org in enumerate(corpus.orgs.values(), start=1):
+        db.c.execute("""INSERT INTO organizations
+                        (id_org, org_name_t, org_url, org_url_id, org_subject_t)
+                        VALUES (?, ?, ?, ?, ?)""",
+                     (id_org, org.name, "/s/or/en/{0}".format(org.uia_id),
+                      str(org.uia_id), org.subject))
+        db.c.execute("INSERT INTO data_raw (fk_org, org_html) VALUES (?, ?)",
+                     (id_org, org.page()))
+
+    db.conn.commit()
+    db.close()
+
+
+def bench_logging(args):
+    """Time parse_manual_orgs under each logging mode.
+
+    Besides wall time, every call to Logger.handle (filters plus handlers,
+    i.e. everything a log call costs after building the record) is timed, so
+    the logging overhead can be read off without the noise of parsing. The
+    console handler writes to os.devnull so the numbers reflect formatting
+    and writing, not the terminal.
+    """
+    import scrape_yio
+
+    corpus = SyntheticYIO(n_orgs=args.orgs, per_page=args.per_page,
+                          seed=args.seed)
+    results = {}
+
+    original_handle = logging.Logger.handle
+    spent = [0.0]
+
+    def timed_handle(self, record):
+        start = time.perf_counter()
+        original_handle(self, record)
+        spent[0] += time.perf_counter() - start
+
+    logging.Logger.handle = timed_handle
+    try:
+        for name, use_queue, every, level in LOG_MODES:
+            with tempfile.TemporaryDirectory() as tmp:
+                config.DB_FILE = os.path.join(tmp, "yio.db")
+                config.METRICS_DIR = tmp
+                seed_database(corpus)
+
+                settings = copy.deepcopy(config.LOG_SETTINGS)
+                settings["handlers"]["file"]["filename"] = os.path.join(tmp, "yio.log")
+                settings["handlers"]["console"] = dict(settings["handlers"]["file"],
+                                                       filename=os.devnull)
+                settings["loggers"][""]["level"] = level
+                logutil.configure(settings, use_queue=use_queue,
+                                  aggregate_every=every)
+
+                spent[0] = 0.0
+                start = time.perf_counter()
+                scrape_yio.parse_manual_orgs()
+                wall = time.perf_counter() - start
+                in_logging = spent[0]
+                logutil.shutdown()
+
+            results[name] = {"wall_us_per_row": wall / args.orgs * 1e6,
+                             "logging_us_per_row": in_logging / args.orgs * 1e6}
+    finally:
+        logging.Logger.handle = original_handle
+
+    baseline = results["sync"]["logging_us_per_row"]
+    print("parse_manual_orgs over {0} orgs, microseconds per row:"
+          .format(args.orgs))
+    for name, result in results.items():
+        print("  {0:<16} {1:>9.1f} wall  {2:>7.1f} in logging  ({3:.0%} of sync)"
+              .format(name, result["wall_us_per_row"],
+                      result["logging_us_per_row"],
+                      result["logging_us_per_row"] / baseline))
+
+
+def bench_streaming(args):
+    """Compare the batch scripts with pipeline.run on the same corpus.
+
+    The mock server adds --latency seconds to every response, standing in
+    for the network. Besides wall time, reports how long it takes for the
+    first clean organization to be written, and checks both modes produce
+    the same organizations_final.
+    """
+    import clean_raw_orgs
+    import pipeline
+
+    corpus = SyntheticYIO(n_orgs=args.orgs, per_page=args.per_page,
+                          seed=args.seed)
+    unthrottled()
+    results = {}
+
+    original_write = clean_raw_orgs.clean_org_to_db
+    first_write = [None]
+
+    def timed_write(*args, **kwargs):
+        if first_write[0] is None:
+            first_write[0] = time.perf_counter()
+        return original_write(*args, **kwargs)
+
+    clean_raw_orgs.clean_org_to_db = timed_write
+    try:
+        for mode in ["batch", "streaming"]:
+            with tempfile.TemporaryDirectory() as tmp, \
+                    MockServer(corpus, latency=args.latency) as server:
+                config.DB_FILE = os.path.join(tmp, "yio.db")
+                config.METRICS_DIR = tmp
+                config.BASE_URL = server.url
+                first_write[0] = None
+
+                start = time.perf_counter()
+                if mode == "batch":
+                    run_pipeline(corpus, StageTimer())
+                else:
+                    pipeline.run(subjects=corpus.subjects,
+                                 session=requests.session())
+                wall = time.perf_counter() - start
+
+                db = DB()
+                final = db.c.execute("""SELECT * FROM organizations_final
+                                        ORDER BY id_org""").fetchall()
+                db.close()
+
+            results[mode] = {"wall": wall, "first_row": first_write[0] - start,
+                             "final": final}
+    finally:
+        clean_raw_orgs.clean_org_to_db = original_write
+
+    print("{0} orgs, {1}ms simulated latency per request:"
+          .format(args.orgs, args.latency * 1000))
+    for mode, result in results.items():
+        print("  {0:<10} {1:>8.2f}s wall  {2:>8.2f}s to first clean row  "
+              "{3} rows".format(mode, result["wall"], result["first_row"],
+                                len(result["final"])))
+    print("  same organizations_final: {0}"
+          .format(results["batch"]["final"] == results["streaming"]["final"]))
+
+
+def bench_startup(args, repeat=7):
+    """Import time of each entry point in a fresh interpreter.
+
+    Runs `python -X importtime -c "import <module>"` repeat times and
+    reports the median cumulative import time of the module, the median wall
+    time of the whole process, and the slowest imports it pulls in.
+    """
+    print("Median of {0} fresh interpreters, milliseconds:".format(repeat))
+    print("  {0:<18} {1:>8} {2:>9}  {3}".format("module", "import",
+                                                 "process", "slowest imports"))
+
+    for module in STARTUP_MODULES:
+        imports, walls = [], []
+        children = defaultdict(list)
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-X", "importtime",
+                                      "-c", "import " + module],
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.PIPE,
+                                     universal_newlines=True)
+            walls.append(time.perf_counter() - start)
+
+            if process.returncode != 0:
+                break
+
+            # A module's line comes after those of everything it imports, so
+            # collect top-level imports until reaching a top-level line
+            direct = []
+            for line in process.stderr.splitlines():
+                parts = line.split("|")
+                if len(parts) != 3 or not parts[1].strip().isdigit():
+                    continue
+                name = parts[2].rstrip()
+                depth = (len(name) - len(name.lstrip())) // 2
+                cumulative = int(parts[1]) / 1000
+
+                if depth == 1:
+                    direct.append((name.strip(), cumulative))
+                elif depth == 0:
+                    if name.strip() == module:
+                        imports.append(cumulative)
+                        for child, child_time in direct:
+                            children[child].append(child_time)
+                    direct = []
+
+        if len(imports) < repeat:
+            print("  {0:<18} failed: {1}".format(
+                module, process.stderr.strip().splitlines()[-1]))
+            continue
+
+        slowest = sorted(((statistics.median(times), name)
+                          for name, times in children.items()),
+                         reverse=True)[:3]
+        print("  {0:<18} {1:>8.1f} {2:>9.1f}  {3}".format(
+            module, statistics.median(imports), statistics.median(walls) * 1000,
+            ", ".join("{0} {1:.1f}".format(name, ms) for ms, name in slowest)))
+
+
+def bench_delta(args):
+    """Full crawl versus a delta crawl after corpus.refresh().
+
+    Both go through delta_crawl.run: on an empty database every listed
+    organization is new, so the first run is a full crawl. Then a fraction
+    of the organizations change or are added, and a second run should fetch
+    only those. Reports requests, bytes and wall time for each, and checks
+    the delta run found exactly what changed.
+    """
+    import delta_crawl
+
+    corpus = SyntheticYIO(n_orgs=args.orgs, per_page=args.per_page,
+                          seed=args.seed)
+    unthrottled()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            MockServer(corpus, latency=args.latency) as server:
+        config.DB_FILE = os.path.join(tmp, "yio.db")
+        config.METRICS_DIR = tmp
+        config.BASE_URL = server.url
+
+        for run in ["full", "delta"]:
+            if run == "delta":
+                before = {uia_id: org.listing_row("")
+                          for uia_id, org in corpus.orgs.items()}
+                _, added = corpus.refresh(changed=args.changed,
+                                          added=args.added)
+                changed = [uia_id for uia_id, row in before.items()
+                           if corpus.orgs[uia_id].listing_row("") != row]
+
+            timer = StageTimer()
+            start = time.perf_counter()
+            counts = delta_crawl.run(session=timed_session(timer))
+            results[run] = {"wall": time.perf_counter() - start,
+                            "requests": len(timer.durations["fetch"]),
+                            "bytes": timer.bytes_fetched, "counts": counts}
+
+        db = DB()
+        stored = {int(url_id): (city, type_ii) for url_id, city, type_ii in
+                  db.c.execute("""SELECT org_url_id, org_city_hq_t,
+                                         org_type_ii_t FROM organizations""")}
+        n_clean_me = db.c.execute("SELECT COUNT(*) FROM clean_me_full"
+                                  ).fetchone()[0]
+        db.close()
+
+    print("{0} orgs, then {1:.0%} changed and {2:.0%} added "
+          "({3} and {4} organizations):".format(args.orgs, args.changed,
+                                                args.added, len(changed),
+                                                len(added)))
+    for run, result in results.items():
+        print("  {0:<6} {1:>6} requests {2:>8.1f} MB {3:>7.2f}s  "
+              "new {4[new]}, changed {4[changed]}, fetched {4[fetched]}"
+              .format(run, result["requests"], result["bytes"] / 1024 ** 2,
+                      result["wall"], result["counts"]))
+    print("  delta / full requests: {0:.1%}".format(
+        results["delta"]["requests"] / results["full"]["requests"]))
+
+    counts = results["delta"]["counts"]
+    up_to_date = all(stored[uia_id] == (org.city, org.type_ii[0] or None)
+                     for uia_id, org in corpus.orgs.items())
+    print("  found every change: {0}, listings up to date: {1}, "
+          "clean_me_full rows: {2}/{3}"
+          .format(counts["changed"] == len(changed) and
+                  counts["new"] == len(added),
+                  up_to_date, n_clean_me, len(corpus.orgs)))
+
+
+def bench_throttle(args):
+    """Fixed pacing versus the adaptive throttle against a loaded server.
+
+    Every organization page is fetched through scrape_yio.fetch, from
+    map_ordered threads as pipeline.py does. "fixed" is the old pacing: one
+    request at a time, --fixed-interval apart. "adaptive" starts there and
+    may go up to --concurrency at once. Two servers: "capacity" slows down
+    past --capacity requests in flight and answers 503 past twice that,
+    "rate-limited" also answers 429 past --rate-limit requests a second.
+    """
+    import scrape_yio
+
+    corpus = SyntheticYIO(n_orgs=args.orgs, per_page=args.per_page,
+                          seed=args.seed)
+    pacers = {
+        "fixed": lambda: throttle.Throttle(
+            interval=args.fixed_interval, min_interval=args.fixed_interval,
+            max_interval=args.fixed_interval, max_concurrency=1, step=0),
+        "adaptive": lambda: throttle.Throttle(
+            interval=args.fixed_interval, min_interval=0, max_interval=2,
+            max_concurrency=args.concurrency, step=args.fixed_interval / 10),
+    }
+    servers = {"capacity": {"capacity": args.capacity},
+               "rate-limited": {"capacity": args.capacity,
+                                "rate_limit": args.rate_limit}}
+
+    print("{0} organization pages, {1}ms base latency, capacity {2}, rate "
+          "limit {3}/s:".format(args.orgs, args.latency * 1000, args.capacity,
+                                args.rate_limit))
+    print("  {0:<13} {1:<9} {2:>7} {3:>7} {4:>5} {5:>5} {6:>5} {7:>7} "
+          "{8:>7} {9:>8}  {10}".format("server", "pacing", "wall s", "pages/s",
+                                       "ok", "429", "503", "p50 ms", "p90 ms",
+                                       "backoffs", "settled at"))
+
+    for server_name, load in servers.items():
+        for pacer_name, make_pacer in pacers.items():
+            metrics.reset()
+            pacer = make_pacer()
+            session = requests.session()
+
+            with MockServer(corpus, latency=args.latency, **load) as server:
+                urls = ["{0}/s/or/en/{1}".format(server.url, uia_id)
+                        for uia_id in corpus.orgs]
+
+                def fetch(url):
+                    # Pages that never got through count as not ok
+                    try:
+                        return scrape_yio.fetch(session, url, pacer)
+                    except scrape_yio.FetchError:
+                        return ""
+
+                start = time.perf_counter()
+                pages = list(throttle.map_ordered(
+                    fetch, urls, workers=pacer.max_concurrency))
+                wall = time.perf_counter() - start
+
+            latency = metrics.summary()["histograms"]["http.latency"]
+            print("  {0:<13} {1:<9} {2:>7.2f} {3:>7.1f} {4:>5} {5:>5} {6:>5} "
+                  "{7:>7.1f} {8:>7.1f} {9:>8}  {10} at a time, {11:.3f}s apart"
+                  .format(server_name, pacer_name, wall, len(urls) / wall,
+                          sum('id="content"' in page for page in pages),
+                          server.statuses[429], server.statuses[503],
+                          latency["p50"] * 1000, latency["p90"] * 1000,
+                          metrics.summary()["counters"].get("throttle.backoffs",
+                                                            0),
+                          int(pacer.concurrency), pacer.interval))
+
+
+def bench_page_store(args):
+    """parse_manual_orgs from whole pages in data_raw versus the page store.
+
+    Seeds data_raw as get_raw_html used to fill it, with --repeat of the
+    organizations captured twice, moves it into the page store and parses
+    again. Reports storage, parse time and whether organizations_raw came
+    out the same.
+    """
+    import page_store
+    import scrape_yio
+
+    corpus = SyntheticYIO(n_orgs=args.orgs, per_page=args.per_page,
+                          seed=args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DB_FILE = os.path.join(tmp, "yio.db")
+        config.METRICS_DIR = tmp
+        seed_database(corpus)
+
+        db = DB()
+        db.c.execute("""INSERT INTO data_raw (fk_org, org_html)
+                        SELECT fk_org, org_html FROM data_raw
+                        WHERE fk_org % ? = 0""", (round(1 / args.repeat),))
+        db.conn.commit()
+        data_raw_bytes, n_captures = db.c.execute(
+            """SELECT SUM(length(CAST(org_html AS blob))), COUNT(*)
+               FROM data_raw""").fetchone()
+        db.close()
+
+        for mode in ["data_raw", "page_store"]:
+            db = DB()
+            if mode == "page_store":
+                page_store.prepare_db(db)
+                start = time.perf_counter()
+                stored, skipped = page_store.migrate(db, delete=True)
+                migrate_time = time.perf_counter() - start
+                stats = page_store.report(db)
+
+                db.c.execute("DELETE FROM organizations_raw")
+                db.conn.commit()
+            db.close()
+
+            start = time.perf_counter()
+            scrape_yio.parse_manual_orgs()
+            wall = time.perf_counter() - start
+
+            db = DB()
+            rows = sorted(db.c.execute("SELECT * FROM organizations_raw"))
+            db.close()
+            results[mode] = {"wall": wall, "rows": rows}
+
+    mb = 1024 ** 2
+    print("{0} organizations, {1} captures in data_raw ({2:.2f} MB)"
+          .format(args.orgs, n_captures, data_raw_bytes / mb))
+    print("  page store: {0} stored, {1} unchanged captures skipped, "
+          "{2} distinct chromes, {3:.2f}s to migrate"
+          .format(stored, skipped, stats["chromes"], migrate_time))
+    print("  stored {0:.2f} MB ({1:.1%} less than data_raw), parse input "
+          "{2:.2f} MB".format(stats["stored_bytes"] / mb,
+                              1 - stats["stored_bytes"] / data_raw_bytes,
+                              stats["content_bytes"] / mb))
+    for mode, result in results.items():
+        print("  parse_manual_orgs from {0:<11} {1:>7.2f}s  {2} rows"
+              .format(mode, result["wall"], len(result["rows"])))
+    print("  same organizations_raw: {0}".format(
+        results["data_raw"]["rows"] == results["page_store"]["rows"]))
+
+
+def compare(result, history):
+    """Log the change in stage throughput against the last comparable run"""
+    previous = [run for run in history
+                if run["params"] == result["params"]]
+    if not previous:
+        return
+
+    last = previous[-1]
+    for stage in STAGES:
+        before = last["stages"][stage]["seconds"]
+        after = result["stages"][stage]["seconds"]
+        if before:
+            print("  {0:<13} {1:>+7.1%} vs {2} ({3})"
+                  .format(stage, (after - before) / before,
+                          last["revision"], last["timestamp"]))
+
+
+def main(args):
+    corpus = SyntheticYIO(n_orgs=args.orgs, per_page=args.per_page,
+                          seed=args.seed)
+    timer = StageTimer()
+    metrics.reset()
+
+    # Set before clean_raw_orgs is imported, since the caches are sized then
+    if args.no_clean_cache:
+        config.CLEAN_CACHE_SIZE = 0
+    import clean_raw_orgs
+
+    with tempfile.TemporaryDirectory() as tmp, MockServer(corpus) as server:
+        config.DB_FILE = os.path.join(tmp, "yio.db")
+        config.BASE_URL = server.url
+        unthrottled()
+
+        start = time.perf_counter()
+        n_scraped, n_final = run_pipeline(corpus, timer)
+        wall = time.perf_counter() - start
+
+        db_size = os.path.getsize(config.DB_FILE)
+
+    result = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "params": {"orgs": args.orgs, "per_page": args.per_page,
+                   "seed": args.seed, "clean_cache": not args.no_clean_cache},
+        "wall_seconds": round(wall, 3),
+        "orgs_scraped": n_scraped,
+        "orgs_final": n_final,
+        "orgs_per_second": round(n_final / wall, 2),
+        "bytes_fetched": timer.bytes_fetched,
+        "db_bytes": db_size,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": timer.summary(),
+        "metrics": metrics.summary(),
+        "clean_cache": clean_raw_orgs.cache_stats(),
+    }
+
+    if os.path.isfile(args.history):
+        with open(args.history, "r") as f:
+            history = json.load(f)
+    else:
+        history = []
+
+    print("{0} orgs in {1}s ({2} orgs/s), peak RSS {3} MB"
+          .format(n_final, result["wall_seconds"], result["orgs_per_second"],
+                  result["peak_rss_mb"]))
+    for stage, stats in result["stages"].items():
+        print("  {0:<13} {1[seconds]:>9.3f}s  {1[items]:>6} items  "
+              "p50 {1[p50_ms]}ms  p90 {1[p90_ms]}ms  p99 {1[p99_ms]}ms"
+              .format(stage, stats))
+    compare(result, history)
+
+    history.append(result)
+    with open(args.history, "w") as f:
+        json.dump(history, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the YIO pipeline "
+                                     "against a synthetic corpus.")
+    parser.add_argument("--orgs", type=int, default=200,
+                        help="number of synthetic organizations")
+    parser.add_argument("--per-page", type=int, default=20,
+                        help="organizations per listing page")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--history", default="bench_history.json",
+                        help="JSON file to append results to")
+    parser.add_argument("--log-level", default="WARNING",
+                        help="root log level while benchmarking")
+    parser.add_argument("--no-clean-cache", action="store_true",
+                        help="turn off memoization of the cleaning functions")
+    parser.add_argument("--logging", action="store_true",
+                        help="compare logging modes on parse_manual_orgs instead")
+    parser.add_argument("--streaming", action="store_true",
+                        help="compare the batch scripts with pipeline.py instead")
+    parser.add_argument("--delta", action="store_true",
+                        help="compare a full crawl with a delta crawl instead")
+    parser.add_argument("--changed", type=float, default=0.05,
+                        help="fraction of organizations changed for --delta")
+    parser.add_argument("--added", type=float, default=0.02,
+                        help="fraction of organizations added for --delta")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure import time of each entry point instead")
+    parser.add_argument("--page-store", action="store_true",
+                        help="compare parsing from data_raw and from the "
+                        "page store instead")
+    parser.add_argument("--repeat", type=float, default=0.1,
+                        help="fraction of organizations captured twice for "
+                        "--page-store")
+    parser.add_argument("--throttle", action="store_true",
+                        help="compare fixed and adaptive request pacing "
+                        "against a loaded mock server instead")
+    parser.add_argument("--fixed-interval", type=float, default=0.05,
+                        help="seconds between requests for --throttle's "
+                        "fixed pacing (and where adaptive starts)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="most requests at once for --throttle's "
+                        "adaptive pacing")
+    parser.add_argument("--capacity", type=int, default=4,
+                        help="requests the mock server handles at once "
+                        "before slowing down, for --throttle")
+    parser.add_argument("--rate-limit", type=int, default=40,
+                        help="requests a second before the mock server "
+                        "answers 429, for --throttle")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds the mock server waits before each "
+                        "response in --streaming, --delta and --throttle")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    logging.getLogger().setLevel(args.log_level)
+    if args.logging:
+        bench_logging(args)
+    elif args.streaming:
+        bench_streaming(args)
+    elif args.startup:
+        bench_startup(args)
+    elif args.delta:
+        bench_delta(args)
+    elif args.throttle:
+        bench_throttle(args)
+    elif args.page_store:
+        bench_page_store(args)
+    else:
+        main(args)
@@ -1,21 +1,26 @@
 #!/usr/bin/env python3
 
 import config
+import metrics
+import search
 from yio import DB
 
+import functools
+import hashlib
 import logging
 import re
 import os
-import webbrowser
-import cgi
-from pprint import pprint
+import time
+from html import escape, unescape
 from bs4 import BeautifulSoup
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, deque
 
 # Start log
 logger = logging.getLogger(__name__)
 
 def show(html):
+    import webbrowser
+
     if not html:
         return
 
@@ -56,10 +61,41 @@ def show(html):
     url = 'file://' + path
 
     with open(path, 'w') as f:
-        f.write(template.format(html, cgi.escape(html)))
+        f.write(template.format(html, escape(html)))
     webbrowser.open(url)
 
-def strip_tags(html, whitelist=['a', 'i', 'b', 'em', 'strong'], remove_search_link=False):
+# Cleaning functions wrapped with memoize_cell, for cache_stats()
+memoized = []
+
+def memoize_cell(function):
+    """Cache a pure cleaning function on its arguments.
+
+    Many cells (classifications, subject blocks, news dates, boilerplate
+    paragraphs) repeat verbatim across organizations, so each cleaned value
+    is kept in an LRU cache of config.CLEAN_CACHE_SIZE entries keyed by the
+    cell text (dict lookups use the string's hash, which Python computes once
+    per string). Every process has its own cache, so this is safe to use
+    from a multiprocessing pool. Arguments must be hashable and results must
+    not be mutated.
+    """
+    cached = functools.lru_cache(
+        maxsize=getattr(config, "CLEAN_CACHE_SIZE", 4096))(function)
+    memoized.append(cached)
+    return cached
+
+def cache_stats():
+    """Hits, misses and hit rate of each memoized cleaning function"""
+    stats = {}
+    for function in memoized:
+        info = function.cache_info()
+        total = info.hits + info.misses
+        stats[function.__name__] = {
+            'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+            'hit_rate': round(info.hits / total, 3) if total else None}
+    return stats
+
+@memoize_cell
+def strip_tags(html, whitelist=('a', 'i', 'b', 'em', 'strong'), remove_search_link=False):
     """Strip all HTML tags except for a list of whitelisted tags."""
     # Adapted from http://stackoverflow.com/a/16144379/120898
     if not html:
@@ -70,7 +106,8 @@ def strip_tags(html, whitelist=['a', 'i', 'b', 'em', 'strong'], remove_search_li
 
     if len(soup) == 0:
         # There's probably malformed HTML, like </p></p></p></div> in the lists
-        logger.info("Trying to fix malformed HTML")
+        logger.info("Trying to fix malformed HTML",
+                    extra={"aggregate": "Tried to fix malformed HTML {0} times."})
         html = html.replace('</p>', '').replace('</div>', '')
         soup = BeautifulSoup(html)
 
@@ -91,6 +128,7 @@ def strip_tags(html, whitelist=['a', 'i', 'b', 'em', 'strong'], remove_search_li
 
     return str(soup).strip().replace('\xa0', ' ')
 
+@memoize_cell
 def clean_news(cell):
     if not cell:
         return
@@ -114,12 +152,16 @@ def clean_events(cell):
     else:
         return events
 
+@memoize_cell
 def clean_type(cell):
     if not cell:
         return
     org_type = strip_tags(cell).split(':')
     return org_type[0]
 
+Contact = namedtuple('Contact', ['contact', 'telephone', 'fax', 'email'])
+Details = namedtuple('Details', ['contacts', 'url'])
+
 def clean_contact(text):
     # Each field is formatted like this:
     #
@@ -144,14 +186,11 @@ def clean_contact(text):
 
     details = defaultdict(list)
 
-    Contact = namedtuple('Contact', ['contact', 'telephone', 'fax', 'email'])
-    Details = namedtuple('Details', ['contacts', 'url'])
-
     contacts = []
     urls = []
 
     for section in text.split('\n'):
-        lines = [strip_tags(line, whitelist=[])
+        lines = [strip_tags(line, whitelist=())
                  for line in section.split('<br/>')]
         lines = list(filter(None, lines))
 
@@ -195,6 +234,122 @@ def clean_contact(text):
 
     return Details(contacts, url)
 
+def normalize_contact(contact):
+    """Collapse whitespace in every field and lowercase the email so the same
+    secretariat written slightly differently hashes the same"""
+    fields = []
+    for field in contact:
+        if field:
+            field = '\n'.join(re.sub(r'\s+', ' ', line).strip()
+                              for line in field.split('\n'))
+        fields.append(field or None)
+
+    normalized = contact._make(fields)
+    if normalized.email:
+        normalized = normalized._replace(email=normalized.email.lower())
+    return normalized
+
+def contact_hash(contact):
+    """Content hash of a normalized contact, used as its unique key"""
+    key = '\x1f'.join(field or '' for field in contact)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def dedupe_contacts(db):
+    # Databases cleaned before contacts were keyed by hash have one contacts
+    # row per organization per run. Hash them, point orgs_contacts at one
+    # copy of each, delete the rest and add the unique index.
+    has_index = db.c.execute("""SELECT 1 FROM sqlite_master
+                             WHERE name = 'contact_hash_index'""").fetchone()
+    if has_index:
+        return
+
+    logger.info("Deduplicating contacts")
+
+    colnames = [col[1] for col in
+                db.c.execute("PRAGMA table_info(contacts);").fetchall()]
+    if 'contact_hash' not in colnames:
+        db.c.execute("ALTER TABLE contacts ADD COLUMN contact_hash text")
+
+    size_sql = """SELECT COUNT(*),
+                  SUM(IFNULL(LENGTH(contact_details), 0) +
+                      IFNULL(LENGTH(contact_phone), 0) +
+                      IFNULL(LENGTH(contact_fax), 0) +
+                      IFNULL(LENGTH(contact_email), 0))
+                  FROM contacts"""
+    rows_before, bytes_before = db.c.execute(size_sql).fetchone()
+
+    rows = db.c.execute("""SELECT id_contact, contact_details, contact_phone,
+                        contact_fax, contact_email
+                        FROM contacts ORDER BY id_contact""").fetchall()
+
+    keepers = {}
+    for row in rows:
+        contact = normalize_contact(Contact(*row[1:]))
+        key = contact_hash(contact)
+
+        if key not in keepers:
+            keepers[key] = row[0]
+            db.c.execute("""UPDATE contacts SET contact_hash = ?,
+                         contact_details = ?, contact_phone = ?,
+                         contact_fax = ?, contact_email = ?
+                         WHERE id_contact = ?""",
+                         (key,) + tuple(contact) + (row[0],))
+        else:
+            # Move the links over (skipping ones that already exist) and
+            # drop the duplicate
+            db.c.execute("""UPDATE OR IGNORE orgs_contacts SET fk_contact = ?
+                         WHERE fk_contact = ?""", (keepers[key], row[0]))
+            db.c.execute("DELETE FROM orgs_contacts WHERE fk_contact = ?",
+                         (row[0],))
+            db.c.execute("DELETE FROM contacts WHERE id_contact = ?",
+                         (row[0],))
+
+    db.c.execute("""CREATE UNIQUE INDEX contact_hash_index
+                 ON contacts (contact_hash)""")
+    db.conn.commit()
+
+    rows_after, bytes_after = db.c.execute(size_sql).fetchone()
+    logger.info("Contacts: {0} rows ({1} bytes) -> {2} rows ({3} bytes)"
+                .format(rows_before, bytes_before or 0,
+                        rows_after, bytes_after or 0))
+
+Link = namedtuple('Link', ['text', 'url'])
+ListItem = namedtuple('ListItem', ['heading', 'subheading', 'name', 'url', 'note'])
+ListCell = namedtuple('ListCell', ['items', 'text', 'summary', 'countries',
+                                   'continents'])
+
+# One pass over a cell: links (with their href), other tags, and text
+html_tokens = re.compile(r'<a\b([^>]*)>(.*?)</a\s*>|<(/?)(\w+)[^>]*>|([^<]+)',
+                         re.S | re.I)
+href_attr = re.compile(r'href\s*=\s*["\']([^"\']*)["\']', re.I)
+any_tag = re.compile(r'<[^>]+>')
+block_tags = {'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'td', 'h1', 'h2', 'h3'}
+
+# Punctuation that structures a list: bullets, item separators, headings,
+# sentence ends (a '.' followed by a space or the end, so 1.5 survives) and
+# parentheses, inside which none of the others count
+list_punctuation = re.compile(r'(•|[,;:()]|\.(?=\s|$))')
+# "Members in 2 countries on 2 continents", "Individuals in 40 countries"
+members_summary = re.compile(r'\bin (\d+) countr\w*(?:\D*?(\d+) continent)?')
+list_count = re.compile(r'\s*\(\d+\)\s*')
+
+def tokenize_html(html):
+    """Yield ('link', text, url), ('block', None, None) and
+    ('text', text, None) tokens from an HTML fragment, without building a
+    soup"""
+    for match in html_tokens.finditer(html):
+        attrs, link_html, _, tag, text = match.groups()
+        if link_html is not None:
+            url = href_attr.search(attrs)
+            yield ('link', unescape(any_tag.sub('', link_html)),
+                   url.group(1) if url else None)
+        elif tag is not None:
+            if tag.lower() in block_tags:
+                yield ('block', None, None)
+        elif text:
+            yield ('text', unescape(text), None)
+
+@memoize_cell
 def clean_list(text):
     # Each field is formatted like this:
     #
@@ -209,79 +364,118 @@ def clean_list(text):
     #
     #   Members in 2 countries on 2 continents.
     #
-
+    # or, for members by country, with bulleted subheadings:
+    #
+    #   Full members in 5 countries:
+    #   • Africa: <a>Kenya</a>, <a>Nigeria</a>.
+    #   • Europe: <a>France</a>, <a>Norway</a>, <a>UK</a>.
+    #
+    # Languages are just "English, French, Spanish." and relations are
+    # "Member of: <a>X</a>; <a>Y</a> (note)."
+    #
+    # This walks the cell's tokens once. Text before a ':' is a heading (or
+    # a subheading if it follows a bullet), ',', ';' and sentence-ending '.'
+    # close an item, and links are kept whole, so periods in organization
+    # names don't split them. None of that applies inside parentheses, so
+    # "ECOSOC (Ros C, 1998)" stays one item with the note "(Ros C, 1998)".
+    # Unlinked sentences like "Members in 2 countries on 2 continents." or
+    # "Individuals in 40 countries." are summaries, not items; they go to
+    # the summary text and the country and continent counts (the largest,
+    # if there are several). Returns a ListCell with the items, the summary
+    # and a plain-text version of the cell for organizations_final.
     if not text:
         return
 
-    # Divide into sentences.
-    # Sentences that end in : indicate a list header
-    # Lists can be nested (like continents)
-    # Continent lists are comma separated
-    # Non-continent lists can be ; or , delimited, meaning the whole list is really a sentence
-    # Essentially every list is a complete sentence; some are just nested
-    list_parts = []
-    insert_subheading = False
-
-    Line = namedtuple('Line', ['contents', 'line_type'])
-    CountrySummary = namedtuple('CountrySummary', ['countries', 'continents'])
-
-    subheading = re.compile(r'• .*: ')
-    heading = re.compile(r'(.+?:)')
-
-    for sen in [strip_tags(sen) for sen in text.split('.')]:
-        # Check for subheadings first, since they look like headings but don't
-        # save them to list_parts until after saving any headings
-        check_subheading = subheading.search(sen)
-        if check_subheading:
-            insert_subheading = True
-            clean_subheading = (re.sub(':|•', '', check_subheading.group(0))
-                                .strip())
-            subheading_temp = Line(clean_subheading, 'subheading')
-            sen = subheading.sub('', sen)
-
-        # Extract headings
-        check_heading = heading.match(sen)
-        if check_heading:
-            clean_heading = (re.sub(r'\(\d+\)', '', check_heading.group(0))
-                             .replace(':', '').strip())
-            list_parts.append(Line(clean_heading, 'heading'))
-
-            sen = heading.sub('', sen)  # Remove heading from sentence
-
-        # Insert subheading if there is one
-        if insert_subheading:
-            list_parts.append(subheading_temp)
-
-            list_elements = sen.split(',')
-            for part in list_elements:
-                list_parts.append(extract_links(part))
-                # TODO: What if there is no link?
-            insert_subheading = False
-        else:
-            if sen.startswith('Members in'):
-                numbers = re.findall(r'\d+', sen)
-                countries = numbers[0]
-                continents = numbers[1] if len(numbers) > 1 else 0
-                list_parts.append(CountrySummary(countries, continents))
+    items = []
+    summaries = []
+    lines = ['']
+    heading = subheading = None
+    bullet = False
+    depth = 0
+    countries = continents = None
+
+    # The item being built: raw text and the link, if there is one
+    parts = []
+    link = None
+
+    def flush():
+        nonlocal parts, link, depth, countries, continents
+        words = ' '.join(''.join(parts).split())
+
+        if link:
+            items.append(ListItem(heading, subheading, link.text.strip(),
+                                  link.url, words or None))
+        elif words:
+            summary = members_summary.search(words)
+            if summary:
+                summaries.append(words + '.')
+                countries = max(countries or 0, int(summary.group(1)))
+                if summary.group(2):
+                    continents = max(continents or 0, int(summary.group(2)))
             else:
-                list_parts.append(Line(sen, 'line'))
-            # TODO: Make sure this really works for all situations
-
-    pprint(list_parts)
+                items.append(ListItem(heading, subheading, words, None, None))
+
+        parts = []
+        link = None
+        depth = 0
+
+    for kind, value, url in tokenize_html(text):
+        if kind == 'block':
+            flush()
+            bullet = False
+            lines.append('')
+            continue
+
+        lines[-1] += value
+
+        if kind == 'link':
+            if depth:
+                # A link inside another item's note, e.g. "(see <a>X</a>)"
+                parts.append(value)
+                continue
+            if link:
+                flush()
+            link = Link(value, url)
+            continue
+
+        for piece in list_punctuation.split(value):
+            if piece == '•':
+                flush()
+                bullet = True
+            elif piece == '(':
+                depth += 1
+                parts.append(piece)
+            elif piece == ')':
+                depth = max(depth - 1, 0)
+                parts.append(piece)
+            elif depth:
+                parts.append(piece)
+            elif piece == ':':
+                label = ' '.join(list_count.sub(' ', ''.join(parts)).split())
+                if bullet:
+                    subheading = label
+                else:
+                    heading, subheading = label, None
+                parts = []
+                link = None
+                bullet = False
+            elif piece in (',', ';', '.'):
+                flush()
+            else:
+                parts.append(piece)
+    flush()
 
-def parse_list_line(text):
-    pass
+    plain = '\n'.join(' '.join(line.split()) for line in lines if line.strip())
+    return ListCell(tuple(items), plain or None, ' '.join(summaries) or None,
+                    countries, continents)
 
 def extract_links(html):
-    Link = namedtuple('Link', ['text', 'url'])
-    links = []
+    return [Link(value, url) for kind, value, url in tokenize_html(html)
+            if kind == 'link']
 
-    soup = BeautifulSoup(html)
-    for link in soup.find_all('a'):
-        links.append(Link(link.get_text(), link.get('href')))
-
-    return links
+Subject = namedtuple('Subject', ['level_2', 'level_1'])
 
+@memoize_cell
 def clean_subject(cell):
     # <ul>
     #     <li>Level 1a</li>
@@ -300,7 +494,6 @@ def clean_subject(cell):
     soup = BeautifulSoup(cell)
     ul = soup.select('ul')
 
-    Subject = namedtuple('Subject', ['level_2', 'level_1'])
     subjects = []
 
     level_1 = ''
@@ -310,99 +503,231 @@ def clean_subject(cell):
         else:
             level_1 = li.get_text()
 
-    return subjects
+    # Tuple, since the cached value is shared by every organization with
+    # the same subjects
+    return tuple(subjects)
+
+
+CleanOrg = namedtuple("CleanOrg", ['id_org', 'org_name', 'acronym',
+                                   'org_url', 'founded', 'city_hq', 'country_hq',
+                                   'type_i_dir', 'type_ii_dir',
+                                   'type_iii_dir', 'type_i', 'type_ii',
+                                   'uia_id', 'url_id', 'subject_dir',
+                                   'history', 'aims', 'events', 'activities',
+                                   'structure', 'staff', 'financing',
+                                   'languages', 'consultative_status',
+                                   'relations_igos', 'relations_ngos',
+                                   'publications', 'information_services',
+                                   'members', 'last_news'])
+
+
+OrgLists = namedtuple("OrgLists", ['members', 'relations_igos',
+                                   'relations_ngos', 'consultative_status',
+                                   'languages'])
+
+# Tables clean_org_to_db writes the structured lists to
+LIST_TABLES = ['orgs_members', 'orgs_members_summary', 'orgs_relations',
+               'languages', 'orgs_languages']
 
+# Page sections clean_row reads, in clean_me_full's order; the rest of a
+# clean_me_full row comes from organizations
+RAW_SECTIONS = ['type_i_classification', 'contact_details', 'members',
+                'last_news_received', 'events', 'structure', 'history',
+                'activities', 'financing',
+                'relations_with_inter_governmental_organizations',
+                'consultative_status', 'aims', 'publications',
+                'relations_with_non_governmental_organizations', 'staff',
+                'subjects', 'type_ii_classification', 'languages',
+                'information_services']
 
-def clean_rows():
+
+def prepare_db(db):
+    """Bring an existing database up to date before writing clean rows"""
+    search.ensure_index(db)
+    dedupe_contacts(db)
+    db.ensure_tables(LIST_TABLES)
+
+
+def clean_rows(limit=None, workers=None):
     # All the rows to parse (organizations collected with `requests` and
-    # manually) are in the view `clean_me`, created with this command:
-    #
-    # CREATE VIEW clean_me_full AS
-    #   SELECT * FROM (
-    #     SELECT * FROM organizations_raw_requests
-    #     UNION ALL
-    #     SELECT fk_org, org_name, type_i_classification, contact_details, members,
-    #       last_news_received, events, structure, history, activities, financing,
-    #       relations_with_inter_governmental_organizations, consultative_status,
-    #       aims, publications, relations_with_non_governmental_organizations,
-    #       staff, subjects, type_ii_classification, languages, information_services
-    #     FROM organizations_raw) temp_table
-    #   INNER JOIN organizations ON temp_table.fk_org = organizations.id_org
-    #
-    # The column names for the second table have to be specified manually,
-    # or else the two tables won't be stacked properly
+    # manually) are in the clean_me_full table, which DB.insert_dict fills
+    # as raw rows are written to organizations_raw_requests or
+    # organizations_raw. It used to be a hand-made view (a UNION ALL of the
+    # two raw tables joined to organizations); DB() converts old databases.
+
+    # Rows are cleaned in shards of consecutive id_org. With more than one
+    # worker, each shard's raw cells go to a process pool and the cleaned
+    # records come back, in order, to this process, which does all the
+    # writing. Shards are written in id order either way, so the output
+    # (including contact IDs) is the same as a serial run.
+    workers = workers or getattr(config, "CLEAN_WORKERS", 1)
 
-    # Get existing column names and create named tuple row factory
     db = DB()
+    prepare_db(db)
+
+    # Get existing column names for the worker's named tuple
     colnames_raw = db.c.execute("PRAGMA table_info(clean_me_full);").fetchall()
     colnames = [col[1] for col in colnames_raw]
-    OrgRawRow = namedtuple("OrgRawRow", colnames)
-    db.add_factory(factory=OrgRawRow)
 
-    results = db.c.execute("SELECT * FROM clean_me_full")
+    shards = read_shards(db, limit)
+
+    pool = None
+    if workers > 1:
+        import multiprocessing
+
+        logger.info("Cleaning with {0} worker processes".format(workers))
+        pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                    initargs=(colnames, True))
+        batches = ordered_map(pool, clean_shard, shards, workers * 2)
+    else:
+        init_worker(colnames)
+        batches = map(clean_shard, shards)
+
+    # Contact hash -> id_contact, so shared secretariats are looked up once
+    contact_ids = {}
+
+    try:
+        for batch, seconds in batches:
+            metrics.observe("clean.shard", seconds)
+
+            for record in batch:
+                logger.info("{0.id_org}: {0.org_name}".format(record[0]),
+                            extra={"aggregate": "Cleaned {0} organizations."})
+
+                with metrics.timer("clean.write"):
+                    clean_org_to_db(*record, db=db, contact_cache=contact_ids)
+    finally:
+        # Once every batch is back the workers are idle, so this only cuts
+        # anything short if a worker or the writing raised
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    with metrics.timer("clean.write"):
+        db.conn.commit()
+    db.close()
+
+    # Worker caches live and die in the workers, so these only mean
+    # something for a serial run
+    if workers == 1:
+        for name, stats in cache_stats().items():
+            logger.info("{0} cache: {1[hits]} hits, {1[misses]} misses ({1[hit_rate]})"
+                        .format(name, stats))
+            metrics.incr("cache.{0}.hits".format(name), stats['hits'])
+            metrics.incr("cache.{0}.misses".format(name), stats['misses'])
+    metrics.dump("clean_rows")
+
+def read_shards(db, limit=None, shard_size=None):
+    """Yield lists of raw clean_me_full rows (plain tuples), shard_size
+    consecutive organizations at a time, in id_org order"""
+    shard_size = shard_size or getattr(config, "CLEAN_SHARD_SIZE", 200)
+
+    # LIMIT -1 means no limit in SQLite
+    ids = [row[0] for row in db.conn.execute(
+        "SELECT id_org FROM clean_me_full ORDER BY id_org LIMIT ?",
+        (limit or -1,))]
+
+    for i in range(0, len(ids), shard_size):
+        shard_ids = ids[i:i + shard_size]
+        yield db.conn.execute("""SELECT * FROM clean_me_full
+                              WHERE id_org BETWEEN ? AND ?
+                              ORDER BY id_org""",
+                              (shard_ids[0], shard_ids[-1])).fetchall()
+
+def ordered_map(pool, function, iterable, max_pending):
+    """Like pool.imap, but reads iterable in this thread (so it can use this
+    thread's SQLite connection) and keeps at most max_pending tasks queued"""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# Named tuple for raw rows in this process, set by init_worker
+OrgRawRow = None
+
+def init_worker(colnames, pool_worker=False):
+    global OrgRawRow
+    OrgRawRow = namedtuple("OrgRawRow", colnames)
 
-    rows = results.fetchall()
+    if pool_worker:
+        import logutil
+        logutil.reset_for_worker()
 
-    CleanOrg = namedtuple("CleanOrg", ['id_org', 'org_name', 'acronym',
-                                       'org_url', 'founded', 'city_hq', 'country_hq',
-                                       'type_i_dir', 'type_ii_dir',
-                                       'type_iii_dir', 'type_i', 'type_ii',
-                                       'uia_id', 'url_id', 'subject_dir',
-                                       'history', 'aims', 'events', 'activities',
-                                       'structure', 'staff', 'financing',
-                                       'languages', 'consultative_status',
-                                       'relations_igos', 'relations_ngos',
-                                       'publications', 'information_services',
-                                       'members', 'last_news'])
+def clean_shard(rows):
+    """Clean a shard of raw rows; returns ([(CleanOrg, subjects, contacts,
+    OrgLists)], seconds spent)"""
+    start = time.perf_counter()
+    cleaned = []
 
     # output = ''
     for row in rows:
-        logger.info("{0.fk_org}: {0.org_name}".format(row))
+        row = OrgRawRow(*row)
 
-        # logger.info(clean_list(row.members))  # TODO: Finish members
         # output += '<h2>{0}: {1}</h2>'.format(i, row.org_name)
         # output += str(row.contact_details)
         # output += '<pre><code>'+str(clean_contact(row.contact_details))+'</pre></code>'
         # output += '<hr>'
         # show(clean_list(row.members))
 
-        # TODO: members
-        # TODO: relations_with_inter_governmental_organizations
-        # TODO: relations_With_non_governmental_organization
-        # TODO: consultative_status
-        # TODO: languages
+        cleaned.append(clean_row(row))
+    # show(output)
+
+    return cleaned, time.perf_counter() - start
 
-        subjects = clean_subject(row.subjects)
-        contact_details = clean_contact(row.contact_details)
+def clean_row(row):
+    """Clean a single row of clean_me_full.
 
-        if contact_details:
-            org_url = contact_details.url
-            contacts = contact_details.contacts
-        else:
-            org_url = contacts = None
-
-        cleaned = CleanOrg(row.id_org, row.org_name_t, row.org_acronym_t,
-                           org_url, row.org_founded_t, row.org_city_hq_t,
-                           row.org_country_hq_t, row.org_type_i_t,
-                           row.org_type_ii_t, row.org_type_iii_t,
-                           clean_type(row.type_i_classification),
-                           clean_type(row.type_ii_classification),
-                           row.org_uia_id_t, row.org_url_id,
-                           row.org_subject_t,
-                           strip_tags(row.history), strip_tags(row.aims),
-                           clean_events(row.events), strip_tags(row.activities),
-                           clean_delim(row.structure), strip_tags(row.staff),
-                           strip_tags(row.financing), None,
-                           None, None,
-                           None, clean_delim(row.publications),
-                           strip_tags(row.information_services), None,
-                           clean_news(row.last_news_received))
-
-        clean_org_to_db(cleaned, subjects, contacts)
-    # show(output)
+    Returns a tuple of (CleanOrg, subjects, contacts, OrgLists) ready for
+    clean_org_to_db
+    """
+    lists = OrgLists(clean_list(row.members),
+                     clean_list(row.relations_with_inter_governmental_organizations),
+                     clean_list(row.relations_with_non_governmental_organizations),
+                     clean_list(row.consultative_status),
+                     clean_list(row.languages))
 
-def clean_org_to_db(clean, subjects, contacts):
-    db = DB()
+    def plain(cell):
+        return cell.text if cell else None
+
+    subjects = clean_subject(row.subjects)
+    contact_details = clean_contact(row.contact_details)
+
+    if contact_details:
+        org_url = contact_details.url
+        contacts = contact_details.contacts
+    else:
+        org_url = contacts = None
+
+    cleaned = CleanOrg(row.id_org, row.org_name_t, row.org_acronym_t,
+                       org_url, row.org_founded_t, row.org_city_hq_t,
+                       row.org_country_hq_t, row.org_type_i_t,
+                       row.org_type_ii_t, row.org_type_iii_t,
+                       clean_type(row.type_i_classification),
+                       clean_type(row.type_ii_classification),
+                       row.org_uia_id_t, row.org_url_id,
+                       row.org_subject_t,
+                       strip_tags(row.history), strip_tags(row.aims),
+                       clean_events(row.events), strip_tags(row.activities),
+                       clean_delim(row.structure), strip_tags(row.staff),
+                       strip_tags(row.financing), plain(lists.languages),
+                       plain(lists.consultative_status), plain(lists.relations_igos),
+                       plain(lists.relations_ngos), clean_delim(row.publications),
+                       strip_tags(row.information_services), plain(lists.members),
+                       clean_news(row.last_news_received))
+
+    return cleaned, subjects, contacts, lists
+
+def clean_org_to_db(clean, subjects, contacts, lists=None, db=None,
+                    contact_cache=None):
+    # Reuse the caller's connection if there is one; clean_rows commits once
+    # at the end instead of opening a new connection for every organization
+    if db is None:
+        db = DB()
+    if contact_cache is None:
+        contact_cache = {}
 
     # Insert organization
     db.c.execute("""INSERT OR IGNORE INTO organizations_final
@@ -410,6 +735,12 @@ def clean_org_to_db(clean, subjects, contacts):
                  .format(clean._fields, ', '.join('?' for _ in clean._fields)),
                  (clean))
 
+    if db.c.rowcount == 1:
+        metrics.incr("clean.rows_inserted")
+        search.index_org(db, clean)
+    else:
+        metrics.incr("clean.rows_skipped")
+
     # Insert subjects
     if subjects:
         # Insert subjects indivudally since there's no way to use executemany
@@ -433,15 +764,32 @@ def clean_org_to_db(clean, subjects, contacts):
 
     # Insert contacts
     if contacts:
-        # Insert contacts individually again, since executemany doesn't play
-        # well with auto-incrementing IDs
+        # Contacts are keyed by a hash of their normalized contents, so a
+        # secretariat shared by many organizations (or seen again on a re-run)
+        # resolves to the existing row, from the cache if possible
         contact_ids = []
         for contact in contacts:
-            db.c.execute("""INSERT INTO contacts
-                         (contact_details, contact_phone,
-                          contact_fax, contact_email)
-                         VALUES (?, ?, ?, ?)""", (contact))
-            contact_ids.append(db.c.lastrowid)
+            contact = normalize_contact(contact)
+            key = contact_hash(contact)
+
+            if key not in contact_cache:
+                db.c.execute("""INSERT OR IGNORE INTO contacts
+                             (contact_hash, contact_details, contact_phone,
+                              contact_fax, contact_email)
+                             VALUES (?, ?, ?, ?, ?)""", (key,) + tuple(contact))
+
+                if db.c.rowcount == 1:
+                    contact_cache[key] = db.c.lastrowid
+                    metrics.incr("clean.contacts_inserted")
+                else:
+                    db.c.execute("""SELECT id_contact FROM contacts
+                                 WHERE contact_hash = ?""", (key,))
+                    contact_cache[key] = db.c.fetchone()[0]
+                    metrics.incr("clean.contacts_reused")
+            else:
+                metrics.incr("clean.contacts_reused")
+
+            contact_ids.append(contact_cache[key])
 
         # Insert organization and contact IDs into the junction table
         db.c.executemany("""INSERT OR IGNORE INTO orgs_contacts
@@ -449,7 +797,60 @@ def clean_org_to_db(clean, subjects, contacts):
                          VALUES (?, ?)""",
                          ([(clean.id_org, con) for con in contact_ids]))
 
-    # db.conn.commit()
+    # Insert structured lists. These are replaced wholesale so re-running
+    # the cleaning doesn't duplicate them.
+    if lists:
+        for table in ['orgs_members', 'orgs_members_summary',
+                      'orgs_relations', 'orgs_languages']:
+            db.c.execute("DELETE FROM {0} WHERE fk_org = ?".format(table),
+                         (clean.id_org,))
+
+        if lists.members:
+            db.c.executemany("""INSERT INTO orgs_members
+                             (fk_org, member_heading, member_region,
+                              member_name, member_url)
+                             VALUES (?, ?, ?, ?, ?)""",
+                             ([(clean.id_org, item.heading, item.subheading,
+                                item.name, item.url)
+                               for item in lists.members.items]))
+
+        if lists.members and lists.members.summary:
+            db.c.execute("""INSERT INTO orgs_members_summary
+                         (fk_org, member_summary, member_countries,
+                          member_continents)
+                         VALUES (?, ?, ?, ?)""",
+                         (clean.id_org, lists.members.summary,
+                          lists.members.countries, lists.members.continents))
+
+        relations = [('igo', lists.relations_igos),
+                     ('ngo', lists.relations_ngos),
+                     ('consultative', lists.consultative_status)]
+        db.c.executemany("""INSERT INTO orgs_relations
+                         (fk_org, relation_type, relation_heading,
+                          related_name, related_url, relation_note)
+                         VALUES (?, ?, ?, ?, ?, ?)""",
+                         ([(clean.id_org, relation_type, item.heading,
+                            item.name, item.url, item.note)
+                           for relation_type, cell in relations if cell
+                           for item in cell.items]))
+
+        if lists.languages:
+            # Same dance as subjects to get the IDs of new and existing rows
+            language_ids = []
+            for item in lists.languages.items:
+                db.c.execute("""INSERT OR IGNORE INTO languages (language_name)
+                             VALUES (?)""", (item.name,))
+                db.c.execute("""SELECT id_language FROM languages
+                             WHERE language_name = ?""", (item.name,))
+                language_ids.append(db.c.fetchone()[0])
+
+            db.c.executemany("""INSERT OR IGNORE INTO orgs_languages
+                             (fk_org, fk_language)
+                             VALUES (?, ?)""",
+                             ([(clean.id_org, lang) for lang in language_ids]))
 
 if __name__ == '__main__':
+    import logutil
+    logutil.setup_logging()
+
     clean_rows()
@@ -0,0 +1,31 @@
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Tests run against config.py.dist when there's no local config.py
+try:
+    import config
+except ImportError:
+    loader = importlib.machinery.SourceFileLoader(
+        "config", os.path.join(HERE, "config.py.dist"))
+    spec = importlib.util.spec_from_loader("config", loader)
+    config = importlib.util.module_from_spec(spec)
+    loader.exec_module(config)
+    sys.modules["config"] = config
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A new DB in a temporary file (DB reads schema.sql from the cwd)"""
+    from yio import DB
+
+    monkeypatch.chdir(HERE)
+    monkeypatch.setattr(config, "DB_FILE", str(tmp_path / "yio.db"))
+    db = DB()
+    yield db
+    db.close()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Delta crawl: refresh the dataset without re-fetching every organization.
+#
+#   1. crawl_listings() walks the subject listing pages (one request per
+#      page of listings instead of one per organization), fingerprints each
+#      row from extract_from_row and compares it with listing_fingerprints:
+#        - new organizations are added to organizations
+#        - changed rows are upserted into organizations, updating the row in
+#          place (INSERT OR IGNORE used to throw the new values away)
+#      and both go into fetch_queue.
+#   2. fetch_queued() fetches only the queued detail pages and replaces
+#      their organizations_raw rows (and so their clean_me_full rows). For
+#      changed organizations it also drops the stale cleaned rows, so the
+#      next clean_rows run rebuilds them.
+#
+#   python delta_crawl.py                  # both steps
+#   python delta_crawl.py --listings-only  # just see what changed
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import metrics
+import clean_raw_orgs
+import scrape_yio
+import throttle
+from yio import YIO, DB
+
+# Full modules
+import argparse
+import hashlib
+import logging
+
+# Just parts of modules
+from collections import Counter
+from datetime import datetime
+
+# Start log
+logger = logging.getLogger(__name__)
+
+DELTA_TABLES = ["listing_fingerprints", "fetch_queue"]
+
+# Listing columns that make up the fingerprint. The subject is left out
+# since an organization can be listed under several, and the URL since the
+# proxy's host name is part of it.
+FINGERPRINT_COLUMNS = ['org_name_t', 'org_url_id', 'org_acronym_t',
+                       'org_founded_t', 'org_city_hq_t', 'org_country_hq_t',
+                       'org_type_i_t', 'org_type_ii_t', 'org_type_iii_t',
+                       'org_uia_id_t']
+
+# Cleaned rows that are rebuilt from a changed organization's new page
+CLEAN_TABLES = [('organizations_final', 'id_org'), ('organizations_fts', 'rowid'),
+                ('orgs_subjects', 'fk_org'), ('orgs_contacts', 'fk_org'),
+                ('orgs_members', 'fk_org'), ('orgs_members_summary', 'fk_org'),
+                ('orgs_relations', 'fk_org'), ('orgs_languages', 'fk_org')]
+
+
+def now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def fingerprint(org_details):
+    """Content hash of a listing row (a dict from extract_from_row, or the
+    same columns read back from organizations)"""
+    key = '\x1f'.join(org_details.get(col) or '' for col in FINGERPRINT_COLUMNS)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def known_listings(db):
+    """org_url_id -> (id_org, fingerprint) for every organization.
+
+    Organizations scraped before delta crawls existed are fingerprinted from
+    their stored listing rows first, so the first delta crawl doesn't treat
+    everything as changed.
+    """
+    missing = db.conn.execute("""SELECT id_org, {0} FROM organizations
+                                 LEFT JOIN listing_fingerprints
+                                   ON listing_fingerprints.fk_org = id_org
+                                 WHERE listing_fingerprints.fk_org IS NULL"""
+                              .format(", ".join(FINGERPRINT_COLUMNS))).fetchall()
+    if missing:
+        logger.info("Fingerprinting {0} existing listing rows"
+                    .format(len(missing)))
+        timestamp = now()
+        db.c.executemany("""INSERT INTO listing_fingerprints
+                            (fk_org, fingerprint, first_seen, last_seen,
+                             last_changed)
+                            VALUES (?, ?, ?, ?, ?)""",
+                         ([row[0],
+                           fingerprint(dict(zip(FINGERPRINT_COLUMNS, row[1:]))),
+                           timestamp, timestamp, timestamp]
+                          for row in missing))
+        db.conn.commit()
+
+    return {url_id: (id_org, print_)
+            for url_id, id_org, print_ in db.conn.execute(
+                """SELECT org_url_id, id_org, fingerprint FROM organizations
+                   INNER JOIN listing_fingerprints
+                     ON listing_fingerprints.fk_org = id_org""")}
+
+
+def crawl_listings(session, db, subjects=None):
+    """Walk the subject listings, queueing new and changed organizations.
+    Returns a Counter of new, changed and unchanged rows (and pages)."""
+    subjects = subjects or scrape_yio.SUBJECTS
+    known = known_listings(db)
+    counts = Counter()
+
+    for subject in subjects:
+        url = scrape_yio.subject_url(subject)
+
+        while url is not None:
+            logger.info("Checking organizations listed at {0}".format(url))
+            page = scrape_yio.fetch(session, url)
+            counts["pages"] += 1
+
+            with metrics.timer("parse.listing_page"):
+                rows, url = scrape_yio.parse_listing(page)
+
+            timestamp = now()
+            unchanged = []
+
+            for org_details in rows:
+                org_details['org_subject_t'] = subject
+                url_id = org_details['org_url_id']
+                new_print = fingerprint(org_details)
+
+                if url_id not in known:
+                    reason = "new"
+                    db.insert_dict(org_details, table="organizations")
+                    id_org = db.c.execute("""SELECT id_org FROM organizations
+                                             WHERE org_url_id = ?""",
+                                          (url_id,)).fetchone()[0]
+                elif known[url_id][1] != new_print:
+                    reason = "changed"
+                    id_org = known[url_id][0]
+                    db.upsert_dict(org_details, table="organizations",
+                                   key="org_url_id", keep=["org_subject_t"])
+                else:
+                    unchanged.append((timestamp, known[url_id][0]))
+                    continue
+
+                logger.info("{0}: {1} ({2})".format(reason.title(),
+                                                    org_details['org_name_t'],
+                                                    url_id))
+                counts[reason] += 1
+                metrics.incr("delta." + reason)
+                known[url_id] = (id_org, new_print)
+
+                db.c.execute("""INSERT INTO listing_fingerprints
+                                (fk_org, fingerprint, first_seen, last_seen,
+                                 last_changed)
+                                VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT (fk_org) DO UPDATE SET
+                                  fingerprint = excluded.fingerprint,
+                                  last_seen = excluded.last_seen,
+                                  last_changed = excluded.last_changed""",
+                             (id_org, new_print, timestamp, timestamp,
+                              timestamp))
+
+                # If it's already waiting, keep the first reason
+                db.c.execute("""INSERT OR IGNORE INTO fetch_queue
+                                (fk_org, reason, queued) VALUES (?, ?, ?)""",
+                             (id_org, reason, timestamp))
+
+            db.c.executemany("""UPDATE listing_fingerprints SET last_seen = ?
+                                WHERE fk_org = ?""", unchanged)
+            db.conn.commit()
+
+            counts["unchanged"] += len(unchanged)
+            metrics.incr("delta.unchanged", len(unchanged))
+
+    logger.info("Listings: {0[new]} new, {0[changed]} changed, "
+                "{0[unchanged]} unchanged organizations on {0[pages]} pages"
+                .format(counts))
+    return counts
+
+
+def forget_clean(db, id_org):
+    """Drop an organization's cleaned rows so clean_rows rebuilds them"""
+    for table, key in CLEAN_TABLES:
+        db.c.execute("DELETE FROM {0} WHERE {1} = ?".format(table, key),
+                     (id_org,))
+
+
+def fetch_queued(session, db, limit=None):
+    """Fetch the detail pages of queued organizations; returns how many were
+    fetched. Pages that can't be fetched or parsed stay in the queue."""
+    # Make sure the cleaned tables forget_clean() touches exist
+    clean_raw_orgs.prepare_db(db)
+
+    # LIMIT -1 means no limit in SQLite
+    queued = db.conn.execute("""SELECT fk_org, reason, org_url FROM fetch_queue
+                                INNER JOIN organizations
+                                  ON organizations.id_org = fetch_queue.fk_org
+                                ORDER BY fk_org LIMIT ?""",
+                             (limit or -1,)).fetchall()
+    logger.info("{0} organizations to fetch".format(len(queued)))
+
+    def fetch_page(org):
+        id_org, reason, url = org
+        logger.info("Getting {0} organization details from {1}"
+                    .format(reason, url))
+        try:
+            return org, scrape_yio.fetch(session, url)
+        except scrape_yio.FetchError as e:
+            logger.warning("{0}; leaving row {1} queued".format(e, id_org))
+            metrics.incr("orgs.failed")
+            return org, None
+
+    n_fetched = 0
+    for (id_org, reason, url), page in throttle.map_ordered(fetch_page, queued):
+        if page is None:
+            continue
+
+        try:
+            with metrics.timer("parse.org_page"):
+                sections = scrape_yio.split_sections(page)
+        except Exception as e:
+            logger.warning("{0} ({1}): row {2}".format(e.__class__.__name__, e,
+                                                       id_org))
+            metrics.incr("orgs.failed")
+            continue
+
+        sections['fk_org'] = id_org
+        db.add_raw_columns(sections.keys())
+
+        if reason == "changed":
+            forget_clean(db, id_org)
+
+        # Replace rather than ignore, so clean_me_full gets the new page
+        db.insert_dict(sections, table="organizations_raw", replace=True)
+        db.c.execute("DELETE FROM fetch_queue WHERE fk_org = ?", (id_org,))
+        db.conn.commit()
+
+        n_fetched += 1
+        metrics.incr("orgs.parsed")
+
+    return n_fetched
+
+
+def run(subjects=None, listings_only=False, limit=None, session=None, db=None):
+    """Crawl the listings and then (unless listings_only) fetch what changed.
+
+    session and db default to a logged-in YIO session and the configured
+    database. Returns a Counter of listing rows by status, plus fetched.
+    """
+    own_db = db is None
+    db = db or DB()
+    session = session or YIO().s
+    db.ensure_tables(DELTA_TABLES)
+
+    try:
+        with metrics.timer("delta.listings"):
+            counts = crawl_listings(session, db, subjects)
+
+        if not listings_only:
+            with metrics.timer("delta.fetch"):
+                counts["fetched"] = fetch_queued(session, db, limit)
+    finally:
+        if own_db:
+            db.close()
+
+    metrics.dump("delta_crawl")
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-crawl the subject "
+                                     "listings and fetch only new or changed "
+                                     "organizations.")
+    parser.add_argument("--subjects", nargs="+", choices=scrape_yio.SUBJECTS,
+                        help="default: all of them")
+    parser.add_argument("--listings-only", action="store_true",
+                        help="queue new and changed organizations but don't "
+                        "fetch them")
+    parser.add_argument("--limit", type=int,
+                        help="fetch at most this many queued organizations")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    run(subjects=args.subjects, listings_only=args.listings_only,
+        limit=args.limit)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Stream the final tables out of SQLite into compressed columnar files for
+# analysis, instead of collect()ing whole tables into R and filtering there.
+#
+# The type exclusions from export_lists.R (i.to.ignore, ii.to.ignore,
+# iii.to.ignore) are pushed down into the SQL, and the junction and lookup
+# tables are limited to organizations that survive them. Rows are read
+# config.EXPORT_CHUNK_SIZE at a time and written as they arrive, so memory
+# stays flat and export time grows linearly with the table size.
+#
+# Writes Parquet if pyarrow is installed, otherwise gzipped CSV:
+#
+#   python export_final.py             # filtered, like export_lists.R
+#   python export_final.py --all       # everything
+#   python export_final.py --snapshot  # read snapshot.py's copy instead
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import metrics
+from yio import DB
+
+# Full modules
+import argparse
+import csv
+import gzip
+import importlib.util
+import logging
+import os
+
+# Parquet output is optional. pyarrow takes longer to import than
+# everything else here put together, so it's only imported to write Parquet.
+HAVE_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+# Start log
+logger = logging.getLogger(__name__)
+
+# Same exclusions as export_lists.R
+TYPE_I_IGNORE = ["J", "H", "R", "S", "T", "U"]
+TYPE_II_IGNORE = ["c", "d", "e", "g", "s"]
+TYPE_III_IGNORE = ["Alumni and Veterans", "European Union Bodies", "FAO Bodies",
+                   "ILO Bodies", "NATO Bodies", "Parliaments",
+                   "Political Parties", "Treaties", "United Nations Bodies",
+                   "WHO Bodies", "Corporations, Companies",
+                   "Intergovernmental Communities"]
+
+# SQLite declared types -> Arrow types
+ARROW_TYPES = {"integer": "int64", "text": "string"}
+
+
+def org_filter():
+    """WHERE clause and parameters that drop ignored organization types.
+
+    Mirrors the R semantics: missing types are kept, and type II is a
+    (case-sensitive) substring match since organizations can have several
+    type II codes.
+    """
+    clauses = [
+        "(type_i_dir IS NULL OR type_i_dir NOT IN ({0}))"
+        .format(", ".join("?" for _ in TYPE_I_IGNORE)),
+        "(type_ii_dir IS NULL OR ({0}))"
+        .format(" AND ".join("instr(type_ii_dir, ?) = 0"
+                             for _ in TYPE_II_IGNORE)),
+        "(type_iii_dir IS NULL OR type_iii_dir NOT IN ({0}))"
+        .format(", ".join("?" for _ in TYPE_III_IGNORE)),
+    ]
+    params = TYPE_I_IGNORE + TYPE_II_IGNORE + TYPE_III_IGNORE
+    return " AND ".join(clauses), params
+
+
+def export_queries(filtered=True):
+    """(table, SQL, parameters) for each exported table"""
+    if filtered:
+        where, params = org_filter()
+    else:
+        where, params = "1", []
+
+    kept_orgs = "SELECT id_org FROM organizations_final WHERE " + where
+
+    return [
+        ("organizations_final",
+         "SELECT * FROM organizations_final WHERE " + where, params),
+        ("orgs_subjects",
+         "SELECT * FROM orgs_subjects WHERE fk_org IN ({0})".format(kept_orgs),
+         params),
+        ("subjects",
+         """SELECT * FROM subjects WHERE id_subject IN
+            (SELECT fk_subject FROM orgs_subjects WHERE fk_org IN ({0}))"""
+         .format(kept_orgs), params),
+        ("orgs_contacts",
+         "SELECT * FROM orgs_contacts WHERE fk_org IN ({0})".format(kept_orgs),
+         params),
+        ("contacts",
+         """SELECT * FROM contacts WHERE id_contact IN
+            (SELECT fk_contact FROM orgs_contacts WHERE fk_org IN ({0}))"""
+         .format(kept_orgs), params),
+        ("orgs_members",
+         "SELECT * FROM orgs_members WHERE fk_org IN ({0})".format(kept_orgs),
+         params),
+        ("orgs_members_summary",
+         "SELECT * FROM orgs_members_summary WHERE fk_org IN ({0})"
+         .format(kept_orgs), params),
+        ("orgs_relations",
+         "SELECT * FROM orgs_relations WHERE fk_org IN ({0})".format(kept_orgs),
+         params),
+        ("orgs_languages",
+         "SELECT * FROM orgs_languages WHERE fk_org IN ({0})".format(kept_orgs),
+         params),
+        ("languages",
+         """SELECT * FROM languages WHERE id_language IN
+            (SELECT fk_language FROM orgs_languages WHERE fk_org IN ({0}))"""
+         .format(kept_orgs), params),
+    ]
+
+
+def arrow_schema(db, table, colnames):
+    import pyarrow
+
+    declared = {col[1]: col[2].lower() for col in
+                db.c.execute("PRAGMA table_info({0})".format(table)).fetchall()}
+    return pyarrow.schema([(name, ARROW_TYPES.get(declared.get(name), "string"))
+                           for name in colnames])
+
+
+def export_table(db, table, sql, params, out_dir, fmt, chunk_size):
+    """Stream one query into out_dir/<table>.<ext>; returns rows written"""
+    cursor = db.conn.cursor()
+    cursor.execute(sql, params)
+    colnames = [col[0] for col in cursor.description]
+
+    n_rows = 0
+
+    if fmt == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+
+        path = os.path.join(out_dir, table + ".parquet")
+        schema = arrow_schema(db, table, colnames)
+
+        with pyarrow.parquet.ParquetWriter(path, schema,
+                                           compression="zstd") as writer:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(col, type=field.type)
+                     for col, field in zip(columns, schema)], schema=schema))
+                n_rows += len(rows)
+    else:
+        path = os.path.join(out_dir, table + ".csv.gz")
+
+        with gzip.open(path, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(colnames)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                n_rows += len(rows)
+
+    cursor.close()
+    logger.info("Exported {0} rows from {1} to {2}".format(n_rows, table, path))
+    return n_rows
+
+
+def export_final(filtered=True, fmt=None, out_dir=None, chunk_size=None,
+                 snapshot=False):
+    fmt = fmt or ("parquet" if HAVE_PYARROW else "csv")
+    out_dir = out_dir or getattr(config, "EXPORT_DIR", "data/export")
+    chunk_size = chunk_size or getattr(config, "EXPORT_CHUNK_SIZE", 5000)
+
+    if fmt == "parquet" and not HAVE_PYARROW:
+        raise RuntimeError("Parquet export needs pyarrow; use --format csv.")
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    if snapshot:
+        from snapshot import Snapshot
+        db = Snapshot()
+    else:
+        db = DB()
+
+    for table, sql, params in export_queries(filtered):
+        with metrics.timer("export." + table):
+            n_rows = export_table(db, table, sql, params, out_dir, fmt,
+                                  chunk_size)
+        metrics.incr("export.rows." + table, n_rows)
+
+    db.close()
+    metrics.dump("export_final")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the final tables to "
+                                     "compressed columnar files.")
+    parser.add_argument("--all", action="store_true",
+                        help="don't drop the ignored organization types")
+    parser.add_argument("--format", choices=["parquet", "csv"],
+                        help="default: parquet if pyarrow is installed")
+    parser.add_argument("--out", help="output directory "
+                        "(default: config.EXPORT_DIR)")
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--snapshot", action="store_true",
+                        help="read config.SNAPSHOT_FILE instead of the live "
+                        "database")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    export_final(filtered=not args.all, fmt=args.format, out_dir=args.out,
+                 chunk_size=args.chunk_size, snapshot=args.snapshot)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Logging helpers that keep log I/O off the scraping hot path.
+#
+#   * Queue mode: the root logger gets a single QueueHandler and the real
+#     file and console handlers run in a QueueListener thread, so logging a
+#     line costs a queue put instead of two synchronous writes.
+#   * Aggregation: per-row messages opt in with
+#       logger.info("Inserted row into database.",
+#                   extra={"aggregate": "Inserted {0} rows into database."})
+#     and are collapsed into one line every `every` occurrences. Leftover
+#     counts are flushed when logging shuts down.
+# --------------------------------------------------------------------------
+
+# Full modules
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import queue
+import threading
+
+# Start log
+logger = logging.getLogger(__name__)
+
+# The running listener and aggregating filters, so shutdown() can find them
+_listener = None
+_aggregators = []
+
+
+class AggregateFilter(logging.Filter):
+    """Swallow records that carry an `aggregate` template and let one through,
+    reworded with the running count, every `every` occurrences.
+    """
+    def __init__(self, every=500):
+        super().__init__()
+        self.every = every
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        template = getattr(record, "aggregate", None)
+        if template is None:
+            return True
+
+        with self.lock:
+            count = self.counts.get(template, 0) + 1
+            if count < self.every:
+                self.counts[template] = count
+                return False
+            self.counts[template] = 0
+
+        record.msg = template.format(count)
+        record.args = ()
+        return True
+
+    def flush(self, handler):
+        """Send any partial counts straight to handler"""
+        with self.lock:
+            pending = [(template, count) for template, count
+                       in self.counts.items() if count > 0]
+            self.counts = {}
+
+        for template, count in pending:
+            record = logging.getLogger().makeRecord(
+                __name__, logging.INFO, __file__, 0, template.format(count),
+                (), None, func="flush")
+            handler.handle(record)
+
+
+def configure(settings, use_queue=True, aggregate_every=500):
+    """Apply a dictConfig and then optionally move the root handlers behind a
+    queue and/or aggregate per-row messages.
+    """
+    global _listener
+
+    shutdown()
+    logging.config.dictConfig(settings)
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+
+    if use_queue:
+        log_queue = queue.Queue(-1)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                                   respect_handler_level=True)
+        _listener.start()
+
+        # Filter before queueing so swallowed rows never cross the thread
+        filtered = [queue_handler]
+    else:
+        filtered = handlers
+
+    if aggregate_every and aggregate_every > 1:
+        for handler in filtered:
+            aggregator = AggregateFilter(aggregate_every)
+            handler.addFilter(aggregator)
+            _aggregators.append((aggregator, handler))
+
+
+def shutdown():
+    """Flush aggregated counts and drain the queue, if there is one"""
+    global _listener
+
+    for aggregator, handler in _aggregators:
+        aggregator.flush(handler)
+        handler.removeFilter(aggregator)
+    del _aggregators[:]
+
+    if _listener is not None:
+        _listener.stop()
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            if isinstance(handler, logging.handlers.QueueHandler):
+                root.removeHandler(handler)
+        for handler in _listener.handlers:
+            root.addHandler(handler)
+        _listener = None
+
+
+def setup_logging():
+    """Run config.setup_logging(). Scripts call this in their __main__ block.
+
+    A config.py copied from before setup_logging existed configures logging
+    when it's imported, so there's nothing left to do for it.
+    """
+    import config
+
+    if hasattr(config, "setup_logging"):
+        config.setup_logging()
+    else:
+        logger.warning("config.py has no setup_logging(); copy the newer "
+                       "settings over from config.py.dist.")
+
+
+def reset_for_worker():
+    """Log straight to stderr in a forked worker process.
+
+    The worker inherits the root QueueHandler but not the listener thread,
+    so anything it logged would sit in its copy of the queue and be lost.
+    """
+    global _listener
+
+    root = logging.getLogger()
+    queued = [handler for handler in root.handlers
+              if isinstance(handler, logging.handlers.QueueHandler)]
+    if not queued:
+        return
+
+    formatter = None
+    if _listener is not None:
+        formatter = next((handler.formatter for handler in _listener.handlers
+                          if handler.formatter), None)
+
+    for handler in queued:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    # The parent's listener and filters aren't this process's to shut down
+    _listener = None
+    del _aggregators[:]
+
+
+atexit.register(shutdown)
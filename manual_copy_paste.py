@@ -10,8 +10,10 @@
 # --------------
 # My modules
 import config
-import scrape_yio
-from yio import DB
+import metrics
+import page_store
+import throttle
+from yio import DB, logged_out
 
 # Full modules
 import logging
@@ -19,14 +21,12 @@ import logging
 # Just parts of modules
 from collections import namedtuple
 from random import choice, sample
-from time import sleep
+from time import sleep, perf_counter
 from sys import platform
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-from selenium.common.exceptions import UnexpectedAlertPresentException
-from selenium.webdriver.chrome.options import Options
+
+# Selenium (and scrape_yio, for BeautifulSoup) are imported by the functions
+# that drive the browser or parse pages, so get_n_remaining() and friends
+# don't pay for them
 
 # Start log
 logger = logging.getLogger(__name__)
@@ -41,8 +41,7 @@ def get_ids(db, k):
     db.c.execute("SELECT fk_org FROM organizations_raw")
     already_processed = {row_id[0] for row_id in db.c.fetchall()}
 
-    db.c.execute("SELECT fk_org FROM data_raw")
-    saved_raw = {row_id[0] for row_id in db.c.fetchall()}
+    saved_raw = page_store.saved_org_ids(db)
 
     # Determine which ids in the master list haven't already been processed
     orgs_todo = master_list - already_processed - saved_raw
@@ -52,7 +51,7 @@ def get_ids(db, k):
     db.add_factory(factory=OrgInfo)
 
     do_these = [str(org) for org in sample(orgs_todo, k)]
-    subset_sql = ("SELECT id_org, org_name, org_url FROM organizations "
+    subset_sql = ("SELECT id_org, org_name_t, org_url FROM organizations "
                   "WHERE id_org IN ({0})""".format(", ".join(do_these)))
     db.c.execute(subset_sql)
     orgs_to_process = db.c.fetchall()
@@ -62,6 +61,10 @@ def get_ids(db, k):
 
 # Manually get pages
 def get_page(browser, url):
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+
     browser.get(url)
     logger.info(browser.title)
 
@@ -110,18 +113,17 @@ def login_manually(browser):
 
 # Parse the raw HTML and save as raw columned data
 def parse_raw_html():
+    import scrape_yio
+
     OrgPage = namedtuple('OrgPage', ['id_org', 'org_html'])
 
     # Open database and log into YIO
     db = DB()
-    db.add_factory(factory=OrgPage)
-
-    db.c.execute("SELECT fk_org, org_html FROM data_raw")
+    page_store.prepare_db(db)
 
-    orgs = db.c.fetchall()
+    orgs = [OrgPage(*row) for row in page_store.saved_pages(db, limit=1)]
 
-    db.add_factory(None)  # Clear custom factory
-    for org in orgs[0:1]:
+    for org in orgs:
         logger.info("Parsing details for {0}".format(org.id_org))
         scrape_yio.parse_individual_org(None, org, db)
 
@@ -130,9 +132,9 @@ def parse_raw_html():
 # There's probably a pure SQL way to do this, but I don't want to figure it out
 def get_n_remaining():
     db = DB()
+    page_store.prepare_db(db)
 
-    db.c.execute("SELECT COUNT(DISTINCT fk_org) FROM data_raw")
-    manually_done = db.c.fetchone()[0]
+    manually_done = len(page_store.saved_org_ids(db))
 
     db.c.execute("SELECT COUNT(id_org) FROM organizations")
     master_list = db.c.fetchone()[0]
@@ -153,9 +155,13 @@ def get_n_remaining():
 # Chrome's CRX: http://chrome-extension-downloader.com
 # Firefox: https://dl.google.com/analytics/optout/gaoptoutaddon_0.9.6.xpi
 #
-def get_raw_html(num_orgs):
+def get_raw_html(num_orgs=1):
+    from selenium import webdriver
+    from selenium.common.exceptions import UnexpectedAlertPresentException
+    from selenium.webdriver.chrome.options import Options
+
     # Choose a random browser
-    if choice(["Firefox", "Firefox"]) is "Firefox":
+    if choice(["Firefox", "Firefox"]) == "Firefox":
         fp = webdriver.FirefoxProfile()
         fp.add_extension(extension='bin/gaoptoutaddon_0.9.6.xpi')
         browser = webdriver.Firefox(firefox_profile=fp)
@@ -173,31 +179,46 @@ def get_raw_html(num_orgs):
     login_manually(browser)
 
     db = DB()
+    page_store.prepare_db(db)
     orgs_to_get = get_ids(db, num_orgs)
 
     # Get, save, wait, repeat
     for i, org in enumerate(orgs_to_get):
         try:
             logger.info("{1}: Getting details for {0}.".format(org.name, i + 1))
-            raw_html = get_page(browser, org.url)
-            data_to_insert = {"fk_org": org.id_org, "org_html": raw_html}
-            db.insert_dict(data_to_insert, table="data_raw")
-
-            if i != len(orgs_to_get) - 1:
-                wait = choice(config.wait_time)
-                logger.info("Waiting for {0} seconds before moving on".format(wait))
-                sleep(wait)
+            # Selenium can't see HTTP statuses, so the throttle only has the
+            # page load time and the login page to go on
+            with throttle.slot():
+                start = perf_counter()
+                raw_html = get_page(browser, org.url)
+                load_time = perf_counter() - start
+            metrics.observe("browser.page_load", load_time)
+            throttle.record(load_time, logged_out=logged_out(raw_html))
+            metrics.incr("http.requests")
+            metrics.incr("http.bytes", len(raw_html.encode("utf-8")))
+            if getattr(config, "PAGE_STORE", True):
+                page_store.store_page(db, org.id_org, raw_html)
+                db.conn.commit()
             else:
+                data_to_insert = {"fk_org": org.id_org, "org_html": raw_html}
+                db.insert_dict(data_to_insert, table="data_raw")
+
+            if i == len(orgs_to_get) - 1:
                 logger.info("All done! \(•◡•)/")
                 logger.info("{0} rows left to do.".format(get_n_remaining()))
         except UnexpectedAlertPresentException:
             logger.info("Weird popup error")
+            metrics.incr("http.errors")
             continue
 
     browser.close()
     db.close()
+    metrics.dump("get_raw_html")
 
 
 if __name__ == '__main__':
-    get_raw_html(num_orgs=1)
+    import logutil
+    logutil.setup_logging()
+
+    get_raw_html()
     # print(get_n_remaining())
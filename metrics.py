@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Lightweight counters, timers and histograms for the scraping pipeline.
+#
+# Everything goes through the module-level registry:
+#
+#   import metrics
+#   metrics.incr("db.rows_inserted")
+#   with metrics.timer("http.latency"):
+#       page = session.get(url).text
+#
+# A one-line summary is logged every config.METRICS_REPORT_EVERY seconds
+# while a run is going, and metrics.dump() writes the whole registry to
+# config.METRICS_DIR as JSON at the end of a run.
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+
+# Full modules
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+# Just parts of modules
+from contextlib import contextmanager
+from datetime import datetime
+
+# Start log
+logger = logging.getLogger(__name__)
+
+
+class Histogram():
+    """Count, sum, min and max of observed values plus a fixed-size random
+    reservoir of them for percentiles, so memory stays constant no matter how
+    long the run is.
+    """
+    def __init__(self, reservoir_size=2048):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.reservoir = []
+        self.reservoir_size = reservoir_size
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        # Reservoir sampling (Algorithm R)
+        if len(self.reservoir) < self.reservoir_size:
+            self.reservoir.append(value)
+        else:
+            slot = random.randrange(self.count)
+            if slot < self.reservoir_size:
+                self.reservoir[slot] = value
+
+    def percentile(self, pct):
+        if not self.reservoir:
+            return None
+        values = sorted(self.reservoir)
+        rank = min(len(values) - 1, int(pct / 100 * len(values)))
+        return values[rank]
+
+    def summary(self):
+        return {"count": self.count,
+                "sum": round(self.total, 6),
+                "mean": round(self.total / self.count, 6) if self.count else None,
+                "min": self.min, "max": self.max,
+                "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class Metrics():
+    """Registry of named counters and histograms"""
+    def __init__(self, report_every=None):
+        self.lock = threading.Lock()
+        self.report_every = report_every
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+            self.last_report = time.monotonic()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+        self.maybe_report()
+
+    @contextmanager
+    def timer(self, name):
+        """Time the body of a with block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def maybe_report(self):
+        if not self.report_every:
+            return
+        now = time.monotonic()
+        if now - self.last_report >= self.report_every:
+            self.last_report = now
+            logger.info(self.summary_line())
+
+    def summary_line(self):
+        with self.lock:
+            parts = ["{0}={1}".format(name, value)
+                     for name, value in sorted(self.counters.items())]
+            parts += ["{0}={1}x{2:.1f}ms".format(name, hist.count,
+                                                 1000 * hist.total / hist.count)
+                      for name, hist in sorted(self.histograms.items())]
+        return "Metrics: " + ", ".join(parts)
+
+    def summary(self):
+        with self.lock:
+            return {"started": datetime.fromtimestamp(self.started)
+                                       .isoformat(timespec="seconds"),
+                    "elapsed": round(time.time() - self.started, 3),
+                    "counters": dict(self.counters),
+                    "histograms": {name: hist.summary() for name, hist
+                                   in self.histograms.items()}}
+
+    def dump(self, run_name, directory=None):
+        """Write the registry to <directory>/<run_name>-<timestamp>.json"""
+        directory = directory or getattr(config, "METRICS_DIR", "metrics")
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, "{0}-{1}.json".format(
+            run_name, datetime.now().strftime("%Y%m%d-%H%M%S")))
+
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+        logger.info(self.summary_line())
+        logger.info("Saved metrics to {0}".format(path))
+        return path
+
+
+# Module-level registry and shortcuts
+registry = Metrics(report_every=getattr(config, "METRICS_REPORT_EVERY", 60))
+
+incr = registry.incr
+observe = registry.observe
+timer = registry.timer
+summary = registry.summary
+dump = registry.dump
+reset = registry.reset
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Synthetic Yearbook of International Organizations pages and a tiny local
+# server to serve them. The pages mimic the structure the scrapers rely on:
+#
+#   * Subject listings: a .view-yearbook-working .views-table with nine
+#     columns per organization and a .pager with a .pager-next link
+#   * Organization pages: site chrome wrapped around a #content div with an
+#     <h1> name and <h2>/<p> sections (contact details, subjects, members...)
+#
+# Cell values are drawn from small pools so that, like the real corpus,
+# classifications, subject blocks, shared secretariats and news snippets
+# repeat across organizations.
+# --------------------------------------------------------------------------
+
+# Full modules
+import logging
+import random
+import re
+import threading
+import time
+
+# Just parts of modules
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Start log
+logger = logging.getLogger(__name__)
+
+WORDS = ("international association federation council network union "
+         "journalists media press freedom education teachers research "
+         "development cooperation promote support member national regional "
+         "training information exchange rights public service broadcasting "
+         "communication culture science study conference annual general "
+         "assembly secretariat committee board programme project standards "
+         "professional ethics independent democratic access knowledge youth "
+         "students schools universities libraries archives publishing").split()
+
+CITIES = [("Paris", "France"), ("Geneva", "Switzerland"),
+          ("Brussels", "Belgium"), ("London", "UK"), ("Nairobi", "Kenya"),
+          ("Washington DC", "USA"), ("Vienna", "Austria"),
+          ("Buenos Aires", "Argentina"), ("Tokyo", "Japan"),
+          ("New Delhi", "India"), ("Dakar", "Senegal"), ("Oslo", "Norway")]
+
+CONTINENTS = {
+    "Africa": ["Kenya", "Nigeria", "Senegal", "South Africa", "Ghana"],
+    "Americas": ["Argentina", "Brazil", "Canada", "Mexico", "USA"],
+    "Asia-Pacific": ["India", "Japan", "Australia", "Indonesia"],
+    "Europe": ["Austria", "Belgium", "France", "Norway", "UK", "Switzerland"],
+}
+
+TYPE_I = [("B", "Universal membership organizations"),
+          ("C", "Intercontinental membership organizations"),
+          ("D", "Regionally defined membership organizations"),
+          ("E", "Organizations emanating from places, persons or other bodies"),
+          ("F", "Organizations having a special form"),
+          ("G", "Internationally-oriented national organizations"),
+          ("J", "Recently reported or proposed international organizations")]
+
+TYPE_II = [("", ""), ("g", "intergovernmental"), ("y",
+           "international organization membership"),
+           ("f", "foundation, fund"), ("j", "research institute"),
+           ("v", "individual membership only")]
+
+TYPE_III = ["Professional Bodies", "Networks", "Foundations", "Institutes",
+            "Human Rights Organizations", "International Federations"]
+
+SUBJECT_TREE = {
+    "Communication": ["Censorship", "Journalism", "Media", "Broadcasting"],
+    "Education": ["Education", "Teaching", "Higher Education"],
+    "Law": ["Human Rights", "Freedom of Expression"],
+    "Societal Problems": ["Censorship", "Discrimination"],
+}
+
+LANGUAGES = ["English", "French", "Spanish", "Arabic", "German", "Russian",
+             "Portuguese", "Chinese"]
+
+IGOS = ["ECOSOC", "UNESCO", "Council of Europe", "UNICEF", "ILO",
+        "African Union", "OAS"]
+
+LISTING_COLUMNS = ["Name", "Acronym", "Founded", "City", "Country", "Type I",
+                   "Type II", "Type III", "UIA ID"]
+
+SUBJECTS = ["Censorship", "Journalism", "Media", "Education"]
+
+
+def _chrome(title, body):
+    """Wrap a page body in the (large, identical) site chrome"""
+    nav = "\n".join('<li class="leaf"><a href="/ybio/?wcodes={0}">{0}</a></li>'
+                    .format(word.title()) for word in WORDS)
+    scripts = "\n".join('<script type="text/javascript" src="/sites/all/js/'
+                        'yearbook_{0}.js?v=2015"></script>'.format(i)
+                        for i in range(12))
+    return """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8" />
+<title>{0} | Yearbook of International Organizations</title>
+<link rel="stylesheet" href="/sites/all/themes/ybio/css/style.css" />
+{1}
+</head>
+<body class="html not-front">
+<div id="header"><a href="/ybio">Yearbook of International Organizations</a>
+<form action="/ybio/" method="get"><input type="text" name="wcodes" /></form>
+</div>
+<div id="navigation"><ul class="menu">
+{2}
+</ul></div>
+<div id="content">
+{3}
+</div>
+<div id="footer"><p>&copy; Union of International Associations. All rights
+reserved. <a href="/terms">Terms of use</a> | <a href="/privacy">Privacy</a></p>
+<script type="text/javascript">var _gaq = _gaq || []; _gaq.push(['_trackPageview']);</script>
+</div>
+</body>
+</html>
+""".format(title, scripts, nav, body)
+
+
+class SyntheticOrg():
+    """One fake organization: listing row values plus its detail sections"""
+    def __init__(self, uia_id, subject, rng, shared_contacts):
+        self.uia_id = uia_id
+        self.subject = subject
+
+        words = rng.sample(WORDS, 4)
+        self.name = "{0} {1} of {2} {3}".format(*[w.title() for w in words])
+        self.acronym = "".join(w[0] for w in words).upper()
+        self.founded = str(rng.randint(1890, 2014))
+        self.city, self.country = rng.choice(CITIES)
+        self.type_i = rng.choice(TYPE_I)
+        self.type_ii = rng.choice(TYPE_II)
+        self.type_iii = rng.choice(TYPE_III)
+
+        self.sections = self._sections(rng, shared_contacts)
+
+    def _sentence(self, rng, n=12):
+        return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+    def _link(self, rng, text):
+        return '<a href="/s/or/en/{0}">{1}</a>'.format(
+            rng.randint(1100000000, 1100099999), text)
+
+    def _sections(self, rng, shared_contacts):
+        # Many organizations share a secretariat; the rest have their own
+        if rng.random() < 0.4:
+            contact = rng.choice(shared_contacts)
+        else:
+            contact = _contact_block(rng)
+
+        site = "http://www.{0}.org".format(self.acronym.lower())
+        contact_details = contact + ('\n<p>URL: <a href="{0}">{0}</a></p>'
+                                     .format(site))
+
+        # Subject block drawn from a small set of combinations
+        parents = rng.sample(sorted(SUBJECT_TREE), rng.randint(1, 2))
+        subjects = "<ul>"
+        for parent in sorted(parents):
+            subjects += "<li>{0}</li><ul>".format(parent)
+            for child in SUBJECT_TREE[parent][:2]:
+                subjects += "<li>{0}</li>".format(child)
+            subjects += "</ul>"
+        subjects += "</ul>"
+
+        # Members by continent
+        continents = rng.sample(sorted(CONTINENTS), rng.randint(1, 3))
+        n_countries = 0
+        members = ['<p>Full members in {0} countries:</p>']
+        for continent in sorted(continents):
+            countries = rng.sample(CONTINENTS[continent],
+                                   rng.randint(1, len(CONTINENTS[continent])))
+            n_countries += len(countries)
+            members.append("<p>• {0}: {1}.</p>".format(
+                continent, ", ".join(self._link(rng, c) for c in countries)))
+        members[0] = members[0].format(n_countries)
+        members.append("<p>Associate members (2):</p>")
+        members.append("<p>• {0};</p>".format(self._link(rng, "Press Council")))
+        members.append("<p>• {0}.</p>".format(self._link(rng, "Media Trust")))
+        members.append("<p>Members in {0} countries on {1} continents.</p>"
+                       .format(n_countries, len(continents)))
+
+        igos = rng.sample(IGOS, rng.randint(1, 3))
+        languages = rng.sample(LANGUAGES, rng.randint(1, 4))
+
+        sections = {
+            "Aims": "<p>{0} {1}</p>".format(self._sentence(rng),
+                                             self._sentence(rng)),
+            "History": "<p>Founded {0}, {1}, at the {2}. {3}</p>".format(
+                self.founded, self.city, self._link(rng, "World Congress"),
+                self._sentence(rng, 30)),
+            "Structure": "<p>General Assembly (every 2 years). Board. "
+                         "Secretariat. {0}</p>".format(self._sentence(rng, 6)),
+            "Languages": "<p>{0}.</p>".format(", ".join(languages)),
+            "Staff": "<p>{0} paid; {1} voluntary.</p>".format(
+                rng.randint(1, 40), rng.randint(0, 100)),
+            "Financing": "<p>Members' dues. <i>Budget</i>: EUR {0}.</p>"
+                         .format(rng.randint(10, 900) * 1000),
+            "Activities": "<p>{0} <b>{1}</b></p>".format(
+                self._sentence(rng, 20), self._sentence(rng, 5)),
+            "Events": ('<p><a href="/ybio/icco/search?org={0}">Search events'
+                       '</a></p><p>{1} General Assembly {2} ({3})</p>'
+                       .format(self.uia_id, rng.randint(2010, 2016),
+                               self.city, self.country)),
+            "Publications": "<p><i>{0} Newsletter</i> (quarterly). "
+                            "Annual Report. {1}</p>".format(
+                                self.acronym, self._sentence(rng, 4)),
+            "Information Services": "<p>Library; databank.</p>",
+            "Members": "\n".join(members),
+            "Consultative Status": "<p>Consultative Status granted with: "
+                                   "{0}.</p>".format("; ".join(
+                                       self._link(rng, i) + " (Ros C)"
+                                       for i in igos)),
+            "Relations with Inter-Governmental Organizations":
+                "<p>Member of: {0}.</p>".format(", ".join(
+                    self._link(rng, i) for i in igos)),
+            "Relations with Non-Governmental Organizations":
+                "<p>Member of: {0}; {1}.</p><p>Partner of: {2}.</p>".format(
+                    self._link(rng, "Global Forum for Media Development"),
+                    self._link(rng, "IFEX"),
+                    self._link(rng, "International Press Institute")),
+            "Subjects": subjects,
+            "Type I Classification": "<p>{0}: {1}</p>".format(*self.type_i),
+            "Type II Classification": "<p>{0}: {1}</p>".format(
+                *self.type_ii) if self.type_ii[0] else "<p></p>",
+            "Last News Received": "<div>{0}-{1:02d}</div>".format(
+                rng.randint(2010, 2015), rng.randint(1, 12)),
+            "Contact Details": contact_details,
+        }
+        return sections
+
+    def listing_row(self, base_url):
+        cells = [
+            '<a href="{0}/s/or/en/{1}">{2}</a>'.format(base_url, self.uia_id,
+                                                       self.name),
+            self.acronym, self.founded, self.city, self.country,
+            self.type_i[0], self.type_ii[0], self.type_iii, str(self.uia_id)]
+        return "<tr>{0}</tr>".format("".join(
+            '<td class="views-field">{0}</td>'.format(cell) for cell in cells))
+
+    def page(self):
+        body = "<h1>{0} ({1})</h1>\n".format(self.name, self.acronym)
+        body += '<script type="text/javascript">initMap({0});</script>\n'.format(
+            self.uia_id)
+        for heading, section in self.sections.items():
+            body += "<h2>{0}</h2>\n{1}\n".format(heading, section)
+        return _chrome(self.name, body)
+
+
+def _contact_block(rng):
+    city, country = rng.choice(CITIES)
+    number = rng.randint(1000000, 9999999)
+    return ("<p>Main address: {0} {1} Street, {2}, {3}<br/>Tel: +1 {4}<br/>"
+            "Fax: +1 {5}<br/>Email: info (at) {6}.org</p>"
+            .format(rng.randint(1, 200), rng.choice(WORDS).title(), city,
+                    country, number, number + 1, rng.choice(WORDS)))
+
+
+class SyntheticYIO():
+    """A reproducible corpus of fake subject listings and organization pages.
+
+    n_orgs organizations are spread round-robin over the four subjects the
+    scraper knows about and listed per_page rows at a time.
+    """
+    def __init__(self, n_orgs=200, per_page=20, seed=1234):
+        self.rng = random.Random(seed)
+        self.shared_contacts = [_contact_block(self.rng)
+                                for _ in range(max(1, n_orgs // 20))]
+
+        self.per_page = per_page
+        self.subjects = SUBJECTS
+        self.orgs = {}
+        self.by_subject = {subject: [] for subject in self.subjects}
+
+        for i in range(n_orgs):
+            self.add_org()
+
+    def add_org(self):
+        i = len(self.orgs)
+        uia_id = 1100000000 + i
+        subject = self.subjects[i % len(self.subjects)]
+        org = SyntheticOrg(uia_id, subject, self.rng, self.shared_contacts)
+        self.orgs[uia_id] = org
+        self.by_subject[subject].append(org)
+        return org
+
+    def refresh(self, changed=0.05, added=0.02):
+        """Simulate time passing: change the listing details (and pages) of
+        a fraction of the organizations and add some new ones. Returns the
+        uia_ids of the (changed, added) organizations."""
+        changed_ids = self.rng.sample(sorted(self.orgs),
+                                      int(len(self.orgs) * changed))
+        for uia_id in changed_ids:
+            org = self.orgs[uia_id]
+            org.city, org.country = self.rng.choice(CITIES)
+            org.type_ii = self.rng.choice(TYPE_II)
+            org.sections["History"] += "<p>{0}</p>".format(
+                org._sentence(self.rng))
+
+        added_ids = [self.add_org().uia_id
+                     for _ in range(int(len(self.orgs) * added))]
+        return changed_ids, added_ids
+
+    def listing_page(self, subject, page, base_url=""):
+        orgs = self.by_subject.get(subject, [])
+        start = page * self.per_page
+        rows = [org.listing_row(base_url)
+                for org in orgs[start:start + self.per_page]]
+
+        header = "<tr>{0}</tr>".format("".join(
+            "<th>{0}</th>".format(col) for col in LISTING_COLUMNS))
+
+        if start + self.per_page < len(orgs):
+            pager_next = ('<li class="pager-next"><a href="/ybio/?wcodes={0}'
+                          '&amp;wcodes_op=contains&amp;page={1}">next ›</a></li>'
+                          .format(subject, page + 1))
+        else:
+            pager_next = ""
+
+        body = """<div class="view view-yearbook-working">
+<table class="views-table">
+{0}
+{1}
+</table>
+<ul class="pager"><li class="pager-current">{2}</li>{3}</ul>
+</div>""".format(header, "\n".join(rows), page + 1, pager_next)
+        return _chrome(subject, body)
+
+    def org_page(self, uia_id):
+        org = self.orgs.get(uia_id)
+        return org.page() if org else None
+
+
+class MockServer():
+    """Serve a SyntheticYIO corpus over HTTP on localhost.
+
+    Use as a context manager; self.url is the base URL to put in
+    config.BASE_URL while it's running. latency (seconds) is added to every
+    response to stand in for the network.
+
+    To stand in for a server under load:
+
+      capacity    requests it handles at once at the base latency. Beyond
+                  that every response slows down in proportion to the
+                  number in flight, and past twice that it answers 503.
+      rate_limit  requests per second (over the last second) it accepts;
+                  the rest get a 429 with Retry-After: 1.
+
+    self.statuses counts the responses sent by status.
+    """
+    def __init__(self, corpus, port=0, latency=0, capacity=None,
+                 rate_limit=None):
+        self.corpus = corpus
+        self.latency = latency
+        self.capacity = capacity
+        self.rate_limit = rate_limit
+        self.statuses = Counter()
+        self.in_flight = 0
+        self.recent = deque()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port),
+                                         self._make_handler())
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+        self.thread = None
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.in_flight += 1
+                try:
+                    status, page, delay = server.load_response()
+                    if delay:
+                        time.sleep(delay)
+                    if status is None:
+                        status, page = server.respond(self.path)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+                        server.statuses[status] += 1
+
+                body = page.encode("utf-8")
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep the console quiet
+
+        return Handler
+
+    def load_response(self):
+        """(status, html, delay) for a request arriving now. status is None
+        if the request should be served normally."""
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and self.recent[0] < now - 1:
+                self.recent.popleft()
+            self.recent.append(now)
+
+            if self.rate_limit and len(self.recent) > self.rate_limit:
+                return 429, "<html><body>Too many requests</body></html>", 0
+            if self.capacity and self.in_flight > 2 * self.capacity:
+                return (503, "<html><body>Service unavailable</body></html>",
+                        self.latency)
+            if self.capacity:
+                return None, None, (self.latency *
+                                    max(1, self.in_flight / self.capacity))
+            return None, None, self.latency
+
+    def respond(self, path):
+        """Return (status, html) for a request path"""
+        parsed = urlparse(path)
+        org_match = re.match(r"^/s/or/en/(\d+)$", parsed.path)
+
+        if org_match:
+            page = self.corpus.org_page(int(org_match.group(1)))
+            if page:
+                return 200, page
+        elif parsed.path.rstrip("/") == "/ybio":
+            query = parse_qs(parsed.query)
+            subject = query.get("wcodes", [""])[0]
+            page = int(query.get("page", ["0"])[0])
+            return 200, self.corpus.listing_page(subject, page, self.url)
+
+        return 404, "<html><body>Not found</body></html>"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        logger.info("Mock YIO server running at {0}".format(self.url))
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    with MockServer(SyntheticYIO()) as server:
+        print("Serving synthetic YIO at {0} (Ctrl + C to stop)".format(server.url))
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
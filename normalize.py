@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Normalize the free-text columns clean_rows leaves in organizations_final:
+#
+#   founded        -> organizations_normalized.founded_year (integer)
+#   country_hq     -> organizations_normalized.fk_country_hq (countries)
+#   type_i_dir     -> organizations_normalized.fk_type_i (type_i)
+#   type_iii_dir   -> organizations_normalized.fk_type_iii (type_iii)
+#   type_ii_dir    -> orgs_type_ii (type_ii), one row per code
+#
+# Work is done a column at a time rather than a row at a time. Years and
+# country names are parsed once per distinct value (with pandas' vectorized
+# string methods if it's installed, otherwise a compiled regex), loaded into
+# temporary tables, and everything is written with a few INSERT ... SELECT
+# joins. The whole table is rebuilt on every run, so it can be re-run after
+# every clean_rows.
+#
+#   python normalize.py
+#   python normalize.py --benchmark    # against row-by-row updates
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import metrics
+from yio import DB
+
+# Full modules
+import argparse
+import importlib.util
+import logging
+import re
+import time
+
+# Just parts of modules
+from datetime import date
+
+# pandas is optional, and slow to import, so it's only imported to parse
+HAVE_PANDAS = importlib.util.find_spec("pandas") is not None
+
+# Start log
+logger = logging.getLogger(__name__)
+
+NORMALIZED_TABLES = ["countries", "organizations_normalized", "orgs_type_ii"]
+
+# The first plausible year in the cell: "1948", "c 1948", "1 Jan 1948",
+# "1948-09-01", "1948, Paris (France)"
+YEAR_PATTERN = r"(?<!\d)(1[0-9]{3}|20[0-9]{2})(?!\d)"
+FIRST_YEAR = 1000
+
+year_pattern = re.compile(YEAR_PATTERN)
+country_noise = re.compile(r"\s*\(.*?\)\s*|[\s.,;:]+$")
+whitespace = re.compile(r"\s+")
+
+# Other spellings of countries -> the name the YIO uses most
+COUNTRY_ALIASES = {
+    "united states": "USA",
+    "united states of america": "USA",
+    "us": "USA",
+    "u.s.a": "USA",
+    "united kingdom": "UK",
+    "great britain": "UK",
+    "england": "UK",
+    "u.k": "UK",
+    "russian federation": "Russia",
+    "holland": "Netherlands",
+    "the netherlands": "Netherlands",
+    "republic of korea": "Korea Rep",
+    "south korea": "Korea Rep",
+    "côte d'ivoire": "Côte d'Ivoire",
+    "ivory coast": "Côte d'Ivoire",
+}
+
+# Type II cells hold one or more codes ("g", "gy", "g, y"), and only codes
+# are matched, so a cell of words can't pick up codes from its letters
+TYPE_II_SEPARATORS = ", "
+
+
+def parse_years(values):
+    """The year in each of values (None where there isn't one)"""
+    last_year = date.today().year
+
+    if HAVE_PANDAS:
+        import pandas
+
+        years = (pandas.Series(values, dtype=object)
+                 .str.extract(YEAR_PATTERN, expand=False).astype(float))
+        years = years.where((years >= FIRST_YEAR) & (years <= last_year))
+        return [None if pandas.isna(year) else int(year) for year in years]
+
+    parsed = []
+    for value in values:
+        match = year_pattern.search(value or "")
+        year = int(match.group(1)) if match else None
+        parsed.append(year if year and FIRST_YEAR <= year <= last_year
+                      else None)
+    return parsed
+
+
+def country_name(value):
+    """Canonical name for a country_hq cell, or None"""
+    if not value:
+        return None
+    name = whitespace.sub(" ", country_noise.sub("", value)).strip()
+    if not name:
+        return None
+    return COUNTRY_ALIASES.get(name.lower().rstrip("."), name)
+
+
+def distinct_values(db, column):
+    return [row[0] for row in db.conn.execute(
+        "SELECT DISTINCT {0} FROM organizations_final WHERE {0} IS NOT NULL"
+        .format(column))]
+
+
+def type_ii_codes(db):
+    return "".join(row[0] for row in db.c.execute("SELECT type_ii FROM type_ii"))
+
+
+def load_temp(db, table, rows):
+    """Replace temp.<table>(raw PRIMARY KEY, value) with rows"""
+    db.c.execute("DROP TABLE IF EXISTS temp.{0}".format(table))
+    db.c.execute("CREATE TEMP TABLE {0} (raw text PRIMARY KEY, value)"
+                 .format(table))
+    db.c.executemany("INSERT INTO temp.{0} VALUES (?, ?)".format(table), rows)
+
+
+def normalize(db=None):
+    """Rebuild organizations_normalized and orgs_type_ii from
+    organizations_final. Returns the number of organizations with each
+    normalized column filled in."""
+    own_db = db is None
+    db = db or DB()
+    db.ensure_tables(NORMALIZED_TABLES)
+
+    with metrics.timer("normalize.parse"):
+        founded = distinct_values(db, "founded")
+        load_temp(db, "founded_years", zip(founded, parse_years(founded)))
+
+        countries = distinct_values(db, "country_hq")
+        load_temp(db, "country_names",
+                  ((raw, country_name(raw)) for raw in countries))
+
+    with metrics.timer("normalize.write"):
+        db.c.execute("""INSERT OR IGNORE INTO countries (country_name)
+                        SELECT DISTINCT value FROM temp.country_names
+                        WHERE value IS NOT NULL""")
+
+        db.c.execute("DELETE FROM organizations_normalized")
+        db.c.execute("""INSERT INTO organizations_normalized
+                        (id_org, founded_year, fk_country_hq, fk_type_i,
+                         fk_type_iii)
+                        SELECT organizations_final.id_org, founded_years.value,
+                               id_country, id_type_i, id_type_iii
+                        FROM organizations_final
+                        LEFT JOIN temp.founded_years
+                          ON founded_years.raw = organizations_final.founded
+                        LEFT JOIN temp.country_names
+                          ON country_names.raw = organizations_final.country_hq
+                        LEFT JOIN countries
+                          ON countries.country_name = country_names.value
+                        LEFT JOIN type_i
+                          ON type_i.type_i = trim(coalesce(
+                               nullif(type_i_dir, ''), organizations_final.type_i))
+                        LEFT JOIN type_iii
+                          ON type_iii.type_iii = trim(type_iii_dir)""")
+
+        # Case-sensitive substring match, like export_final's filter, on
+        # cells with nothing but codes in them
+        not_codes = "*[^{0}{1}]*".format(type_ii_codes(db), TYPE_II_SEPARATORS)
+        db.c.execute("DELETE FROM orgs_type_ii")
+        db.c.execute("""INSERT INTO orgs_type_ii (fk_org, fk_type_ii)
+                        SELECT id_org, id_type_ii FROM organizations_final
+                        INNER JOIN type_ii
+                          ON instr(coalesce(nullif(type_ii_dir, ''),
+                                            organizations_final.type_ii),
+                                   type_ii.type_ii) > 0
+                        WHERE coalesce(nullif(type_ii_dir, ''),
+                                       organizations_final.type_ii)
+                              NOT GLOB ?""", (not_codes,))
+        db.conn.commit()
+
+    counts = db.c.execute("""SELECT COUNT(*), COUNT(founded_year),
+                                    COUNT(fk_country_hq), COUNT(fk_type_i),
+                                    COUNT(fk_type_iii),
+                                    (SELECT COUNT(DISTINCT fk_org)
+                                     FROM orgs_type_ii)
+                             FROM organizations_normalized""").fetchone()
+    counts = dict(zip(["organizations", "founded_year", "country_hq",
+                       "type_i", "type_iii", "type_ii"], counts))
+    logger.info("Normalized {0[organizations]} organizations: {0[founded_year]} "
+                "years, {0[country_hq]} countries, {0[type_i]} type I, "
+                "{0[type_ii]} type II and {0[type_iii]} type III codes"
+                .format(counts))
+
+    if own_db:
+        db.close()
+    return counts
+
+
+def normalize_rowwise(db):
+    """The row-at-a-time equivalent of normalize(), for benchmark()"""
+    db.c.execute("DELETE FROM organizations_normalized")
+    db.c.execute("DELETE FROM orgs_type_ii")
+
+    codes_only = set(type_ii_codes(db) + TYPE_II_SEPARATORS)
+    rows = db.conn.execute("""SELECT id_org, founded, country_hq, type_i_dir,
+                                     type_i, type_ii_dir, type_ii, type_iii_dir
+                              FROM organizations_final""").fetchall()
+    for (id_org, founded, country_hq, type_i_dir, type_i, type_ii_dir,
+         type_ii, type_iii_dir) in rows:
+        year = parse_years([founded])[0]
+
+        country = country_name(country_hq)
+        id_country = None
+        if country:
+            db.c.execute("INSERT OR IGNORE INTO countries (country_name) "
+                         "VALUES (?)", (country,))
+            id_country = db.c.execute("SELECT id_country FROM countries "
+                                      "WHERE country_name = ?",
+                                      (country,)).fetchone()[0]
+
+        id_type_i = db.c.execute("SELECT id_type_i FROM type_i WHERE type_i = ?",
+                                 ((type_i_dir or type_i or "").strip(),)
+                                 ).fetchone()
+        id_type_iii = db.c.execute("SELECT id_type_iii FROM type_iii "
+                                   "WHERE type_iii = ?",
+                                   ((type_iii_dir or "").strip(),)).fetchone()
+        db.c.execute("""INSERT INTO organizations_normalized
+                        (id_org, founded_year, fk_country_hq, fk_type_i,
+                         fk_type_iii) VALUES (?, ?, ?, ?, ?)""",
+                     (id_org, year, id_country,
+                      id_type_i[0] if id_type_i else None,
+                      id_type_iii[0] if id_type_iii else None))
+
+        codes = type_ii_dir or type_ii or ""
+        if set(codes) <= codes_only:
+            for code in set(codes) - set(TYPE_II_SEPARATORS):
+                id_type_ii = db.c.execute("SELECT id_type_ii FROM type_ii "
+                                          "WHERE type_ii = ?", (code,)).fetchone()
+                if id_type_ii:
+                    db.c.execute("INSERT INTO orgs_type_ii VALUES (?, ?)",
+                                 (id_org, id_type_ii[0]))
+    db.conn.commit()
+
+
+def benchmark(db, repeat=3):
+    """Time normalize() against normalize_rowwise() and check they agree"""
+    db.ensure_tables(NORMALIZED_TABLES)
+    n_orgs = db.c.execute("SELECT COUNT(*) FROM organizations_final").fetchone()[0]
+    print("{0} organizations; best of {1} runs ({2})"
+          .format(n_orgs, repeat, "pandas" if HAVE_PANDAS else "regex"))
+
+    results = {}
+    for name, function in [("row by row", normalize_rowwise),
+                           ("set-based", normalize)]:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(db)
+            timings.append(time.perf_counter() - start)
+        results[name] = (
+            db.c.execute("""SELECT * FROM organizations_normalized
+                            ORDER BY id_org""").fetchall(),
+            db.c.execute("""SELECT * FROM orgs_type_ii
+                            ORDER BY fk_org, fk_type_ii""").fetchall())
+        print("  {0:<12} {1:>8.3f}s".format(name, min(timings)))
+
+    print("  same output: {0}".format(results["row by row"] ==
+                                      results["set-based"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Normalize founded years, "
+                                     "HQ countries and type codes in "
+                                     "organizations_final.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare with row-by-row updates")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    if args.benchmark:
+        db = DB()
+        benchmark(db)
+        db.close()
+    else:
+        normalize()
+        metrics.dump("normalize")
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Content-addressed storage for saved organization pages.
+#
+# data_raw keeps every capture as a whole page, but most of each page is
+# the same site chrome (header, navigation, footer, scripts) and only the
+# #content div matters to parse_individual_org. Here each page is split
+# into
+#
+#   content   the <div id="content"> element, exactly as it was
+#   chrome    everything around it, with the <title> text taken out so it's
+#             the same for every organization
+#   title     the page's <title> text
+#
+# and content and chrome go into page_blobs by SHA-1, so the chrome is
+# stored once however many pages share it. A capture of an organization
+# whose content hasn't changed since its last capture is skipped.
+# join_page() puts a page back together byte for byte.
+#
+#   python page_store.py --migrate     # move data_raw into the page store
+#   python page_store.py               # bytes saved so far
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import metrics
+from yio import DB
+
+# Full modules
+import argparse
+import hashlib
+import logging
+import re
+
+# Just parts of modules
+from datetime import datetime
+
+# Start log
+logger = logging.getLogger(__name__)
+
+PAGE_TABLES = ["page_blobs", "page_captures"]
+
+# Stand-ins for the title and content in a chrome template. NUL can't
+# appear in an HTML page, so they can't clash with the page itself.
+TITLE_SLOT = "\x00title\x00"
+CONTENT_SLOT = "\x00content\x00"
+
+content_start = re.compile(r"""<div\b[^>]*\bid=["']content["'][^>]*>""", re.I)
+div_tag = re.compile(r"<(/?)div\b", re.I)
+title_text = re.compile(r"<title\b[^>]*>(.*?)</title>", re.I | re.S)
+
+
+def digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def split_page(html):
+    """(chrome, title, content) for a page. If there's no #content div to
+    split on, chrome and title are None and content is the whole page."""
+    whole = (None, None, html)
+
+    start = content_start.search(html)
+    if start is None or "\x00" in html:
+        return whole
+
+    # Find the </div> that closes #content
+    depth = 1
+    for tag in div_tag.finditer(html, start.end()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            break
+    else:
+        return whole
+
+    end = html.find(">", tag.end()) + 1
+    if end == 0:
+        return whole
+
+    content = html[start.start():end]
+    chrome = html[:start.start()] + CONTENT_SLOT + html[end:]
+
+    title = title_text.search(chrome)
+    if title is None:
+        return chrome, None, content
+
+    return (chrome[:title.start(1)] + TITLE_SLOT + chrome[title.end(1):],
+            title.group(1), content)
+
+
+def join_page(chrome, title, content):
+    """The page split_page() split"""
+    if chrome is None:
+        return content
+    if title is not None:
+        chrome = chrome.replace(TITLE_SLOT, title, 1)
+    return chrome.replace(CONTENT_SLOT, content, 1)
+
+
+def prepare_db(db):
+    db.ensure_tables(PAGE_TABLES)
+
+
+def store_page(db, fk_org, html, captured=None):
+    """Save a capture of an organization's page. Returns False (and stores
+    nothing) if its content is the same as the organization's last capture."""
+    chrome, title, content = split_page(html)
+    content_hash = digest(content)
+    chrome_hash = digest(chrome) if chrome is not None else None
+
+    last = db.c.execute("""SELECT content_hash FROM page_captures
+                           WHERE fk_org = ?
+                           ORDER BY id_capture DESC LIMIT 1""",
+                        (fk_org,)).fetchone()
+    if last is not None and last[0] == content_hash:
+        logger.info("Skipping unchanged capture of {0}".format(fk_org))
+        metrics.incr("pages.unchanged")
+        return False
+
+    db.c.executemany("""INSERT OR IGNORE INTO page_blobs (blob_hash, body)
+                        VALUES (?, ?)""",
+                     [(content_hash, content)] +
+                     ([(chrome_hash, chrome)] if chrome is not None else []))
+    db.c.execute("""INSERT INTO page_captures
+                    (fk_org, content_hash, chrome_hash, title, page_bytes,
+                     captured)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                 (fk_org, content_hash, chrome_hash, title,
+                  len(html.encode("utf-8")),
+                  captured or datetime.now().isoformat(timespec="seconds")))
+    metrics.incr("pages.stored")
+    return True
+
+
+def saved_org_ids(db):
+    """Organizations with a saved page, in the page store or data_raw"""
+    ids = {row[0] for row in db.c.execute("SELECT fk_org FROM page_captures")}
+    if has_data_raw(db):
+        ids |= {row[0] for row in db.c.execute("SELECT fk_org FROM data_raw")}
+    return ids
+
+
+def has_data_raw(db):
+    return db.c.execute("""SELECT 1 FROM sqlite_master
+                           WHERE name = 'data_raw'""").fetchone() is not None
+
+
+def saved_pages(db, limit=None):
+    """(fk_org, html) for each saved page, for parsing: the #content of
+    each organization's latest capture in the page store, then any
+    data_raw pages that haven't been moved over"""
+    sql = """SELECT fk_org, body FROM page_captures
+             INNER JOIN page_blobs ON blob_hash = content_hash
+             WHERE id_capture IN (SELECT MAX(id_capture) FROM page_captures
+                                  GROUP BY fk_org)"""
+    if has_data_raw(db):
+        sql += """ UNION ALL
+                   SELECT fk_org, org_html FROM data_raw
+                   WHERE fk_org NOT IN (SELECT fk_org FROM page_captures)"""
+
+    # LIMIT -1 means no limit in SQLite
+    return db.conn.execute(sql + " LIMIT ?", (limit or -1,)).fetchall()
+
+
+def full_page(db, id_capture):
+    """A capture as it was saved, chrome and all"""
+    chrome, title, content = db.c.execute(
+        """SELECT chrome.body, title, content.body FROM page_captures
+           INNER JOIN page_blobs AS content
+             ON content.blob_hash = content_hash
+           LEFT JOIN page_blobs AS chrome
+             ON chrome.blob_hash = chrome_hash
+           WHERE id_capture = ?""", (id_capture,)).fetchone()
+    return join_page(chrome, title, content)
+
+
+def migrate(db, delete=False):
+    """Move data_raw into the page store, in capture order, for
+    organizations that aren't in it yet. Rows are kept unless delete is
+    set. Returns (pages stored, unchanged captures skipped)."""
+    if not has_data_raw(db):
+        return 0, 0
+
+    stored = skipped = 0
+    rows = db.conn.execute("""SELECT rowid, fk_org, org_html FROM data_raw
+                              WHERE fk_org NOT IN
+                                (SELECT fk_org FROM page_captures)
+                              ORDER BY rowid""").fetchall()
+
+    for rowid, fk_org, html in rows:
+        if join_page(*split_page(html)) != html:
+            raise RuntimeError("Page for {0} (data_raw row {1}) doesn't split "
+                               "cleanly".format(fk_org, rowid))
+
+        if store_page(db, fk_org, html):
+            stored += 1
+        else:
+            skipped += 1
+        if delete:
+            db.c.execute("DELETE FROM data_raw WHERE rowid = ?", (rowid,))
+
+    db.conn.commit()
+    logger.info("Moved {0} pages from data_raw; skipped {1} unchanged "
+                "captures".format(stored, skipped))
+    return stored, skipped
+
+
+def report(db):
+    """Sizes of the page store against keeping every capture whole"""
+    captures, orgs, chromes, page_bytes = db.c.execute(
+        """SELECT COUNT(*), COUNT(DISTINCT fk_org), COUNT(DISTINCT chrome_hash),
+                  COALESCE(SUM(page_bytes), 0)
+           FROM page_captures""").fetchone()
+    stored_bytes = db.c.execute(
+        """SELECT COALESCE(SUM(length(CAST(body AS blob))), 0)
+           FROM page_blobs""").fetchone()[0]
+    title_bytes, content_bytes = db.c.execute(
+        """SELECT COALESCE(SUM(length(CAST(title AS blob))), 0),
+                  COALESCE(SUM(length(CAST(body AS blob))), 0)
+           FROM page_captures
+           INNER JOIN page_blobs ON blob_hash = content_hash""").fetchone()
+    stored_bytes += title_bytes
+
+    return {"captures": captures, "organizations": orgs, "chromes": chromes,
+            "page_bytes": page_bytes, "stored_bytes": stored_bytes,
+            "saved_bytes": page_bytes - stored_bytes,
+            "content_bytes": content_bytes}
+
+
+def print_report(stats):
+    mb = 1024 ** 2
+    print("{0[captures]} captures of {0[organizations]} organizations, "
+          "{0[chromes]} distinct chromes".format(stats))
+    if not stats["page_bytes"]:
+        return
+    print("  whole pages  {0:>9.2f} MB".format(stats["page_bytes"] / mb))
+    print("  stored       {0:>9.2f} MB  ({1:.1%} saved)"
+          .format(stats["stored_bytes"] / mb,
+                  stats["saved_bytes"] / stats["page_bytes"]))
+    print("  parse input  {0:>9.2f} MB  ({1:.1%} of whole pages)"
+          .format(stats["content_bytes"] / mb,
+                  stats["content_bytes"] / stats["page_bytes"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Content-addressed storage "
+                                     "of saved organization pages.")
+    parser.add_argument("--migrate", action="store_true",
+                        help="move the pages in data_raw into the page store")
+    parser.add_argument("--delete", action="store_true",
+                        help="with --migrate, delete the data_raw rows moved")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    db = DB()
+    prepare_db(db)
+
+    if args.migrate:
+        migrate(db, delete=args.delete)
+    print_report(report(db))
+
+    db.close()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Streaming mode: crawl, parse and clean in one pass.
+#
+# The batch scripts hand work to each other through whole tables
+# (organizations -> data_raw / organizations_raw -> clean_me_full ->
+# organizations_final), so nothing is clean until everything is scraped.
+# Here each stage is a generator and the stages are connected by bounded
+# queues:
+#
+#   list_orgs      [thread]  subject listing pages -> listing rows
+#   fetch_orgs     [thread]  listing row -> organization page
+#   split_orgs     [thread]  page -> sections (scrape_yio.split_sections)
+#   write_orgs     [main]    organizations row, optional organizations_raw
+#                            row, clean_row, clean_org_to_db
+#
+# so final rows are committed every config.PIPELINE_COMMIT_EVERY
+# organizations while the crawl is still running. Organization pages are
+# fetched by up to config.THROTTLE_MAX_CONCURRENCY threads, in listing
+# order; how many requests are actually in flight, and how far apart they
+# start, is up to the shared throttle.controller.
+#
+# Organizations whose page can't be fetched (still 429/5xx after
+# scrape_yio.fetch's retries) are saved from their listing row and put in
+# delta_crawl's fetch_queue, so `python delta_crawl.py` picks them up later.
+#
+#   python pipeline.py --limit 50
+#   python pipeline.py --keep-raw        # also fill organizations_raw
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import metrics
+import clean_raw_orgs
+import delta_crawl
+import scrape_yio
+import throttle
+from yio import YIO, DB
+
+# Full modules
+import argparse
+import logging
+import queue
+import threading
+import time
+
+# Just parts of modules
+from collections import namedtuple
+from itertools import islice
+
+# Start log
+logger = logging.getLogger(__name__)
+
+# The organizations columns clean_row reads, followed by the page sections:
+# the same fields as a clean_me_full row
+LISTING_COLUMNS = ['org_name_t', 'org_acronym_t', 'org_founded_t',
+                   'org_city_hq_t', 'org_country_hq_t', 'org_type_i_t',
+                   'org_type_ii_t', 'org_type_iii_t', 'org_uia_id_t',
+                   'org_url_id', 'org_subject_t']
+StreamRow = namedtuple("StreamRow", ['id_org'] + LISTING_COLUMNS +
+                       clean_raw_orgs.RAW_SECTIONS)
+
+# Marks the end of a stage's output (or an exception) in its queue
+_finished = object()
+
+
+def threaded(iterable, name, maxsize=None):
+    """Iterate over iterable in a background thread, handing items over
+    through a queue of at most maxsize. Exceptions in the thread are raised
+    here; closing this generator stops the thread (and closes iterable).
+    """
+    maxsize = maxsize or getattr(config, "PIPELINE_QUEUE_SIZE", 50)
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # Time out now and then so a stopped pipeline doesn't leave the
+        # thread blocked on a full queue forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+            put((_finished, None))
+        except Exception as e:
+            put((_finished, e))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            metrics.observe("pipeline.queue." + name, items.qsize())
+
+            if type(item) is tuple and item and item[0] is _finished:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def list_orgs(session, subjects):
+    """Yield listing rows (dicts for organizations), page by page"""
+    for subject in subjects:
+        url = scrape_yio.subject_url(subject)
+
+        while url is not None:
+            logger.info("Parsing organizations listed at {0}".format(url))
+            page = scrape_yio.fetch(session, url)
+
+            with metrics.timer("parse.listing_page"):
+                rows, url = scrape_yio.parse_listing(page)
+
+            for org_details in rows:
+                org_details['org_subject_t'] = subject
+                yield org_details
+
+
+def fetch_orgs(session, listed):
+    """Yield (listing row, organization page), in listing order"""
+    def fetch_one(org_details):
+        logger.info("Getting organization details from {0}"
+                    .format(org_details['org_url']))
+        try:
+            return org_details, scrape_yio.fetch(session, org_details['org_url'])
+        except scrape_yio.FetchError as e:
+            logger.warning(str(e))
+            metrics.incr("orgs.failed")
+            return org_details, None
+
+    yield from throttle.map_ordered(fetch_one, listed)
+
+
+def split_orgs(fetched):
+    """Yield (listing row, sections), skipping pages that can't be parsed.
+    Pages that couldn't be fetched come through with sections=None."""
+    for org_details, page in fetched:
+        if page is None:
+            yield org_details, None
+            continue
+
+        start = time.perf_counter()
+        try:
+            sections = scrape_yio.split_sections(page)
+        except Exception as e:
+            logger.warning("{0} ({1}): {2}".format(e.__class__.__name__, e,
+                                                   org_details['org_url']))
+            metrics.incr("orgs.failed")
+            continue
+
+        metrics.observe("parse.org_page", time.perf_counter() - start)
+        metrics.incr("orgs.parsed")
+        yield org_details, sections
+
+
+def write_orgs(db, parsed, keep_raw=False, commit_every=None):
+    """Save, clean and write each parsed organization; returns the number
+    of organizations written"""
+    commit_every = commit_every or getattr(config, "PIPELINE_COMMIT_EVERY", 50)
+    contact_ids = {}
+    started = time.perf_counter()
+    n_written = 0
+
+    for org_details, sections in parsed:
+        # The listing row is what gives the organization its id_org
+        db.insert_dict(org_details, table="organizations", commit=False)
+        id_org = db.c.execute("SELECT id_org FROM organizations "
+                              "WHERE org_url_id = ?",
+                              (org_details['org_url_id'],)).fetchone()[0]
+
+        if sections is None:
+            db.c.execute("""INSERT OR IGNORE INTO fetch_queue
+                            (fk_org, reason, queued) VALUES (?, ?, ?)""",
+                         (id_org, "new", delta_crawl.now()))
+            continue
+
+        if keep_raw:
+            sections['fk_org'] = id_org
+            db.add_raw_columns(sections.keys())
+            db.insert_dict(sections, table="organizations_raw", commit=False)
+
+        row = StreamRow(id_org=id_org,
+                        **{col: org_details.get(col) for col in LISTING_COLUMNS},
+                        **{col: sections.get(col)
+                           for col in clean_raw_orgs.RAW_SECTIONS})
+
+        with metrics.timer("clean.row"):
+            record = clean_raw_orgs.clean_row(row)
+        with metrics.timer("clean.write"):
+            clean_raw_orgs.clean_org_to_db(*record, db=db,
+                                           contact_cache=contact_ids)
+
+        n_written += 1
+        if n_written == 1:
+            metrics.observe("pipeline.first_row", time.perf_counter() - started)
+        if n_written % commit_every == 0:
+            db.conn.commit()
+            logger.info("Wrote {0} clean organizations".format(n_written))
+
+    db.conn.commit()
+    return n_written
+
+
+def run(subjects=None, limit=None, keep_raw=False, session=None, db=None):
+    """Crawl subjects and write clean organizations as they arrive.
+
+    session and db default to a logged-in YIO session and the configured
+    database; limit stops after that many listed organizations.
+    """
+    subjects = subjects or scrape_yio.SUBJECTS
+    own_db = db is None
+    db = db or DB()
+    session = session or YIO().s
+
+    clean_raw_orgs.prepare_db(db)
+    db.ensure_tables(delta_crawl.DELTA_TABLES)
+
+    listed = threaded(islice(list_orgs(session, subjects), limit), "listed")
+    fetched = threaded(fetch_orgs(session, listed), "fetched")
+    parsed = threaded(split_orgs(fetched), "parsed")
+
+    try:
+        with metrics.timer("pipeline.run"):
+            n_written = write_orgs(db, parsed, keep_raw=keep_raw)
+    finally:
+        parsed.close()
+        if own_db:
+            db.close()
+
+    logger.info("Streamed {0} organizations".format(n_written))
+    metrics.dump("pipeline")
+    return n_written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crawl, parse and clean "
+                                     "organizations in one streaming pass.")
+    parser.add_argument("--subjects", nargs="+", choices=scrape_yio.SUBJECTS,
+                        help="default: all of them")
+    parser.add_argument("--limit", type=int,
+                        help="stop after this many listed organizations")
+    parser.add_argument("--keep-raw", action="store_true",
+                        help="also save the page sections in organizations_raw")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    run(subjects=args.subjects, limit=args.limit, keep_raw=args.keep_raw)
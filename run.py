@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Common command line runner for the pipeline entry points, with optional
+# profiling, so nobody has to hand-edit __main__ blocks to find out why a
+# batch got slow:
+#
+#   python run.py clean_rows --profile --trace-memory --sample 500
+#
+# Reports (and the run's metrics dump) go to a timestamped directory in
+# config.PROFILE_DIR:
+#
+#   profile.pstats   raw cProfile stats, for snakeviz / pstats
+#   profile.txt      top functions by cumulative and internal time
+#   memory.txt       top allocating lines from tracemalloc
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+
+# Full modules
+import argparse
+import cProfile
+import importlib
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+# Just parts of modules
+from datetime import datetime
+
+# Start log
+logger = logging.getLogger(__name__)
+
+# name: (module, function, keyword that takes --sample)
+# Modules are imported only when needed, so running clean_rows doesn't
+# require Selenium
+ENTRY_POINTS = {
+    "scrape_subjects": ("scrape_yio", "scrape_subjects", "limit"),
+    "scrape_org": ("scrape_yio", "scrape_org", "limit"),
+    "parse_manual_orgs": ("scrape_yio", "parse_manual_orgs", "limit"),
+    "get_raw_html": ("manual_copy_paste", "get_raw_html", "num_orgs"),
+    "clean_rows": ("clean_raw_orgs", "clean_rows", "limit"),
+    "delta_crawl": ("delta_crawl", "run", "limit"),
+    "pipeline": ("pipeline", "run", "limit"),
+}
+
+
+def report_dir(entry_point):
+    path = os.path.join(getattr(config, "PROFILE_DIR", "profiles"), "{0}-{1}".format(
+        datetime.now().strftime("%Y%m%d-%H%M%S"), entry_point))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_profile(profiler, path, top=40):
+    profiler.dump_stats(os.path.join(path, "profile.pstats"))
+
+    with open(os.path.join(path, "profile.txt"), "w") as f:
+        stats = pstats.Stats(profiler, stream=f).strip_dirs()
+        f.write("Top {0} by cumulative time\n".format(top))
+        stats.sort_stats("cumulative").print_stats(top)
+        f.write("\nTop {0} by internal time\n".format(top))
+        stats.sort_stats("tottime").print_stats(top)
+
+
+def write_memory(snapshot, peak, path, top=25):
+    with open(os.path.join(path, "memory.txt"), "w") as f:
+        f.write("Peak traced memory: {0:.1f} MB\n\n".format(peak / 1024 ** 2))
+        f.write("Top {0} allocating lines\n".format(top))
+        for stat in snapshot.statistics("lineno")[:top]:
+            f.write("{0}\n".format(stat))
+
+
+def run(entry_point, profile=False, trace_memory=False, sample=None):
+    module_name, function_name, sample_kwarg = ENTRY_POINTS[entry_point]
+    function = getattr(importlib.import_module(module_name), function_name)
+
+    kwargs = {}
+    if sample is not None:
+        kwargs[sample_kwarg] = sample
+
+    path = report_dir(entry_point)
+    config.METRICS_DIR = path  # Keep the metrics dump with the reports
+
+    logger.info("Running {0}({1}), reports in {2}".format(
+        function_name, kwargs or "", path))
+
+    if trace_memory:
+        tracemalloc.start(25)
+    profiler = cProfile.Profile() if profile else None
+
+    start = time.perf_counter()
+    try:
+        if profiler:
+            profiler.runcall(function, **kwargs)
+        else:
+            function(**kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+
+        # Snapshot memory before the profile report allocates anything
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            write_memory(tracemalloc.take_snapshot(), peak, path)
+            tracemalloc.stop()
+        if profiler:
+            write_profile(profiler, path)
+
+        logger.info("{0} finished in {1:.2f} seconds".format(entry_point,
+                                                             elapsed))
+
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a pipeline entry point, "
+                                     "optionally with profiling.")
+    parser.add_argument("entry_point", choices=sorted(ENTRY_POINTS))
+    parser.add_argument("--profile", action="store_true",
+                        help="record a cProfile report")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the top allocators with tracemalloc")
+    parser.add_argument("--sample", type=int, metavar="N",
+                        help="only run on the first N rows")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    if args.profile and args.trace_memory:
+        logger.warning("tracemalloc slows everything down; "
+                       "profile timings will be inflated.")
+
+    run(args.entry_point, profile=args.profile,
+        trace_memory=args.trace_memory, sample=args.sample)
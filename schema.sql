@@ -18,6 +18,95 @@ CREATE TABLE organizations (
 );
 CREATE UNIQUE INDEX org_url_index ON organizations (org_url_id);
 
+-- Raw rows waiting to be cleaned: each organization's page sections (from
+-- organizations_raw or organizations_raw_requests) with its listing row.
+-- This replaced a UNION ALL view that returned a row from each raw table
+-- (requests row first) for an organization in both. There is now one row
+-- per organization, and the organizations_raw row wins.
+-- DB.insert_dict copies a raw row in here as soon as it's written, so
+-- clean_rows reads this table by id_org instead of joining everything.
+-- DB.add_raw_columns adds a column here too for any section heading not
+-- listed below.
+CREATE TABLE clean_me_full (
+  id_org integer PRIMARY KEY,
+  org_name_t text NOT NULL,
+  org_name_full text,
+  org_acronym_t text,
+  org_founded_t text,
+  org_city_hq_t text,
+  org_country_hq_t text,
+  org_type_i_t text,
+  org_type_ii_t text,
+  org_type_iii_t text,
+  org_uia_id_t text,
+  org_url text NOT NULL,
+  org_url_id text NOT NULL,
+  org_subject_t text NOT NULL,
+  org_name text,
+  type_i_classification text,
+  contact_details text,
+  members text,
+  last_news_received text,
+  events text,
+  structure text,
+  history text,
+  activities text,
+  financing text,
+  relations_with_inter_governmental_organizations text,
+  consultative_status text,
+  aims text,
+  publications text,
+  relations_with_non_governmental_organizations text,
+  staff text,
+  subjects text,
+  type_ii_classification text,
+  languages text,
+  information_services text,
+  FOREIGN KEY (id_org) REFERENCES organizations (id_org) ON DELETE CASCADE
+);
+
+-- Delta crawls (delta_crawl.py): a fingerprint of each organization's
+-- listing row as last seen, and the organizations whose detail pages need
+-- (re)fetching because they're new or their listing row changed
+CREATE TABLE listing_fingerprints (
+  fk_org integer PRIMARY KEY,
+  fingerprint text NOT NULL,
+  first_seen text NOT NULL,
+  last_seen text NOT NULL,
+  last_changed text NOT NULL,
+  FOREIGN KEY (fk_org) REFERENCES organizations (id_org) ON DELETE CASCADE
+);
+
+CREATE TABLE fetch_queue (
+  fk_org integer PRIMARY KEY,
+  reason text NOT NULL,
+  queued text NOT NULL,
+  FOREIGN KEY (fk_org) REFERENCES organizations (id_org) ON DELETE CASCADE
+);
+
+-- Saved organization pages (page_store.py), instead of whole pages in
+-- data_raw. page_blobs holds each distinct #content fragment and each
+-- distinct site chrome (the page around #content, with the title taken out)
+-- once, keyed by SHA-1. A capture points at one of each, and a capture with
+-- the same content as the organization's last one isn't saved.
+CREATE TABLE page_blobs (
+  blob_hash text PRIMARY KEY,
+  body text NOT NULL
+);
+
+CREATE TABLE page_captures (
+  id_capture integer PRIMARY KEY,
+  fk_org integer NOT NULL,
+  content_hash text NOT NULL,
+  chrome_hash text,
+  title text,
+  page_bytes integer NOT NULL,
+  captured text NOT NULL,
+  FOREIGN KEY (content_hash) REFERENCES page_blobs (blob_hash),
+  FOREIGN KEY (chrome_hash) REFERENCES page_blobs (blob_hash)
+);
+CREATE INDEX page_captures_index ON page_captures (fk_org);
+
 
 -- Final tables
 CREATE TABLE organizations_final (
@@ -54,6 +143,17 @@ CREATE TABLE organizations_final (
 );
 CREATE UNIQUE INDEX org_url_index_final ON organizations_final (url_id);
 
+-- Full-text index of the cleaned text, with HTML tags removed.
+-- rowid is organizations_final.id_org, and clean_org_to_db adds each new row.
+CREATE VIRTUAL TABLE organizations_fts USING fts5(
+  history,
+  aims,
+  activities,
+  events,
+  publications,
+  tokenize = 'porter unicode61 remove_diacritics 2'
+);
+
 CREATE TABLE subjects (
   id_subject integer PRIMARY KEY,
   subject_name text NOT NULL,
@@ -71,11 +171,13 @@ CREATE TABLE orgs_subjects (
 
 CREATE TABLE contacts (
   id_contact integer PRIMARY KEY,
+  contact_hash text NOT NULL,
   contact_details text,
   contact_phone text,
   contact_fax text,
   contact_email text
 );
+CREATE UNIQUE INDEX contact_hash_index ON contacts (contact_hash);
 
 CREATE TABLE orgs_contacts (
   fk_org integer NOT NULL,
@@ -86,6 +188,54 @@ CREATE TABLE orgs_contacts (
 );
 
 
+-- Structured lists from the members, relations and languages sections
+CREATE TABLE orgs_members (
+  fk_org integer NOT NULL,
+  member_heading text,
+  member_region text,
+  member_name text NOT NULL,
+  member_url text,
+  FOREIGN KEY (fk_org) REFERENCES organizations (id_org) ON DELETE CASCADE
+);
+CREATE INDEX orgs_members_index ON orgs_members (fk_org);
+
+-- The "Members in N countries on M continents." sentences of the members
+-- section, with the counts parsed out
+CREATE TABLE orgs_members_summary (
+  fk_org integer PRIMARY KEY,
+  member_summary text,
+  member_countries integer,
+  member_continents integer,
+  FOREIGN KEY (fk_org) REFERENCES organizations (id_org) ON DELETE CASCADE
+);
+
+-- relation_type is igo, ngo or consultative
+CREATE TABLE orgs_relations (
+  fk_org integer NOT NULL,
+  relation_type text NOT NULL,
+  relation_heading text,
+  related_name text NOT NULL,
+  related_url text,
+  relation_note text,
+  FOREIGN KEY (fk_org) REFERENCES organizations (id_org) ON DELETE CASCADE
+);
+CREATE INDEX orgs_relations_index ON orgs_relations (fk_org);
+
+CREATE TABLE languages (
+  id_language integer PRIMARY KEY,
+  language_name text NOT NULL
+);
+CREATE UNIQUE INDEX language_index ON languages (language_name);
+
+CREATE TABLE orgs_languages (
+  fk_org integer NOT NULL,
+  fk_language integer NOT NULL,
+  FOREIGN KEY (fk_org) REFERENCES organizations (id_org) ON DELETE CASCADE,
+  FOREIGN KEY (fk_language) REFERENCES languages (id_language) ON DELETE CASCADE,
+  PRIMARY KEY(fk_org, fk_language)
+);
+
+
 -- Types
 CREATE TABLE type_i (
   id_type_i integer PRIMARY KEY NOT NULL,
@@ -180,3 +330,34 @@ INSERT INTO "type_iii" VALUES(39,'Treaties');
 INSERT INTO "type_iii" VALUES(40,'UNESCO Bodies');
 INSERT INTO "type_iii" VALUES(41,'United Nations Bodies');
 INSERT INTO "type_iii" VALUES(42,'WHO Bodies');
+
+
+-- Normalized columns (normalize.py), rebuilt from organizations_final in
+-- one pass: the year founded as a number, and the HQ country and type codes
+-- as keys into the lookup tables. Organizations can have several type II
+-- codes, so those go in orgs_type_ii.
+CREATE TABLE countries (
+  id_country integer PRIMARY KEY,
+  country_name text NOT NULL
+);
+CREATE UNIQUE INDEX country_index ON countries (country_name);
+
+CREATE TABLE organizations_normalized (
+  id_org integer PRIMARY KEY,
+  founded_year integer,
+  fk_country_hq integer,
+  fk_type_i integer,
+  fk_type_iii integer,
+  FOREIGN KEY (id_org) REFERENCES organizations_final (id_org) ON DELETE CASCADE,
+  FOREIGN KEY (fk_country_hq) REFERENCES countries (id_country),
+  FOREIGN KEY (fk_type_i) REFERENCES type_i (id_type_i),
+  FOREIGN KEY (fk_type_iii) REFERENCES type_iii (id_type_iii)
+);
+
+CREATE TABLE orgs_type_ii (
+  fk_org integer NOT NULL,
+  fk_type_ii integer NOT NULL,
+  FOREIGN KEY (fk_org) REFERENCES organizations_final (id_org) ON DELETE CASCADE,
+  FOREIGN KEY (fk_type_ii) REFERENCES type_ii (id_type_ii),
+  PRIMARY KEY(fk_org, fk_type_ii)
+);
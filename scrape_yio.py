@@ -5,24 +5,28 @@
 # --------------
 # My modules
 import config
-from yio import YIO, DB
+import metrics
+import page_store
+import throttle
+from yio import YIO, DB, logged_out
 
 # Pip-installed modules
 import logging
 import re
-import requests
 
 # Just parts of modules
 from bs4 import BeautifulSoup
 from collections import namedtuple
-from random import choice
-from time import sleep
+from time import perf_counter
 
 from pprint import pprint
 
 # Start log
 logger = logging.getLogger(__name__)
 
+# Subjects to scrape, in order
+SUBJECTS = ["Censorship", "Journalism", "Media", "Education"]
+
 
 # Useful functions
 def namify(heading_name):
@@ -41,6 +45,127 @@ def subject_url(subject, page=None):
     return(config.BASE_URL + url)
 
 
+class FetchError(Exception):
+    """A page still came back 429/5xx after all of fetch()'s retries"""
+    pass
+
+
+def fetch(session, url, pacer=None):
+    """Get a page with an existing session, recording latency and size.
+
+    Requests are paced by pacer (default: the shared throttle.controller),
+    and 429/5xx responses are retried up to config.THROTTLE_RETRIES times
+    after it backs off. Raises FetchError if the last try fails too, rather
+    than returning the error page.
+    """
+    pacer = pacer or throttle.controller
+    retries = getattr(config, "THROTTLE_RETRIES",
+                      throttle.DEFAULTS["THROTTLE_RETRIES"])
+
+    for attempt in range(retries + 1):
+        with pacer.slot():
+            start = perf_counter()
+            try:
+                response = session.get(url)
+            except Exception:
+                pacer.record(perf_counter() - start, status=None)
+                raise
+            latency = perf_counter() - start
+
+        metrics.observe("http.latency", latency)
+        metrics.incr("http.requests")
+        metrics.incr("http.bytes", len(response.content))
+        if response.status_code != 200:
+            metrics.incr("http.errors")
+
+        expired = logged_out(response.text)
+        pacer.record(latency, response.status_code, logged_out=expired,
+                     pause=throttle.retry_after(response))
+
+        # Stop here rather than failing to parse every page from now on
+        if expired:
+            metrics.incr("http.logged_out")
+            raise RuntimeError("Got the login page for {0}; the YIO session "
+                               "has expired. Run again to log in.".format(url))
+
+        if not throttle.congested(response.status_code):
+            break
+        if attempt < retries:
+            logger.info("HTTP {0} for {1}; retrying"
+                        .format(response.status_code, url))
+            metrics.incr("http.retries")
+    else:
+        metrics.incr("http.gave_up")
+        raise FetchError("HTTP {0} for {1} after {2} tries"
+                         .format(response.status_code, url,
+                                 retries + 1))
+
+    return response.text
+
+
+def split_sections(page):
+    """Split an organization page into {'org_name': ..., section: html}.
+
+    Raises IndexError or AttributeError if the page has no #content or <h1>
+    (i.e. it isn't an organization page).
+    """
+    soup = BeautifulSoup(page)
+
+    # Select just the main content section
+    content = soup.select("#content")[0]
+
+    # Get rid of embedded Javascript
+    [tag.extract() for tag in content.findAll("script")]
+
+    # Get organization name
+    org_name = clean_text(content.find("h1").get_text())
+
+    # Find all H2s, since the page is structured like so:
+    #   <h2></h2>
+    #   <p></p>
+    #   <h2></h2>
+    #   <p></p>
+    #   etc.
+    headings = content.findAll("h2")
+
+    # Initialize dictionary to be saved to the database
+    raw_data = {}
+    raw_data['org_name'] = org_name
+
+    # Loop through each heading, move along each sibling until coming to a H2
+    for heading in headings:
+        raw_section = []  # Track the parts of the section
+        for sibling in heading.next_siblings:
+            if sibling.name == "h2":
+                break  # Stop, since we're in a new section
+            else:
+                if sibling != "\n":
+                    raw_section.append(str(sibling))  # Add to section
+
+        # Save the section to the dictionary
+        raw_data[namify(heading.get_text())] = '\n'.join(raw_section)
+
+    return raw_data
+
+
+def parse_listing(page):
+    """Listing rows on a subject page and the URL of the next page (or None)"""
+    soup = BeautifulSoup(page)
+    table = soup.select(".view-yearbook-working .views-table")[0]
+    rows = [extract_from_row(org) for org in table.select("tr")[1:]]
+
+    # Check if there's a next page
+    pager = soup.select(".view-yearbook-working .pager")[0]
+    next_page_raw = pager.select(".pager-next")
+
+    if len(next_page_raw) > 0:
+        next_page = config.BASE_URL + next_page_raw[0].select("a")[0]['href']
+    else:
+        next_page = None
+
+    return rows, next_page
+
+
 # Scraping functions
 def parse_individual_org(session, org, db):
     # Hacky thing. Ordinarily, this takes an existing YIO session object and
@@ -49,53 +174,29 @@ def parse_individual_org(session, org, db):
     # rows, I have all the organzation content saved as HTML in the data_raw
     # table. So instead of getting a URL, if the session parameter is empty,
     # this will just start parsing the pre-saved HTML.
-    if type(session) is requests.sessions.Session:
+    if session is not None:
         print("This is a session object.")
         logger.info("Getting organization details from {0}".format(org.url))
-        page = session.get(org.url).text
+        try:
+            page = fetch(session, org.url)
+        except FetchError as e:
+            # No organizations_raw row, so the next run tries it again
+            logger.warning("{0}: row {1}".format(e, org.id_org))
+            metrics.incr("orgs.failed")
+            return
     else:
-        logger.info("Using existing HTML for {0}".format(org.id_org))
+        logger.info("Using existing HTML for {0}".format(org.id_org),
+                    extra={"aggregate": "Used existing HTML for {0} organizations."})
         page = org.org_html
 
-    soup = BeautifulSoup(page)
+    parse_start = perf_counter()
 
-    # Select just the main content section
     try:
-        content = soup.select("#content")[0]
-
-        # Get rid of embedded Javascript
-        [tag.extract() for tag in content.findAll("script")]
-
-        # Get organization name
-        org_name = clean_text(content.find("h1").get_text())
-
-        # Find all H2s, since the page is structured like so:
-        #   <h2></h2>
-        #   <p></p>
-        #   <h2></h2>
-        #   <p></p>
-        #   etc.
-        headings = content.findAll("h2")
-
-        # Initialize dictionary to be saved to the database
-        raw_data = {}
+        raw_data = split_sections(page)
         raw_data['fk_org'] = org.id_org
-        raw_data['org_name'] = org_name
-
-        # Loop through each heading, move along each sibling until coming to a H2
-        for heading in headings:
-            raw_section = []  # Track the parts of the section
-            for sibling in heading.next_siblings:
-                if sibling.name == "h2":
-                    break  # Stop, since we're in a new section
-                else:
-                    if sibling != "\n":
-                        raw_section.append(str(sibling))  # Add to section
-
-            # Save the section to the dictionary
-            raw_data[namify(heading.get_text())] = '\n'.join(raw_section)
 
         # pprint(raw_data)
+        metrics.observe("parse.org_page", perf_counter() - parse_start)
 
         # This is tremendously hacky, but I have no idea which sections the YIO
         # uses---they change depending on the organization. So, this
@@ -105,10 +206,12 @@ def parse_individual_org(session, org, db):
         db.add_raw_columns(colnames)
 
         db.insert_dict(raw_data, table="organizations_raw")
+        metrics.incr("orgs.parsed")
     except Exception as e:
         message = "{0} ({1}): row {2}\n".format(e.__class__.__name__,
                                                 e, org.id_org)
         logger.warning(message)
+        metrics.incr("orgs.failed")
 
         with open("borked.txt", "a") as myfile:
             myfile.write(message)
@@ -118,38 +221,26 @@ def parse_individual_org(session, org, db):
 
 def parse_subject_page(session, url, subject, db):
     logger.info("Parsing organizations listed at {0}".format(url))
-    page = session.get(url).text
-    soup = BeautifulSoup(page)
-    table = soup.select(".view-yearbook-working .views-table")[0]
+    page = fetch(session, url)
+
+    with metrics.timer("parse.listing_page"):
+        rows, next_page = parse_listing(page)
 
     # Loop through each row in the table and add it to the database
-    for org in table.select("tr")[1:]:
-        org_details = extract_from_row(org)
+    for org_details in rows:
         org_details['org_subject_t'] = subject
 
         logger.info("Dealing with {0} ({1})."
-                    .format(org_details['org_name'],
-                            org_details['org_url_id']))
+                    .format(org_details['org_name_t'],
+                            org_details['org_url_id']),
+                    extra={"aggregate": "Dealt with {0} listed organizations."})
 
         # db.insert_org_basic(org_details)
         db.insert_dict(org_details, table="organizations")
 
-    # Check if there's a next page
-    pager = soup.select(".view-yearbook-working .pager")[0]
-    next_page_raw = pager.select(".pager-next")
-
-    if len(next_page_raw) > 0:
-        next_page = config.BASE_URL + next_page_raw[0].select("a")[0]['href']
-    else:
-        next_page = None
-
     # Recursively get and parse the next page
     if next_page is not None:
         logger.info("There's another page. Parse it.")
-
-        wait = choice(config.wait_time)
-        logger.info("Waiting for {0} seconds before moving on".format(wait))
-        sleep(wait)
         parse_subject_page(session, next_page, subject, db)
 
 
@@ -159,7 +250,7 @@ def extract_from_row(org):
     org_raw = org.select("td")
 
     # Parse name and URL information
-    org_details['org_name'] = clean_text(org_raw[0].get_text())
+    org_details['org_name_t'] = clean_text(org_raw[0].get_text())
     org_details['org_url'] = clean_text(org_raw[0].select("a")[0]['href'])
     org_details['org_url_id'] = re.search(r"/(\d+)$",
                                           org_details['org_url']).group(1)
@@ -182,26 +273,25 @@ def extract_from_row(org):
     return(org_details)
 
 
-def parse_manual_orgs():
+def parse_manual_orgs(limit=None):
     ManualOrg = namedtuple('ManualOrg', ['id_org', 'org_html'])
 
     db = DB()
-    db.add_factory(factory=ManualOrg)
+    page_store.prepare_db(db)
 
-    db.c.execute("SELECT fk_org, org_html FROM data_raw")
-
-    orgs = db.c.fetchall()
-
-    db.add_factory(None)  # Clear custom factory
+    # Just the #content of pages in the page store, whole pages from data_raw
+    orgs = [ManualOrg(*row) for row in page_store.saved_pages(db, limit)]
 
     for org in orgs:
         parse_individual_org(None, org, db)
 
+    metrics.dump("parse_manual_orgs")
+
 
 # ------------
 # Run script
 # ------------
-def scrape_subjects():
+def scrape_subjects(limit=1):
     """Run actual script."""
 
     # Open database and log into YIO
@@ -210,23 +300,20 @@ def scrape_subjects():
 
     # First page of the subject
     subject_page = namedtuple('SubjectPage', ['name', 'url'])
-    subjects = [
-        subject_page(name="Censorship", url=subject_url("Censorship")),
-        subject_page(name="Journalism", url=subject_url("Journalism")),
-        subject_page(name="Media", url=subject_url("Media")),
-        subject_page(name="Education", url=subject_url("Education"))
-    ]
-
-    for subject in subjects[:1]:
+    subjects = [subject_page(name=subject, url=subject_url(subject))
+                for subject in SUBJECTS]
+
+    for subject in subjects[:limit]:
         logger.info("Beginning to parse the {0} subject ({1})"
                     .format(subject.name, subject.url))
         parse_subject_page(yio, subject.url, subject.name, db)
 
     # Close everything up
     db.close()
+    metrics.dump("scrape_subjects")
 
 
-def scrape_org():
+def scrape_org(limit=1):
     OrgPage = namedtuple('OrgPage', ['id_org', 'name', 'url'])
 
     # Open database and log into YIO
@@ -234,20 +321,22 @@ def scrape_org():
     db.add_factory(factory=OrgPage)
     yio = YIO().s
 
-    db.c.execute("SELECT id_org, org_name, org_url FROM organizations")
+    db.c.execute("SELECT id_org, org_name_t, org_url FROM organizations")
 
     orgs = db.c.fetchall()
 
     db.add_factory(None)  # Clear custom factory
-    for org in orgs[0:1]:
-        wait = choice(config.wait_time)
-        logger.info("Waiting for {0} seconds before moving on".format(wait))
-        sleep(wait)
+    for org in orgs[0:limit]:
         logger.info("Parsing details for ({1}) {0}".format(org.name, org.id_org))
         parse_individual_org(yio, org, db)
 
+    metrics.dump("scrape_org")
+
 
 if __name__ == '__main__':
+    import logutil
+    logutil.setup_logging()
+
     # scrape_subjects()
     # scrape_org()
     parse_manual_orgs()
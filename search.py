@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Full-text search over the cleaned organization text.
+#
+# organizations_fts (defined in schema.sql) is an FTS5 index of the history,
+# aims, activities, events and publications columns of organizations_final,
+# with HTML tags stripped. clean_org_to_db adds each organization as it's
+# written; ensure_index() creates and backfills it for older databases.
+#
+#   python search.py "press freedom"
+#   python search.py --benchmark          # FTS vs LIKE scans
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+from yio import DB
+
+# Full modules
+import argparse
+import logging
+import re
+import statistics
+import time
+
+# Just parts of modules
+from html import unescape
+
+# Start log
+logger = logging.getLogger(__name__)
+
+FTS_COLUMNS = ["history", "aims", "activities", "events", "publications"]
+
+# bm25 weights, in FTS_COLUMNS order: aims and history say the most about
+# what an organization is
+FTS_WEIGHTS = [2.0, 3.0, 1.0, 0.5, 0.5]
+
+BENCHMARK_QUERIES = ["journalism", "press freedom", "censorship", "teachers",
+                     "human rights", "broadcasting"]
+
+tag_pattern = re.compile(r"<[^>]+>")
+
+
+def strip_html(text):
+    if not text:
+        return text
+    return unescape(tag_pattern.sub("", text))
+
+
+def ensure_index(db):
+    """Create organizations_fts from schema.sql and fill it if it's missing"""
+    exists = db.c.execute("""SELECT 1 FROM sqlite_master
+                             WHERE name = 'organizations_fts'""").fetchone()
+    if exists:
+        return
+
+    logger.info("Creating full-text index")
+    commands = open("schema.sql", "r").read().split(";")
+    db.c.execute([command for command in commands
+                  if "organizations_fts" in command][0])
+    rebuild(db)
+
+
+def rebuild(db):
+    """Re-index every row of organizations_final"""
+    db.c.execute("DELETE FROM organizations_fts")
+
+    rows = db.conn.execute("SELECT id_org, {0} FROM organizations_final"
+                           .format(", ".join(FTS_COLUMNS)))
+    db.c.executemany("""INSERT INTO organizations_fts (rowid, {0})
+                        VALUES (?, {1})"""
+                     .format(", ".join(FTS_COLUMNS),
+                             ", ".join("?" for _ in FTS_COLUMNS)),
+                     ([row[0]] + [strip_html(text) for text in row[1:]]
+                      for row in rows))
+    db.conn.commit()
+    logger.info("Indexed {0} organizations".format(
+        db.c.execute("SELECT COUNT(*) FROM organizations_fts").fetchone()[0]))
+
+
+def index_org(db, clean):
+    """Add one CleanOrg to the index (called by clean_org_to_db)"""
+    db.c.execute("""INSERT OR REPLACE INTO organizations_fts (rowid, {0})
+                    VALUES (?, {1})"""
+                 .format(", ".join(FTS_COLUMNS),
+                         ", ".join("?" for _ in FTS_COLUMNS)),
+                 [clean.id_org] + [strip_html(getattr(clean, col))
+                                   for col in FTS_COLUMNS])
+
+
+def search(db, query, limit=20):
+    """Ranked matches for an FTS5 query, with a highlighted snippet.
+
+    Returns (id_org, org_name, score, snippet) tuples, best first.
+    """
+    sql = """SELECT organizations_final.id_org, organizations_final.org_name,
+                    bm25(organizations_fts, {0}) AS score,
+                    snippet(organizations_fts, -1, '[', ']', '...', 12)
+             FROM organizations_fts
+             INNER JOIN organizations_final
+               ON organizations_final.id_org = organizations_fts.rowid
+             WHERE organizations_fts MATCH ?
+             ORDER BY score
+             LIMIT ?""".format(", ".join(str(w) for w in FTS_WEIGHTS))
+    return db.c.execute(sql, (query, limit)).fetchall()
+
+
+def like_search(db, query, limit=20):
+    """The old way: a LIKE scan over every text column"""
+    where = " OR ".join("{0} LIKE ?".format(col) for col in FTS_COLUMNS)
+    sql = """SELECT id_org, org_name FROM organizations_final
+             WHERE {0} LIMIT ?""".format(where)
+    pattern = "%{0}%".format(query)
+    return db.c.execute(sql, [pattern] * len(FTS_COLUMNS) + [limit]).fetchall()
+
+
+def benchmark(db, queries=BENCHMARK_QUERIES, repeat=5, limit=20):
+    """Median latency of a ranked FTS query (top `limit`, with snippets)
+    against the LIKE scan it replaces, in milliseconds. LIKE can't rank, so
+    it has to read every matching row to offer the same thing.
+    """
+    n_orgs = db.c.execute("SELECT COUNT(*) FROM organizations_final").fetchone()[0]
+    print("{0} organizations; median of {1} runs".format(n_orgs, repeat))
+    print("  {0:<16} {1:>12} {2:>12} {3:>10}"
+          .format("query", "fts top ms", "like ms", "like rows"))
+
+    for query in queries:
+        timings = {"fts": [], "like": []}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            search(db, '"{0}"'.format(query), limit=limit)
+            timings["fts"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            like_hits = like_search(db, query, limit=-1)
+            timings["like"].append(time.perf_counter() - start)
+
+        print("  {0:<16} {1:>12.2f} {2:>12.2f} {3:>10}"
+              .format(query, statistics.median(timings["fts"]) * 1000,
+                      statistics.median(timings["like"]) * 1000,
+                      len(like_hits)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Search cleaned "
+                                     "organization text.")
+    parser.add_argument("query", nargs="?", help="FTS5 query")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--rebuild", action="store_true",
+                        help="re-index organizations_final from scratch")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare FTS and LIKE query latency")
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    db = DB()
+    ensure_index(db)
+
+    if args.rebuild:
+        rebuild(db)
+    if args.benchmark:
+        benchmark(db)
+    if args.query:
+        for id_org, org_name, score, snippet in search(db, args.query,
+                                                      args.limit):
+            print("{0:>8}  {1:6.2f}  {2}\n          {3}"
+                  .format(id_org, -score, org_name, snippet))
+
+    db.close()
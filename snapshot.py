@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Read-only snapshots of the database for analysis.
+#
+# The R export and ad-hoc queries used to open data/yio.db while the
+# scrapers and clean_rows were writing to it, so they waited on each
+# other's locks and every query started from a cold cache. snapshot()
+# copies the database with SQLite's online backup API (safe while it's
+# being written), then, on the copy:
+#
+#   - drops the scraping tables analysis never reads (unless full=True)
+#   - adds covering indexes for the usual joins (SNAPSHOT_INDEXES)
+#   - VACUUMs and ANALYZEs it
+#
+# and moves it into place read-only at config.SNAPSHOT_FILE. Snapshot()
+# opens it with immutable=1, so SQLite takes no locks and never checks for
+# changes, and memory-maps it (config.SNAPSHOT_MMAP_SIZE). A new snapshot
+# replaces the file rather than rewriting it, so connections already open
+# keep reading the old one.
+#
+#   python snapshot.py               # make a new snapshot
+#   python snapshot.py --benchmark   # query latency, live database vs snapshot
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import export_final
+
+# Full modules
+import argparse
+import logging
+import os
+import sqlite3
+import statistics
+import threading
+import time
+
+# Start log
+logger = logging.getLogger(__name__)
+
+# Tables the scrapers and cleaner need but analysis doesn't
+SCRAPING_TABLES = ["data_raw", "organizations_raw", "organizations_raw_requests",
+                   "clean_me_full", "page_blobs", "page_captures",
+                   "listing_fingerprints", "fetch_queue"]
+
+# (table, index). The junction tables' primary keys already cover going
+# from an organization to its subjects, contacts or languages; these cover
+# the other direction, and export_final's type filter.
+SNAPSHOT_INDEXES = [
+    ("orgs_subjects", "CREATE INDEX IF NOT EXISTS orgs_subjects_by_subject "
+                      "ON orgs_subjects (fk_subject, fk_org)"),
+    ("orgs_contacts", "CREATE INDEX IF NOT EXISTS orgs_contacts_by_contact "
+                      "ON orgs_contacts (fk_contact, fk_org)"),
+    ("orgs_languages", "CREATE INDEX IF NOT EXISTS orgs_languages_by_language "
+                       "ON orgs_languages (fk_language, fk_org)"),
+    ("organizations_final", "CREATE INDEX IF NOT EXISTS organizations_final_types "
+                            "ON organizations_final (type_i_dir, type_iii_dir, "
+                            "type_ii_dir, id_org)"),
+]
+
+# Pages copied per step of the backup. The source is only locked during a
+# step, so writers get a look in between.
+BACKUP_STEP = 4096
+
+BENCHMARK_QUERIES = [
+    ("orgs per subject",
+     """SELECT subject_name, subject_parent, COUNT(*) FROM subjects
+        INNER JOIN orgs_subjects ON fk_subject = id_subject
+        GROUP BY id_subject""", ()),
+    ("orgs in a subject",
+     """SELECT organizations_final.id_org, org_name FROM subjects
+        INNER JOIN orgs_subjects ON fk_subject = id_subject
+        INNER JOIN organizations_final
+          ON organizations_final.id_org = orgs_subjects.fk_org
+        WHERE subject_name = (SELECT subject_name FROM subjects
+                              ORDER BY id_subject LIMIT 1)""", ()),
+    ("shared contacts",
+     """SELECT contacts.id_contact, contact_email, COUNT(*) AS n_orgs
+        FROM orgs_contacts
+        INNER JOIN contacts ON contacts.id_contact = orgs_contacts.fk_contact
+        GROUP BY orgs_contacts.fk_contact HAVING n_orgs > 1""", ()),
+    ("orgs sharing a contact",
+     """SELECT fk_org FROM orgs_contacts WHERE fk_contact IN
+        (SELECT fk_contact FROM orgs_contacts GROUP BY fk_contact
+         ORDER BY COUNT(*) DESC LIMIT 10)""", ()),
+]
+
+
+def table_names(conn):
+    return {row[0] for row in
+            conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def snapshot_file():
+    return getattr(config, "SNAPSHOT_FILE", "data/yio_snapshot.db")
+
+
+def snapshot(source=None, destination=None, full=False):
+    """Copy source (default config.DB_FILE) into an optimized, read-only
+    snapshot at destination (default config.SNAPSHOT_FILE)"""
+    source = source or config.DB_FILE
+    destination = destination or snapshot_file()
+    building = destination + ".tmp"
+
+    if os.path.exists(building):
+        os.remove(building)
+
+    start = time.perf_counter()
+    src = sqlite3.connect(source)
+    dest = sqlite3.connect(building)
+    src.backup(dest, pages=BACKUP_STEP)
+    src.close()
+    logger.info("Copied {0} in {1:.1f}s".format(source,
+                                               time.perf_counter() - start))
+
+    existing = table_names(dest)
+    if not full:
+        for table in SCRAPING_TABLES:
+            if table in existing:
+                dest.execute("DROP TABLE {0}".format(table))
+
+    for table, index in SNAPSHOT_INDEXES:
+        if table in existing:
+            dest.execute(index)
+
+    # Nothing will write to it again, so it doesn't need a WAL or journal
+    dest.execute("PRAGMA journal_mode = DELETE")
+    dest.commit()
+    dest.execute("VACUUM")
+    dest.execute("ANALYZE")
+    dest.commit()
+    dest.close()
+
+    os.chmod(building, 0o444)
+    os.replace(building, destination)
+
+    logger.info("Saved a {0:.1f} MB snapshot of {1} ({2:.1f} MB) to {3} in "
+                "{4:.1f}s".format(os.path.getsize(destination) / 1024 ** 2,
+                                  source, os.path.getsize(source) / 1024 ** 2,
+                                  destination, time.perf_counter() - start))
+    return destination
+
+
+class Snapshot():
+    """Read-only connection to a snapshot. Has the conn, c and close() of
+    yio.DB, so functions that take a db (export_final.export_table,
+    search.search) work on it."""
+    def __init__(self, path=None, mmap_size=None):
+        path = path or snapshot_file()
+        if not os.path.isfile(path):
+            raise FileNotFoundError("No snapshot at {0}; run snapshot.py "
+                                    "first".format(path))
+
+        # urllib.request is slow to import, and only needed here
+        from urllib.request import pathname2url
+
+        uri = "file:{0}?mode=ro&immutable=1".format(
+            pathname2url(os.path.abspath(path)))
+        self.conn = sqlite3.connect(uri, uri=True,
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False)
+        self.c = self.conn.cursor()
+        self.c.execute("PRAGMA mmap_size = {0:d}".format(
+            mmap_size if mmap_size is not None
+            else getattr(config, "SNAPSHOT_MMAP_SIZE", 512 * 1024 * 1024)))
+
+    def close(self):
+        self.c.close()
+        self.conn.close()
+
+
+def benchmark_queries():
+    """BENCHMARK_QUERIES plus export_final's queries"""
+    return BENCHMARK_QUERIES + [("export " + table, sql, params) for
+                                table, sql, params in
+                                export_final.export_queries(filtered=True)]
+
+
+def time_query(conn, sql, params, repeat):
+    """(first run, median of the rest) in seconds"""
+    timings = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        timings.append(time.perf_counter() - start)
+    return timings[0], statistics.median(timings[1:])
+
+
+def busy_writer(path, stop):
+    """Keep a write transaction going on the live database, like clean_rows
+    does, without changing anything"""
+    conn = sqlite3.connect(path, timeout=30)
+    ids = [row[0] for row in
+           conn.execute("SELECT id_org FROM organizations_final")]
+    while not stop.is_set():
+        for i in range(0, len(ids), 50):
+            conn.executemany("""UPDATE organizations_final SET org_name = org_name
+                                WHERE id_org = ?""",
+                             ((id_org,) for id_org in ids[i:i + 50]))
+            conn.commit()
+            if stop.is_set():
+                break
+    conn.close()
+
+
+def benchmark(repeat=5):
+    """Latency of analysis queries on the live database (alone, and with a
+    writer busy on it) and on the snapshot, in milliseconds: the first run,
+    then the median of the next `repeat`"""
+    queries = benchmark_queries()
+    results = {}
+
+    live = sqlite3.connect(config.DB_FILE, timeout=30)
+    results["live"] = [time_query(live, sql, params, repeat)
+                       for _, sql, params in queries]
+
+    stop = threading.Event()
+    writer = threading.Thread(target=busy_writer, args=(config.DB_FILE, stop))
+    writer.start()
+    try:
+        results["live+writer"] = [time_query(live, sql, params, repeat)
+                                  for _, sql, params in queries]
+    finally:
+        stop.set()
+        writer.join()
+        live.close()
+
+    snap = Snapshot()
+    results["snapshot"] = [time_query(snap.conn, sql, params, repeat)
+                           for _, sql, params in queries]
+    snap.close()
+
+    print("ms, first run / median of {0}".format(repeat))
+    print("  {0:<26} {1:>17} {2:>17} {3:>17}".format("query", *results))
+    for i, (name, _, _) in enumerate(queries):
+        print("  {0:<26} {1}".format(name, " ".join(
+            "{0:>8.2f} /{1:>7.2f}".format(runs[i][0] * 1000, runs[i][1] * 1000)
+            for runs in results.values())))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Make a read-only, optimized "
+                                     "snapshot of the database for analysis.")
+    parser.add_argument("--full", action="store_true",
+                        help="keep the scraping tables too")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare query latency on the live database and "
+                        "the snapshot (makes a snapshot first if there "
+                        "isn't one)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    import logutil
+    logutil.setup_logging()
+
+    if not args.benchmark or not os.path.isfile(snapshot_file()):
+        snapshot(full=args.full)
+    if args.benchmark:
+        benchmark(repeat=args.repeat)
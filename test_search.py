@@ -0,0 +1,27 @@
+import search
+
+
+def add_final_org(db, id_org, org_name, aims):
+    db.insert_dict({"id_org": id_org, "org_name_t": org_name,
+                    "org_url": "/s/or/en/{0}".format(id_org),
+                    "org_url_id": str(id_org), "org_subject_t": "Media"},
+                   table="organizations")
+    db.c.execute("""INSERT INTO organizations_final
+                    (id_org, org_name, uia_id, url_id, aims)
+                    VALUES (?, ?, ?, ?, ?)""",
+                 (id_org, org_name, str(id_org), str(id_org), aims))
+
+
+def test_search_decodes_entities(db):
+    add_final_org(db, 1, "Press &amp; Media Institute",
+                  "<p>Defends press &amp; media freedom&nbsp;in Africa&#39;s "
+                  "newsrooms.</p>")
+    add_final_org(db, 2, "Teachers Union", "<p>Supports teachers.</p>")
+    search.rebuild(db)
+
+    for entity in ["amp", "nbsp", "39"]:
+        assert search.search(db, entity) == []
+
+    hits = search.search(db, "media")
+    assert [hit[0] for hit in hits] == [1]
+    assert "&" in hits[0][3] and "&amp;" not in hits[0][3]
@@ -0,0 +1,64 @@
+import pytest
+
+from yio import RAW_TABLES
+
+
+def add_org(db, id_org=1):
+    db.insert_dict({"id_org": id_org, "org_name_t": "Org {0}".format(id_org),
+                    "org_url": "/s/or/en/{0}".format(id_org),
+                    "org_url_id": str(id_org), "org_subject_t": "Media"},
+                   table="organizations")
+
+
+def add_raw_tables(db):
+    # organizations_raw_requests only exists in older databases
+    db.c.execute("""CREATE TABLE organizations_raw_requests (
+                      fk_org integer PRIMARY KEY, aims text)""")
+    db.add_raw_columns(["fk_org", "aims"])
+
+
+def rematerialize(db):
+    db.c.execute("DROP TABLE clean_me_full")
+    db.materialize_clean_me()
+    return db.c.execute("SELECT * FROM clean_me_full ORDER BY id_org").fetchall()
+
+
+@pytest.mark.parametrize("order", [RAW_TABLES, RAW_TABLES[::-1]])
+def test_clean_me_prefers_organizations_raw(db, order):
+    add_org(db)
+    add_raw_tables(db)
+
+    for table in order:
+        db.insert_dict({"fk_org": 1, "aims": table}, table=table)
+
+    incremental = db.c.execute("SELECT * FROM clean_me_full").fetchall()
+    assert db.c.execute("SELECT aims FROM clean_me_full").fetchall() == \
+        [("organizations_raw",)]
+    assert rematerialize(db) == incremental
+
+
+def test_clean_me_from_requests_only(db):
+    add_org(db, 1)
+    add_org(db, 2)
+    add_raw_tables(db)
+
+    db.insert_dict({"fk_org": 1, "aims": "requests"},
+                   table="organizations_raw_requests")
+    db.insert_dict({"fk_org": 2, "aims": "raw"}, table="organizations_raw")
+
+    incremental = db.c.execute(
+        "SELECT * FROM clean_me_full ORDER BY id_org").fetchall()
+    assert [row[0] for row in incremental] == [1, 2]
+    assert rematerialize(db) == incremental
+
+
+def test_clean_me_keeps_unlisted_sections(db):
+    add_org(db)
+    sections = {"fk_org": 1, "aims": "Aims", "goals_2030": "Goals"}
+    db.add_raw_columns(sections.keys())
+    db.insert_dict(sections, table="organizations_raw")
+
+    incremental = db.c.execute("SELECT * FROM clean_me_full").fetchall()
+    assert db.c.execute("SELECT goals_2030 FROM clean_me_full").fetchall() == \
+        [("Goals",)]
+    assert rematerialize(db) == incremental
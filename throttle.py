@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------
+# Adaptive request pacing, instead of a fixed random config.wait_time sleep.
+#
+# A Throttle hands out request slots. It limits both how many requests are
+# in flight and how soon one may start after the last, and adjusts both
+# AIMD-style (like TCP congestion control) from what comes back:
+#
+#   clean, fast response   additive increase: concurrency grows by about one
+#                          per round of responses, the interval shrinks by
+#                          THROTTLE_INTERVAL_STEP
+#   429, 5xx, connection   multiplicative decrease: concurrency halves, the
+#   error, login page,     interval doubles (at most once per round trip, so
+#   or latency above       a burst of errors from one round counts once), and
+#   THROTTLE_LATENCY_      Retry-After is honoured
+#   FACTOR x the best seen
+#
+# scrape_yio.fetch goes through the module-level controller (and retries
+# throttled responses), so every scraper shares one view of how the server
+# is doing:
+#
+#   import throttle
+#   with throttle.slot():
+#       start = time.perf_counter()
+#       response = session.get(url)
+#   throttle.record(time.perf_counter() - start, response.status_code)
+# --------------------------------------------------------------------------
+
+# My modules
+import config
+import metrics
+
+# Full modules
+import logging
+import random
+import threading
+import time
+
+# Just parts of modules
+from collections import deque
+from contextlib import contextmanager
+
+# Start log
+logger = logging.getLogger(__name__)
+
+# Concurrency is multiplied and the interval divided by this on a backoff
+DECREASE = 0.5
+
+# Request starts are spread by +/- this fraction of the interval, like the
+# old random wait
+JITTER = 0.25
+
+# The best latency seen drifts up by this much per response, so a lasting
+# slowdown (a busier proxy, a slower route) becomes the new normal instead
+# of counting as congestion forever
+BASELINE_DRIFT = 1.02
+
+# For config.py files copied from before the THROTTLE_* settings existed
+DEFAULTS = {"THROTTLE_INTERVAL": 1.5, "THROTTLE_MIN_INTERVAL": 0.5,
+            "THROTTLE_MAX_INTERVAL": 60, "THROTTLE_INTERVAL_STEP": 0.05,
+            "THROTTLE_MAX_CONCURRENCY": 3, "THROTTLE_LATENCY_FACTOR": 3,
+            "THROTTLE_RETRIES": 3}
+
+
+def congested(status):
+    """Whether an HTTP status means the server wants us to slow down"""
+    return status is None or status == 429 or status >= 500
+
+
+def retry_after(response):
+    """Seconds from a Retry-After header, if it's given in seconds"""
+    value = response.headers.get("Retry-After", "")
+    return float(value) if value.strip().isdigit() else None
+
+
+class Throttle():
+    """AIMD controller for request concurrency and spacing.
+
+    Settings default to the THROTTLE_* values in config; reset() re-reads
+    them and starts over.
+    """
+    def __init__(self, interval=None, min_interval=None, max_interval=None,
+                 max_concurrency=None, latency_factor=None, step=None):
+        self.settings = {"interval": interval, "min_interval": min_interval,
+                         "max_interval": max_interval,
+                         "max_concurrency": max_concurrency,
+                         "latency_factor": latency_factor, "step": step}
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        def setting(name, config_name):
+            value = self.settings[name]
+            if value is not None:
+                return value
+            return getattr(config, config_name, DEFAULTS[config_name])
+
+        with self.condition:
+            self.interval = setting("interval", "THROTTLE_INTERVAL")
+            self.min_interval = setting("min_interval", "THROTTLE_MIN_INTERVAL")
+            self.max_interval = setting("max_interval", "THROTTLE_MAX_INTERVAL")
+            self.max_concurrency = setting("max_concurrency",
+                                           "THROTTLE_MAX_CONCURRENCY")
+            self.latency_factor = setting("latency_factor",
+                                          "THROTTLE_LATENCY_FACTOR")
+            self.step = setting("step", "THROTTLE_INTERVAL_STEP")
+
+            self.concurrency = 1.0
+            self.in_flight = 0
+            self.next_start = 0.0
+            self.paused_until = 0.0
+            self.best_latency = None
+            self.last_backoff = 0.0
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Wait until a request may start, and hold a place while it runs"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = max(self.next_start, self.paused_until) - now
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    break
+                # Woken early by record() or a finished request
+                self.condition.wait(wait if wait > 0 else None)
+
+            self.in_flight += 1
+            self.next_start = now + self.interval * random.uniform(1 - JITTER,
+                                                                   1 + JITTER)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def record(self, latency, status=200, logged_out=False, pause=None):
+        """Adjust to one response: its latency in seconds, HTTP status (None
+        for a connection error), whether it was the login page, and how long
+        the server asked us to wait (Retry-After)"""
+        with self.condition:
+            now = time.monotonic()
+
+            if logged_out:
+                reason = "login page"
+            elif congested(status):
+                reason = "HTTP {0}".format(status) if status else "no response"
+            else:
+                reason = None
+                if self.best_latency is None or latency < self.best_latency:
+                    self.best_latency = latency
+                elif latency > self.best_latency * self.latency_factor:
+                    reason = "{0:.2f}s response".format(latency)
+                else:
+                    self.best_latency *= BASELINE_DRIFT
+
+            if reason is None:
+                self.concurrency = min(self.max_concurrency,
+                                       self.concurrency + 1 / self.concurrency)
+                self.interval = max(self.min_interval, self.interval - self.step)
+            elif now - self.last_backoff > max(latency, self.interval):
+                self.concurrency = max(1.0, self.concurrency * DECREASE)
+                self.interval = min(self.max_interval,
+                                    max(self.interval, self.step) / DECREASE)
+                self.last_backoff = now
+                metrics.incr("throttle.backoffs")
+                logger.info("Backing off after a {0}: {1} at a time, {2:.2f}s "
+                            "apart".format(reason, int(self.concurrency),
+                                           self.interval))
+
+            if pause:
+                self.paused_until = max(self.paused_until, now + pause)
+
+            metrics.observe("throttle.concurrency", int(self.concurrency))
+            metrics.observe("throttle.interval", self.interval)
+            self.condition.notify_all()
+
+
+def map_ordered(function, items, workers=None):
+    """map() with up to `workers` calls running at once in threads (default
+    config.THROTTLE_MAX_CONCURRENCY; the controller decides how many
+    requests actually go out). Results come back in input order, reading at
+    most two per worker ahead."""
+    workers = workers or getattr(config, "THROTTLE_MAX_CONCURRENCY",
+                                 DEFAULTS["THROTTLE_MAX_CONCURRENCY"])
+    if workers <= 1:
+        yield from map(function, items)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Module-level controller and shortcuts
+controller = Throttle()
+
+slot = controller.slot
+record = controller.record
+reset = controller.reset
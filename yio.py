@@ -1,44 +1,173 @@
 #!/usr/bin/env python3
 # Modules
 import config
+import metrics
+import json
 import logging
 import os
-import pickle
-import requests
+import re
 import sqlite3
-from bs4 import BeautifulSoup
+import time
+from contextlib import contextmanager
 from random import choice
 
+# requests and BeautifulSoup are only needed to log in, so YIO imports them
+# itself and scripts that only use DB start faster
+
+# File locking is Unix-only; elsewhere the session store works unlocked
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Enable logging for library
 # https://docs.python.org/3.4/howto/logging.html#library-config
 # logging.getLogger().addHandler(logging.NullHandler())
 logger = logging.getLogger(__name__)
 
+# Tables of raw page sections (requests-era and everything since) that
+# feed clean_me_full
+RAW_TABLES = ["organizations_raw_requests", "organizations_raw"]
+
+# The proxy answers with a Shibboleth login form instead of the page asked
+# for once a session has run out
+LOGIN_MARKER = "Shibboleth Authentication Request"
+
+
+def logged_out(page):
+    """Whether page is the login form rather than a YIO page"""
+    return LOGIN_MARKER in page
+
+
+class SessionStore():
+    """Cookies of a logged-in session, saved as JSON:
+
+        {"saved": ..., "checked": ..., "user_agent": ...,
+         "cookies": [{"name": ..., "value": ..., "domain": ..., "path": ...,
+                      "expires": ..., "secure": ...}, ...]}
+
+    saved and checked are Unix times of the login and of the last
+    successful probe. Writes go through a temporary file and os.replace,
+    and lock() holds an exclusive lock on a sidecar file, so several
+    workers can share one store and only one of them logs in.
+    """
+    def __init__(self, path=None):
+        self.path = path or getattr(config, "SESSION_FILE", "yio_session.json")
+
+    @contextmanager
+    def lock(self):
+        with open(self.path + ".lock", "a") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        """The saved session, or None if there isn't a readable one"""
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, saved):
+        temp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+
+        # Cookies are as good as a password, so keep them private
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(saved, f, indent=1)
+        os.replace(temp_path, self.path)
+
+    def save(self, session):
+        now = time.time()
+        self.write({"saved": now, "checked": now,
+                    "user_agent": session.headers.get("User-Agent"),
+                    "cookies": [{"name": cookie.name, "value": cookie.value,
+                                 "domain": cookie.domain, "path": cookie.path,
+                                 "expires": cookie.expires,
+                                 "secure": cookie.secure}
+                                for cookie in session.cookies]})
+
+    def expired(self, saved):
+        """Older than config.SESSION_MAX_AGE, or holding an expired cookie"""
+        now = time.time()
+        if now - saved["saved"] > getattr(config, "SESSION_MAX_AGE", 8 * 60 * 60):
+            return True
+        return any(cookie["expires"] is not None and cookie["expires"] < now
+                   for cookie in saved["cookies"])
+
+    def restore(self, saved, session):
+        if saved["user_agent"]:
+            session.headers.update({"User-Agent": saved["user_agent"]})
+        for cookie in saved["cookies"]:
+            session.cookies.set(cookie["name"], cookie["value"],
+                                domain=cookie["domain"], path=cookie["path"],
+                                expires=cookie["expires"],
+                                secure=cookie["secure"])
+
 
 class YIO():
     """Connect to the Yearbook of International Organizations through
     Duke's Shibboleth authentication system.
     """
     def __init__(self):
-        config.BASE_URL
-
-        # If there's a pre-logged-in session, use it.
-        # You can't pickle self and reload it again,
-        # but you can pickle self.__dict__ and self.update it
-        if os.path.isfile("yio.pickle"):
-            with open("yio.pickle", 'rb') as f:
-                self.__dict__.update(pickle.load(f))
-            logger.info("No need to log in---using existing session.")
-        # Otherwise log in and save the session to file
-        else:
-            logger.info("Logging in to YIO through Duke's library.")
-            self.s = requests.session()
-            self.s.headers.update({"User-Agent": choice(config.user_agents)})
-            self.login_through_duke()
-
-            with open('yio.pickle', 'wb') as f:
-                pickle.dump(self.__dict__, f)
-            logger.info("Saving session to file for future use.")
+        import requests
+
+        self.s = requests.session()
+        store = SessionStore()
+
+        # Hold the lock while checking and logging in, so workers starting
+        # together wait for one login instead of each doing their own
+        with store.lock():
+            saved = store.load()
+
+            # If there's a pre-logged-in session that still works, use it.
+            # It's only probed if nobody has checked it for a while.
+            if saved is not None and not store.expired(saved):
+                store.restore(saved, self.s)
+
+                if (time.time() - saved["checked"] <
+                        getattr(config, "SESSION_CHECK_EVERY", 10 * 60)):
+                    reuse = True
+                else:
+                    reuse = self.probe()
+                    if reuse:
+                        saved["checked"] = time.time()
+                        store.write(saved)
+            else:
+                reuse = False
+
+            if reuse:
+                logger.info("No need to log in---using existing session.")
+                metrics.incr("yio.session_reused")
+            # Otherwise log in and save the session to file
+            else:
+                if saved is not None:
+                    logger.info("Saved session has expired.")
+                    metrics.incr("yio.session_expired")
+
+                logger.info("Logging in to YIO through Duke's library.")
+                self.s = requests.session()
+                self.s.headers.update({"User-Agent": choice(config.user_agents)})
+                with metrics.timer("yio.login"):
+                    self.login_through_duke()
+
+                store.save(self.s)
+                logger.info("Saving session to file for future use.")
+
+    def probe(self):
+        """Check the session is still logged in. Only reads the start of the
+        YIO front page, which is enough to spot the login form."""
+        with metrics.timer("yio.probe"):
+            response = self.s.get(config.BASE_URL + "/ybio", stream=True)
+            start = response.raw.read(16384, decode_content=True)
+            response.close()
+
+        return not logged_out(start.decode("utf-8", "replace"))
 
     def login_through_duke(self):
         """Bounce between all the different authentication layers to log into
@@ -46,6 +175,7 @@ class YIO():
 
         Leaves self.s logged in and ready to be used for all other YIO URLs
         """
+        from bs4 import BeautifulSoup
 
         # URLs to be used
         yio_url = config.BASE_URL + "/ybio"
@@ -57,7 +187,7 @@ class YIO():
         # ----------------------------------------------------------------
         initial_yio_page = self.s.get(yio_url).text
 
-        if "Shibboleth Authentication Request" not in initial_yio_page:
+        if not logged_out(initial_yio_page):
             raise RuntimeError("Did not correctly connect to the initial YIO proxy page.")
         else:
             soup = BeautifulSoup(initial_yio_page)
@@ -123,6 +253,11 @@ class DB():
             logger.info("Creating new database.")
             self.create()
 
+        self._clean_me_sql = None
+        self._clean_me_listing_sql = None
+        self.materialize_clean_me()
+        self.add_clean_me_columns(self.raw_columns())
+
     def add_factory(self, factory):
         if factory:
             # Closure wizardry: http://stackoverflow.com/a/4020443/120898
@@ -148,21 +283,201 @@ class DB():
         for command in create_command:
             self.c.execute(command)
 
-    def insert_dict(self, row_dict, table):
+    def ensure_tables(self, tables):
+        """Create any of these tables (and their indexes) that don't exist
+        yet from schema.sql, for databases made before they were added."""
+        existing = {row[0] for row in
+                    self.c.execute("SELECT name FROM sqlite_master").fetchall()}
+        missing = set(tables) - existing
+
+        if len(missing) == 0:
+            return
+
+        logger.info("Adding tables: {0}".format(", ".join(sorted(missing))))
+        for command in open("schema.sql", "r").read().split(";"):
+            target = re.search(r"CREATE (?:UNIQUE )?(?:TABLE|INDEX \w+ ON) (\w+)",
+                               command)
+            if target and target.group(1) in missing:
+                self.c.execute(command)
+
+    def insert_dict(self, row_dict, table, replace=False, commit=True):
+        # replace=True overwrites an existing row with the same key. Only use
+        # it on tables nothing references, since REPLACE deletes the old row
+        # (and anything that cascades from it) first. commit=False leaves
+        # committing to the caller, for writing rows in batches.
         var_names = ", ".join(row_dict.keys())
         placeholders = ", ".join([":" + key for key in row_dict.keys()])
 
-        insert_string = ("INSERT OR IGNORE INTO {2} ({0}) VALUES ({1})"
-                         .format(var_names, placeholders, table))
-
-        self.c.execute(insert_string, row_dict)
-
-        if self.c.rowcount == 1:
-            logger.info("Inserted row into database.")
+        insert_string = ("INSERT OR {3} INTO {2} ({0}) VALUES ({1})"
+                         .format(var_names, placeholders, table,
+                                 "REPLACE" if replace else "IGNORE"))
+
+        with metrics.timer("db.write"):
+            self.c.execute(insert_string, row_dict)
+            inserted = self.c.rowcount == 1
+            if inserted and table in RAW_TABLES:
+                self.refresh_clean_me(row_dict, table)
+            if commit:
+                self.conn.commit()
+
+        if inserted:
+            metrics.incr("db.rows_inserted")
+            metrics.incr("db.rows_inserted." + table)
+            logger.info("Inserted row into database.",
+                        extra={"aggregate": "Inserted {0} rows into database."})
         else:
-            logger.info("Skipping. Already in database.")
+            metrics.incr("db.rows_skipped")
+            metrics.incr("db.rows_skipped." + table)
+            logger.info("Skipping. Already in database.",
+                        extra={"aggregate": "Skipped {0} rows already in database."})
+
+    def upsert_dict(self, row_dict, table, key, keep=(), commit=True):
+        """Insert row_dict, or update the row that has the same value of the
+        key column (which needs a unique index). The row is updated in
+        place, so it keeps its id and nothing referencing it is cascaded
+        away. Columns in keep are only written when the row is new. As with
+        insert_dict, commit=False leaves committing to the caller.
+        """
+        var_names = ", ".join(row_dict.keys())
+        placeholders = ", ".join([":" + col for col in row_dict.keys()])
+        updates = ", ".join("{0} = excluded.{0}".format(col) for col in row_dict
+                            if col != key and col not in keep)
+
+        upsert_string = ("""INSERT INTO {0} ({1}) VALUES ({2})
+                            ON CONFLICT ({3}) DO UPDATE SET {4}"""
+                         .format(table, var_names, placeholders, key, updates))
+
+        with metrics.timer("db.write"):
+            self.c.execute(upsert_string, row_dict)
+            if table == "organizations":
+                self.refresh_clean_me_listing(key, row_dict[key])
+            if commit:
+                self.conn.commit()
+
+        metrics.incr("db.rows_upserted")
+        metrics.incr("db.rows_upserted." + table)
+
+    def clean_me_columns(self):
+        """(columns from organizations, columns from the raw tables) in
+        clean_me_full"""
+        org_cols = [col[1] for col in self.c.execute(
+            "PRAGMA table_info(organizations);").fetchall()]
+        raw_cols = [col[1] for col in self.c.execute(
+            "PRAGMA table_info(clean_me_full);").fetchall()
+                    if col[1] not in org_cols]
+        return org_cols, raw_cols
+
+    def refresh_clean_me(self, row_dict, table="organizations_raw"):
+        """Copy a just-inserted raw row, with its organizations row, into
+        clean_me_full. As in materialize_clean_me, an organizations_raw row
+        wins over an organizations_raw_requests row for the same
+        organization, whichever was written first."""
+        if table != "organizations_raw" and self.has_raw_row(row_dict['fk_org']):
+            return
+
+        if self._clean_me_sql is None:
+            org_cols, raw_cols = self.clean_me_columns()
+            self._clean_me_sql = (
+                """INSERT OR REPLACE INTO clean_me_full ({0}, {1})
+                   SELECT {0}, {2} FROM organizations WHERE id_org = :fk_org"""
+                .format(", ".join(org_cols), ", ".join(raw_cols),
+                        ", ".join(":" + col for col in raw_cols)),
+                raw_cols)
+
+        sql, raw_cols = self._clean_me_sql
+        params = {col: row_dict.get(col) for col in raw_cols}
+        params['fk_org'] = row_dict['fk_org']
+        self.c.execute(sql, params)
+        metrics.incr("db.clean_me_refreshed")
+
+    def raw_columns(self):
+        """Section columns in the raw tables that exist"""
+        columns = []
+        for table in RAW_TABLES:
+            columns += [col[1] for col in self.c.execute(
+                "PRAGMA table_info({0});".format(table)).fetchall()
+                        if col[1] != "fk_org" and col[1] not in columns]
+        return columns
+
+    def add_clean_me_columns(self, colnames):
+        """Add section columns clean_me_full doesn't have yet, for headings
+        schema.sql doesn't list, so they're carried through as the old view
+        carried them"""
+        existing = {col[1] for col in self.c.execute(
+            "PRAGMA table_info(clean_me_full);").fetchall()}
+        new_cols = [col for col in colnames
+                    if col != "fk_org" and col not in existing]
+
+        for col in new_cols:
+            self.c.execute("ALTER TABLE clean_me_full ADD COLUMN {0} text"
+                           .format(col))
+        if new_cols:
+            self._clean_me_sql = None
+
+    def has_raw_row(self, id_org):
+        """Whether organizations_raw (which may not exist yet) has id_org"""
+        if self.c.execute("""SELECT 1 FROM sqlite_master
+                             WHERE name = 'organizations_raw'""").fetchone() is None:
+            return False
+        return self.c.execute("SELECT 1 FROM organizations_raw WHERE fk_org = ?",
+                              (id_org,)).fetchone() is not None
+
+    def refresh_clean_me_listing(self, key, value):
+        """Copy an updated organizations row's columns into clean_me_full"""
+        if self._clean_me_listing_sql is None:
+            org_cols, _ = self.clean_me_columns()
+            self._clean_me_listing_sql = ", ".join(org_cols)
+
+        self.c.execute("""UPDATE clean_me_full SET ({0}) =
+                            (SELECT {0} FROM organizations WHERE {1} = ?)
+                          WHERE id_org =
+                            (SELECT id_org FROM organizations WHERE {1} = ?)"""
+                       .format(self._clean_me_listing_sql, key), (value, value))
+
+    def materialize_clean_me(self):
+        """Replace an old hand-made clean_me_full view with the table from
+        schema.sql and fill it from the raw tables. Unlike the view, an
+        organization in both raw tables gets one row, from organizations_raw.
+        """
+        kind = self.c.execute("""SELECT type FROM sqlite_master
+                                 WHERE name = 'clean_me_full'""").fetchone()
+        if kind is not None and kind[0] == "table":
+            return
+
+        logger.info("Materializing clean_me_full")
+        if kind is not None:
+            self.c.execute("DROP VIEW clean_me_full")
+        self.ensure_tables(["clean_me_full"])
+        self.add_clean_me_columns(self.raw_columns())
+
+        org_cols, raw_cols = self.clean_me_columns()
+
+        # clean_me_full has one row per organization. The old UNION ALL view
+        # returned a row from each raw table for an organization that is in
+        # both (and clean_rows kept whichever came first); now the
+        # organizations_raw row, filled in last here, replaces the
+        # organizations_raw_requests one. organizations_raw is the newer
+        # source (manual copies of pages requests could no longer get).
+        for table in RAW_TABLES:
+            existing = [col[1] for col in self.c.execute(
+                "PRAGMA table_info({0});".format(table)).fetchall()]
+            if len(existing) == 0:
+                continue
+
+            cols = [col for col in raw_cols if col in existing]
+            self.c.execute("""INSERT OR REPLACE INTO clean_me_full ({0}, {1})
+                              SELECT {2}, {3} FROM {4} AS raw
+                              INNER JOIN organizations
+                                ON raw.fk_org = organizations.id_org"""
+                           .format(", ".join(org_cols), ", ".join(cols),
+                                   ", ".join("organizations." + col
+                                             for col in org_cols),
+                                   ", ".join("raw." + col for col in cols),
+                                   table))
 
         self.conn.commit()
+        logger.info("clean_me_full has {0} rows".format(self.c.execute(
+            "SELECT COUNT(*) FROM clean_me_full").fetchone()[0]))
 
     def close(self):
         self.c.close()
@@ -203,6 +518,8 @@ class DB():
 
         # Add new columns if needed
         if len(new_cols) > 0:
+            metrics.incr("db.raw_columns_added", len(new_cols))
             for col in new_cols:
                 self.c.execute("ALTER TABLE organizations_raw ADD COLUMN {0} text"
                                .format(col))
+            self.add_clean_me_columns(sorted(new_cols))